@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# "Bot is working" indicators: the typing action plus an animated placeholder.
+# Each chat gets one timer task, however many replies are being generated in
+# it, and every tick sends at most one typing action and one edit per
+# placeholder. When the platform reports a flood wait the chat's tick interval
+# grows to at least the requested wait and then shrinks back gradually.
+# Leaving an activity (or detaching its placeholder) waits for an edit that is
+# already in flight, so the real reply can never be overwritten by a late
+# animation frame.
+
+
+class _ChatState:
+    def __init__(self, interval):
+        self.activities = 0
+        self.placeholders = {}  # placeholder message -> animation frame
+        self.lock = asyncio.Lock()  # held while the timer talks to the platform
+        self.interval = interval
+        self.next_action = 0.0
+        self.task = None
+
+
+class ChatActivity:
+    def __init__(self, service, chat, placeholder=None):
+        self.service = service
+        self.chat = chat
+        self.placeholder = placeholder
+
+    async def __aenter__(self):
+        self.service._enter(self.chat, self.placeholder)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.detach()
+        await self.service._exit(self.chat)
+
+    async def detach(self):
+        """Stop animating the placeholder; once this returns it will not be edited again."""
+        if self.placeholder is not None:
+            await self.service._detach(self.chat, self.placeholder)
+            self.placeholder = None
+
+
+class ChatActivityService:
+    def __init__(self, send_action, edit, flood_wait=None, text="Thinking", action_interval=4.5,
+                 frame_interval=1.5, max_interval=60.0):
+        """`send_action(chat)` shows the typing indicator and `edit(placeholder, text)` updates a
+        placeholder; `flood_wait(error)` returns the seconds a rate-limit error asks to wait, else None.
+        `chat` is whatever the caller identifies chats by, as long as it is hashable."""
+        self.send_action = send_action
+        self.edit = edit
+        self.flood_wait = flood_wait or (lambda error: None)
+        self.text = text
+        self.action_interval = action_interval
+        self.frame_interval = frame_interval
+        self.max_interval = max_interval
+        self._chats = {}
+
+        self.actions_sent = 0
+        self.edits_sent = 0
+        self.flood_waits = 0
+
+    def activity(self, chat, placeholder=None):
+        return ChatActivity(self, chat, placeholder)
+
+    def stats(self):
+        return {
+            "chats": len(self._chats),
+            "actions_sent": self.actions_sent,
+            "edits_sent": self.edits_sent,
+            "flood_waits": self.flood_waits,
+        }
+
+    def _enter(self, chat, placeholder):
+        state = self._chats.get(chat)
+        if state is None:
+            state = self._chats[chat] = _ChatState(self.frame_interval)
+        state.activities += 1
+        if placeholder is not None:
+            state.placeholders[placeholder] = 0
+        if state.task is None:
+            state.task = asyncio.create_task(self._run(chat, state))
+
+    async def _detach(self, chat, placeholder):
+        state = self._chats.get(chat)
+        if state is None:
+            return
+        async with state.lock:
+            state.placeholders.pop(placeholder, None)
+
+    async def _exit(self, chat):
+        state = self._chats.get(chat)
+        if state is None:
+            return
+        state.activities -= 1
+        if state.activities > 0:
+            return
+        del self._chats[chat]
+        task, state.task = state.task, None
+        # Cancel between ticks, never in the middle of a platform call
+        async with state.lock:
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def _run(self, chat, state):
+        while True:
+            async with state.lock:
+                try:
+                    await self._tick(chat, state)
+                    state.interval = max(self.frame_interval, state.interval * 0.75)
+                except Exception as e:
+                    wait = self.flood_wait(e)
+                    if wait is not None:
+                        self.flood_waits += 1
+                        state.interval = min(self.max_interval, max(wait, state.interval * 2))
+                    else:
+                        logger.warning(f"Chat activity update failed for chat {chat}: {e}")
+                        state.interval = min(self.max_interval, state.interval * 2)
+            await asyncio.sleep(state.interval)
+
+    async def _tick(self, chat, state):
+        now = time.monotonic()
+        if now >= state.next_action:
+            await self.send_action(chat)
+            self.actions_sent += 1
+            state.next_action = now + self.action_interval
+        for placeholder, frame in list(state.placeholders.items()):
+            frame = frame % 3 + 1
+            try:
+                await self.edit(placeholder, f"{self.text}{'.' * frame}")
+            except Exception as e:
+                if self.flood_wait(e) is not None:
+                    raise
+                # Most likely deleted; the reply will be sent as a new message anyway
+                logger.warning(f"Stopped animating a placeholder in chat {chat}: {e}")
+                del state.placeholders[placeholder]
+                continue
+            self.edits_sent += 1
+            state.placeholders[placeholder] = frame
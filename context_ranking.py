@@ -0,0 +1,92 @@
+import time
+
+import numpy as np
+import openai
+
+import metrics
+import tracing
+
+
+# Batched embedding + vectorized relevance ranking used when building context.
+# Candidates are embedded in a single request, stacked into one float32 matrix
+# and scored against the query with a single matrix-vector product.
+
+EMBEDDING_SECONDS = metrics.histogram("embedding_request_seconds", "Embedding API request latency", ("model",))
+EMBEDDED_TEXTS = metrics.counter("embedding_texts_total", "Texts embedded, by where the vector came from",
+                                 ("model", "source"))
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+async def embed_texts(texts, model, normalize=True, cache=None) -> np.ndarray:
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    texts = list(texts)
+    vectors = await cache.get_many(model, texts) if cache is not None else [None] * len(texts)
+
+    # Only texts the cache could not answer go to the API, each at most once
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+    EMBEDDED_TEXTS.labels(model, "cache").inc(len(texts) - sum(vector is None for vector in vectors))
+    if missing:
+        EMBEDDED_TEXTS.labels(model, "api").inc(len(missing))
+        started = time.perf_counter()
+        with tracing.span("llm.embed", tracing.KIND_CLIENT, {"llm.model": model, "llm.inputs": len(missing)},
+                          require_parent=True):
+            response = await openai.Embedding.acreate(model=model, input=missing)
+        EMBEDDING_SECONDS.labels(model).observe(time.perf_counter() - started)
+        # The API returns one item per input, tagged with its position in the request
+        data = sorted(response["data"], key=lambda item: item["index"])
+        fetched = [np.asarray(item["embedding"], dtype=np.float32) for item in data]
+        if cache is not None:
+            await cache.put_many(model, missing, fetched)
+        by_text = dict(zip(missing, fetched))
+        vectors = [by_text[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+
+    matrix = np.vstack(vectors).astype(np.float32, copy=False)
+    return normalize_rows(matrix) if normalize else matrix
+
+
+def rank_indices(scores: np.ndarray, indices=None, k=None, threshold=None) -> np.ndarray:
+    """Return candidate indices ordered by descending score.
+
+    `indices` restricts ranking to a subset of rows, `threshold` drops anything
+    scoring below it and `k` keeps only the best k (selected with argpartition,
+    so only the survivors get fully sorted).
+    """
+    candidates = np.arange(len(scores)) if indices is None else np.asarray(indices, dtype=np.intp)
+    if threshold is not None:
+        candidates = candidates[scores[candidates] >= threshold]
+    if k is not None and k < len(candidates):
+        best = np.argpartition(-scores[candidates], k - 1)[:k]
+        candidates = candidates[best]
+    order = np.argsort(-scores[candidates], kind="stable")
+    return candidates[order]
+
+
+class ContextRanker:
+    """Scores a fixed set of candidates against one query.
+
+    Built once per context request from the batched embeddings; every ranking
+    afterwards is an index lookup into the precomputed score vector.
+    """
+
+    def __init__(self, query_vector: np.ndarray, candidate_matrix: np.ndarray):
+        self.query_vector = query_vector
+        self.candidate_matrix = candidate_matrix
+        if len(candidate_matrix):
+            self.scores = candidate_matrix @ query_vector
+        else:
+            self.scores = np.zeros(0, dtype=np.float32)
+
+    @classmethod
+    async def from_texts(cls, query, candidate_texts, model, normalize=True, cache=None):
+        vectors = await embed_texts([query] + list(candidate_texts), model, normalize=normalize, cache=cache)
+        return cls(vectors[0], vectors[1:])
+
+    def rank(self, indices=None, k=None, threshold=None) -> np.ndarray:
+        return rank_indices(self.scores, indices=indices, k=k, threshold=threshold)
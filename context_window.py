@@ -0,0 +1,139 @@
+import logging
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+
+from zep_python.exceptions import NotFoundError
+
+from token_budget import count_message_tokens, count_tokens
+
+
+logger = logging.getLogger(__name__)
+
+
+# Token-budgeted rolling history window per session.
+# Each build fetches only the most recent `max_messages` from Zep and merges
+# the ones newer than the window's cursor, so the fetch and the prompt stay
+# the same size however long the channel history gets. Messages that fall out
+# of the window (count, age or token budget) are represented by the session's
+# latest summary instead of being replayed verbatim.
+
+
+def _parse_time(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+class SessionWindow:
+    def __init__(self):
+        self.messages = deque()  # dicts with uuid, role, content, created_at, tokens
+        self.uuids = set()
+        self.tokens = 0
+        self.cursor = None  # created_at of the newest message merged so far
+        self.cursor_uuids = set()  # uuids of the merged messages created exactly at the cursor
+        self.summary = None
+        self.summary_tokens = 0
+
+    def append(self, uuid, role, content, created_at, tokens):
+        self.messages.append({
+            "uuid": uuid,
+            "role": role,
+            "content": content,
+            "created_at": created_at,
+            "tokens": tokens,
+        })
+        if uuid:
+            self.uuids.add(uuid)
+        self.tokens += tokens
+        if created_at is not None and (self.cursor is None or created_at > self.cursor):
+            self.cursor = created_at
+            self.cursor_uuids = set()
+        if created_at is not None and created_at == self.cursor and uuid:
+            self.cursor_uuids.add(uuid)
+
+    def pop_oldest(self):
+        message = self.messages.popleft()
+        self.uuids.discard(message["uuid"])
+        self.tokens -= message["tokens"]
+        return message
+
+    def chat_messages(self):
+        messages = []
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of earlier conversation: {self.summary}"})
+        messages.extend({"role": m["role"], "content": m["content"]} for m in self.messages)
+        return messages
+
+    def transcript(self):
+        lines = []
+        if self.summary:
+            lines.append(f"summary: {self.summary}")
+        lines.extend(f"{m['role']}: {m['content']}" for m in self.messages)
+        return "\n".join(lines)
+
+
+class ContextAssembler:
+    def __init__(self, zep_client, model, max_tokens=3000, max_messages=10, retention_minutes=30,
+                 max_sessions=1000):
+        self.zep_client = zep_client
+        self.model = model
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        self.retention = timedelta(minutes=retention_minutes)
+        self.max_sessions = max_sessions
+        self._windows = OrderedDict()
+
+    def window(self, session_id):
+        window = self._windows.get(session_id)
+        if window is None:
+            window = self._windows[session_id] = SessionWindow()
+            while len(self._windows) > self.max_sessions:
+                self._windows.popitem(last=False)
+        self._windows.move_to_end(session_id)
+        return window
+
+    async def build(self, session_id):
+        window = self.window(session_id)
+
+        try:
+            memory = await self.zep_client.memory.aget_memory(session_id, lastn=self.max_messages)
+        except NotFoundError:
+            logger.info(f"No memory for session {session_id} yet")
+            return window
+
+        if memory.summary is not None and memory.summary.content != window.summary:
+            window.summary = memory.summary.content
+            window.summary_tokens = count_tokens(window.summary, self.model)
+
+        for message in memory.messages or []:
+            created_at = _parse_time(message.created_at)
+            if message.uuid and message.uuid in window.uuids:
+                continue
+            if created_at is not None and window.cursor is not None and created_at <= window.cursor:
+                # Messages sharing the cursor's timestamp are only known if their uuid was merged,
+                # even when trimming has already dropped them from the window
+                if created_at < window.cursor or not message.uuid or message.uuid in window.cursor_uuids:
+                    continue
+            window.append(message.uuid, message.role, message.content, created_at,
+                          count_message_tokens(message.content, self.model))
+
+        self._trim(window)
+        return window
+
+    def _trim(self, window):
+        while len(window.messages) > self.max_messages:
+            window.pop_oldest()
+
+        if window.cursor is not None:
+            # Retention is measured back from the newest message, not wall-clock time,
+            # so a quiet channel still keeps the tail of its last conversation
+            cutoff = window.cursor - self.retention
+            while window.messages and window.messages[0]["created_at"] is not None \
+                    and window.messages[0]["created_at"] < cutoff:
+                window.pop_oldest()
+
+        while window.messages and window.tokens + window.summary_tokens > self.max_tokens:
+            window.pop_oldest()
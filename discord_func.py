@@ -8,18 +8,31 @@ from aiohttp import ClientTimeout, ClientConnectorError
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 import asyncio
 from asyncio import TimeoutError
+import functools
 import re
 import io
 import requests
 import uuid
-from datetime import datetime, timedelta
 import json
-import numpy as np
-import asyncpg
 from asyncpg.pool import Pool
 
-from zep_python import (ZepClient, MemorySearchPayload)
-from zep_python.memory import Memory, Message
+import metrics
+import tracing
+
+from context_ranking import embed_texts
+from context_window import ContextAssembler
+from rate_limiter import RateLimit
+from response_cache import SemanticResponseCache
+from response_streaming import StreamingMessageEditor
+from session_cache import SessionIdCache
+from shared_state import MemorySharedState, PostgresSharedState
+from session_scheduler import SessionScheduler, format_batched_questions, settle, split_batched_answers
+from summary_scheduler import PostgresWatermarkStore, SummaryScheduler
+from summary_tree import PostgresSummaryNodeStore, SummaryTree
+from shared_resources import (acquire_pg_pool, get_embedding_cache, get_llm_gateway, get_memory_backend, get_memory_writer,
+                              get_metrics_server, get_rate_limiter, get_search_index, get_tracer, get_zep_client,
+                              release_pg_pool, start_rate_limiter, stop_rate_limiter)
+from zep_python.memory import Message
 
 
 load_dotenv()
@@ -38,20 +51,13 @@ PG_DATABASE = os.getenv("PG_DATABASE")
 
 
 BOT_COMMAND_PREFIX = os.getenv('BOT_PREFIX')
+DISCORD_SHARD_COUNT = os.getenv("DISCORD_SHARD_COUNT")  # Total shards over all processes, or "auto"; unset runs one unsharded connection
+DISCORD_SHARD_IDS = os.getenv("DISCORD_SHARD_IDS")  # Shards this process runs, e.g. "0-3" or "0,2,4"; unset runs all of them
 ZEP_API_URL = os.getenv("ZEP_API_URL")
 ZEP_API_KEY = os.getenv("ZEP_API_KEY")
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 
-recent_prompts = []
-
-message_counters = {}
-
-
-
-zep_client = ZepClient(ZEP_API_URL, ZEP_API_KEY)
-
-
 
   # Prefix for bot commands
 
@@ -75,6 +81,11 @@ MAX_MESSAGES_BEFORE_SUMMARY = 75  # Number of messages before triggering a summa
 MAX_CHARS_BEFORE_SUMMARY = 12000  # Total character count before triggering a summary
 SUMMARY_WORD_LIMIT = 200  # Maximum word count for generated summaries
 SUMMARY_MAX_AGE_HOURS = 24  # Maximum age of a summary before it's updated, regardless of message count
+SUMMARY_DEBOUNCE = 30  # Seconds a channel must be quiet before its due summary runs
+SUMMARY_MAX_DELAY = 300  # Seconds a due summary may be postponed by ongoing conversation
+SUMMARY_WORKERS = 2  # Summaries generated concurrently in the background
+SUMMARY_CHUNK_SIZE = 25  # Messages per first-level summary
+SUMMARY_FANOUT = 4  # Summaries rolled up into one summary of the next level
 
 # Context Retrieval
 RELEVANCE_THRESHOLD = 0.5  # Minimum relevance score for including messages/summaries
@@ -83,6 +94,8 @@ SUMMARY_PERCENTAGE_REDUCTION = 0.1  # Reduction in percentage for each successiv
 MIN_SUMMARY_PERCENTAGE = 0.5  # Minimum percentage of messages to include from a summary
 MAX_CONTEXT_TOKENS = 3000  # Maximum number of tokens for the entire context
 SUMMARY_CONTEXT_PERCENTAGE = 0.7  # Percentage of context dedicated to summary-related messages
+SUMMARY_CONTEXT_TOKENS = 800  # Token budget for hierarchical summaries of earlier conversation in a prompt
+RESPONSE_CACHE_THRESHOLD = 0.95  # Minimum question similarity for reusing a cached answer in the same channel
 
 # Model Selection
 SUMMARIZATION_MODEL = "gpt-4o-mini"  # Model to use for generating summaries
@@ -92,9 +105,17 @@ EMBEDDING_MODEL = "text-embedding-ada-002"  # Model to use for creating embeddin
 # Search and Ranking
 SEARCH_RESULT_LIMIT = 100  # Maximum number of results to retrieve from memory search
 MMR_LAMBDA = 0.5  # Lambda parameter for MMR reranking
+MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "zep")  # Semantic retrieval backend: "zep", "local" or "cached"
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", "vector_store")  # Directory of the local vector store
+VECTOR_STORE_IVF_MIN_SIZE = 4096  # Messages in a channel before its vectors get an IVF index
+VECTOR_STORE_NPROBE = 8  # IVF lists scanned per query
+RELEVANT_CONTEXT_TOKENS = 600  # Budget for retrieved older messages in a prompt
 
 # Discord Bot Settings
-
+DISCORD_MESSAGE_LIMIT = 2000  # Maximum characters Discord accepts in a single message
+STREAM_RESPONSES = True  # Stream replies into the "Thinking..." message as tokens arrive
+STREAM_EDIT_INTERVAL = 1.0  # Minimum seconds between edits of a streamed message (Discord allows ~5 edits / 5s)
+MENTION_BATCH_SIZE = 5  # Most mentions answered by one completion
 
 # Summarization Process
 SUMMARY_STYLE = "concise"  # Options: "concise", "detailed", "bullet-points"
@@ -121,6 +142,11 @@ RATE_LIMIT_COMMANDS = 20  # Maximum number of commands per user per hour
 COOLDOWN_DURATION = 5  # Seconds a user must wait between using specific commands
 BURST_ALLOWANCE = 5  # Number of rapid requests allowed before rate limiting kicks in
 RATE_LIMIT_RESPONSE = "You're doing that too much. Please wait a moment and try again."
+RATE_LIMIT_CHANNEL_MESSAGES = 60  # Maximum bot replies per channel per minute
+RATE_LIMIT_LLM_REQUESTS = 600  # Maximum bot replies per minute across all users, channels and bots
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "memory")  # "memory" (one process) or "postgres" (recent prompts shared by every shard process)
+RECENT_PROMPTS_KEY = "discord:recent_prompts"
+RECENT_PROMPTS_LIMIT = 5  # Prompts listed by the prompt command
 
 # Context Retention
 CONTEXT_RETENTION_MESSAGES = 10  # Number of previous messages to retain for context
@@ -136,32 +162,116 @@ ERROR_LOGGING_LEVEL = "detailed"  # Options: "minimal", "detailed"
 
 # Performance Optimization
 CACHE_DURATION = 3600  # Seconds to cache embeddings or frequent queries
+EMBEDDING_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Memory budget for the in-process embedding cache
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")  # Optional SQLite file for the on-disk embedding tier
 BATCH_SIZE = 10  # Number of items to process in a single batch for efficiency
+MEMORY_FLUSH_INTERVAL = 1.0  # Seconds a queued message may wait before it is written to Zep
+MEMORY_QUEUE_SIZE = 1000  # Maximum queued Zep writes before handlers wait for the writer to catch up
+SESSION_CACHE_SIZE = 10000  # Maximum cached channel -> session id mappings
+SEARCH_INDEX_SESSIONS = 200  # Channels whose full-text search index is kept in memory
+RESPONSE_CACHE_SIZE = 32  # Cached answers kept per channel
+RESPONSE_CACHE_SESSIONS = 1000  # Channels with cached answers kept in memory
 ASYNC_PROCESSING = True  # Enable asynchronous processing of non-critical tasks
 
 # Integration with External Services
 ENABLE_WEATHER_API = False  # Toggle integration with weather service
 ENABLE_NEWS_API = False  # Toggle integration with news service
 API_TIMEOUT = 5  # Maximum wait time for external API responses in seconds
+ZEP_EXECUTOR_WORKERS = 4  # Threads for Zep SDK calls that have no native async variant
+LLM_MAX_CONCURRENCY = 16  # Chat completions in flight at once across the process
+LLM_REQUESTS_PER_MINUTE = 3500  # OpenAI request budget the gateway paces to
+LLM_TOKENS_PER_MINUTE = 200000  # OpenAI token budget the gateway paces to
+LLM_TIMEOUT = 60  # Seconds before a chat completion request is abandoned
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # Local port serving /metrics; 0 turns it off
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER")  # "file", "otlp", or unset to record no traces
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")  # OTLP/JSON lines written by the file exporter
+TRACE_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")  # Collector for the otlp exporter
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))  # Share of inbound messages that get traced
+
+# Rate limits, all token buckets refilling at the configured rate and holding BURST_ALLOWANCE requests
+USER_MESSAGE_LIMIT = RateLimit(RATE_LIMIT_MESSAGES, 60, BURST_ALLOWANCE)
+CHANNEL_MESSAGE_LIMIT = RateLimit(RATE_LIMIT_CHANNEL_MESSAGES, 60, BURST_ALLOWANCE)
+LLM_REQUEST_LIMIT = RateLimit(RATE_LIMIT_LLM_REQUESTS, 60, LLM_MAX_CONCURRENCY)
+USER_COMMAND_LIMIT = RateLimit(RATE_LIMIT_COMMANDS, 3600, BURST_ALLOWANCE)
+COMMAND_COOLDOWN = RateLimit(1, COOLDOWN_DURATION)
+LLM_BUDGET_KEY = "llm:global"  # Shared with the other bots, so the budget covers all of them
 
 # API Keys and Credentials
 
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix=BOT_COMMAND_PREFIX, intents=intents, help_command=None)
 
 
-def highlight_keyword(text, keyword):
-    pattern = re.compile(re.escape(keyword), re.IGNORECASE)
-    return pattern.sub(f"*`{keyword}`*", text)
+def parse_shard_ids(value):
+    """Parse a shard list such as "0-3,6" into [0, 1, 2, 3, 6]."""
+    shard_ids = []
+    for part in value.split(","):
+        first, _, last = part.strip().partition("-")
+        shard_ids.extend(range(int(first), int(last or first) + 1))
+    return shard_ids
+
+
+def create_bot():
+    if not DISCORD_SHARD_COUNT:
+        return commands.Bot(command_prefix=BOT_COMMAND_PREFIX, intents=intents, help_command=None)
+    if DISCORD_SHARD_COUNT == "auto":
+        # Discord picks the shard count and this process runs every shard
+        return commands.AutoShardedBot(command_prefix=BOT_COMMAND_PREFIX, intents=intents, help_command=None)
+    return commands.AutoShardedBot(
+        command_prefix=BOT_COMMAND_PREFIX,
+        intents=intents,
+        help_command=None,
+        shard_count=int(DISCORD_SHARD_COUNT),
+        shard_ids=parse_shard_ids(DISCORD_SHARD_IDS) if DISCORD_SHARD_IDS else None
+    )
+
+
+bot = create_bot()
+shared_state = MemorySharedState()
+
+zep_client = get_zep_client(ZEP_API_URL, ZEP_API_KEY, timeout=API_TIMEOUT, max_workers=ZEP_EXECUTOR_WORKERS)
+embedding_cache = get_embedding_cache(ttl=CACHE_DURATION, max_bytes=EMBEDDING_CACHE_MAX_BYTES, path=EMBEDDING_CACHE_PATH)
+memory_writer = get_memory_writer(zep_client, batch_size=BATCH_SIZE, flush_interval=MEMORY_FLUSH_INTERVAL,
+                                  max_pending=MEMORY_QUEUE_SIZE)
+context_assembler = ContextAssembler(zep_client, RESPONSE_GENERATION_MODEL, max_tokens=MAX_CONTEXT_TOKENS,
+                                     max_messages=CONTEXT_RETENTION_MESSAGES,
+                                     retention_minutes=CONTEXT_RETENTION_TIME)
+
+
+def embed_normalized(texts):
+    return embed_texts(texts, EMBEDDING_MODEL, normalize=True, cache=embedding_cache)
+
+
+response_cache = SemanticResponseCache(
+    embed_normalized,
+    threshold=RESPONSE_CACHE_THRESHOLD,
+    ttl=CACHE_DURATION,
+    max_entries=RESPONSE_CACHE_SIZE,
+    max_sessions=RESPONSE_CACHE_SESSIONS
+)
+memory_backend = get_memory_backend(MEMORY_BACKEND, zep_client, memory_writer, embed=embed_normalized,
+                                    path=VECTOR_STORE_PATH, ivf_min_size=VECTOR_STORE_IVF_MIN_SIZE,
+                                    nprobe=VECTOR_STORE_NPROBE)
+search_index = get_search_index(zep_client, memory_writer, max_sessions=SEARCH_INDEX_SESSIONS)
+rate_limiter = get_rate_limiter()
+llm_gateway = get_llm_gateway(max_concurrency=LLM_MAX_CONCURRENCY, requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+                              tokens_per_minute=LLM_TOKENS_PER_MINUTE, timeout=LLM_TIMEOUT)
+metrics_server = get_metrics_server(METRICS_PORT)
+tracer = get_tracer(TRACE_EXPORTER, path=TRACE_FILE, endpoint=TRACE_OTLP_ENDPOINT, sample_rate=TRACE_SAMPLE_RATE)
+metrics.export_stats("discord", "response_cache", response_cache.stats)
+
+
+def highlight_keyword(keyword):
+    return f"*`{keyword}`*"
 
 
 class PostgresSessionStorage:
     def __init__(self):
         self.pool: Pool = None
+        self.cache = SessionIdCache(self._load_session_id, max_size=SESSION_CACHE_SIZE)
 
     async def initialize(self):
-        self.pool = await asyncpg.create_pool(
+        self.pool = await acquire_pg_pool(
             host=PG_HOST,
             port=PG_PORT,
             user=PG_USER,
@@ -179,6 +289,9 @@ class PostgresSessionStorage:
             ''')
 
     async def get_session_id(self, channel_id: int) -> str:
+        return await self.cache.get(channel_id)
+
+    async def _load_session_id(self, channel_id: int) -> str:
         async with self.pool.acquire() as conn:
             row = await conn.fetchrow(
                 'SELECT session_id FROM sessions WHERE channel_id = $1',
@@ -186,36 +299,80 @@ class PostgresSessionStorage:
             )
             if row:
                 return str(row['session_id'])
-            
-            # If no session exists, create a new one
-            session_id = str(uuid.uuid4())
-            await conn.execute(
-                'INSERT INTO sessions (channel_id, session_id) VALUES ($1, $2)',
-                channel_id, session_id
+
+            # If no session exists, create one; a concurrent insert wins the conflict
+            row = await conn.fetchrow(
+                '''
+                INSERT INTO sessions (channel_id, session_id) VALUES ($1, $2)
+                ON CONFLICT (channel_id) DO NOTHING
+                RETURNING session_id
+                ''',
+                channel_id, str(uuid.uuid4())
             )
-            return session_id
+            if row is None:
+                row = await conn.fetchrow(
+                    'SELECT session_id FROM sessions WHERE channel_id = $1',
+                    channel_id
+                )
+            return str(row['session_id'])
 
     async def close(self):
-        await self.pool.close()
+        await release_pg_pool(self.pool)
 
 session_storage = PostgresSessionStorage()
 
 @bot.event
 async def on_ready():
-    await session_storage.initialize()
+    global shared_state
+    # on_ready fires again after every reconnect; only set up shared resources once
+    if session_storage.pool is None:
+        await session_storage.initialize()
+        await memory_writer.start()
+        await llm_gateway.start()
+        summary_tree.store = PostgresSummaryNodeStore(session_storage.pool)
+        await summary_tree.store.initialize()
+        summary_scheduler.store = PostgresWatermarkStore(session_storage.pool)
+        await summary_scheduler.start()
+        if SHARED_STATE_BACKEND == "postgres":
+            shared_state = PostgresSharedState(session_storage.pool)
+            await shared_state.initialize()
+        # RATE_LIMIT_BACKEND picks whether the limits are shared with other processes
+        await start_rate_limiter(
+            host=PG_HOST,
+            port=PG_PORT,
+            user=PG_USER,
+            password=PG_PASSWORD,
+            database=PG_DATABASE
+        )
+        if METRICS_PORT:
+            await metrics_server.start()
+        await tracer.start()
     print(f'{bot.user} has connected to Discord!')
 
 async def get_channel_session_id(channel_id):
-    return await session_storage.get_session_id(channel_id)
+    return await session_storage.get_session_id(int(channel_id))
 
 @bot.event
 async def on_message(message):
     if message.author == bot.user:
         return
 
+    # One trace per inbound message; every stage below it opens a child span
+    with tracing.span("discord.message", tracing.KIND_SERVER, {
+        "platform": "discord",
+        "messaging.message.id": message.id,
+        "messaging.channel.id": message.channel.id
+    }):
+        await handle_message(message)
+
+
+async def handle_message(message):
+    metrics.MESSAGES_TOTAL.labels("discord").inc()
     channel_id = message.channel.id
     content = message.content
-    session_id = f"discord_chat_{await get_channel_session_id(channel_id)}"
+    with metrics.stage("discord", "session_lookup"), tracing.span("session_lookup"):
+        session_id = f"discord_chat_{await get_channel_session_id(channel_id)}"
+    tracing.set_attribute("session.id", session_id)
 
     # Check if the message is a command starting with '/'
     is_slash_command = content.startswith('/')
@@ -223,69 +380,73 @@ async def on_message(message):
     # Check if the message is a greeting
     is_greeting = bool(GREETING_PATTERN.search(content))
 
+    is_mention = bot.user.mentioned_in(message) or content.lower().startswith('bot,')
+    if not is_mention:
+        # The conversation moved on, so earlier answers may be stale
+        response_cache.invalidate(session_id)
+
     try:
-        memory = Memory(
-            messages=[Message(role="user", content=f"{message.author.name}: {content}")],
-            metadata={"session_id": session_id}
-        )
-        zep_client.memory.add_memory(session_id, memory)
+        with tracing.span("memory_enqueue"):
+            user_message = Message(role="user", content=f"{message.author.name}: {content}")
+            await memory_writer.add(session_id, user_message, metadata={"session_id": session_id})
+            search_index.add(session_id, "user", user_message.content, user_message.uuid)
         # print(f"Message saved: {content}")
 
-        # Increment the message counter for this session
-        if session_id not in message_counters:
-            message_counters[session_id] = 0
-        message_counters[session_id] += 1
-
+        # Count toward the next background summary, but not slash commands or greetings
+        if not is_slash_command and not is_greeting:
+            summary_scheduler.record(session_id, content)
 
-        # Check if we need to create a summary, but not for slash commands or greetings
-        if not is_slash_command and not is_greeting and message_counters[session_id]>=10:
-            await check_and_summarize(session_id)
-            message_counters[session_id] = 0
-            
     except Exception as e:
+        metrics.ERRORS_TOTAL.labels("discord", "memory_write").inc()
         print(f"Error saving message or summarizing: {e}")
 
-    if bot.user.mentioned_in(message) or message.content.lower().startswith('bot,'):
+    if is_mention:
+        # Every mention is a paid completion: charge the user, the channel and the global budget
+        with tracing.span("rate_limit") as span:
+            decision = await rate_limiter.hit(
+                (USER_MESSAGE_LIMIT, f"discord:user:{message.author.id}"),
+                (CHANNEL_MESSAGE_LIMIT, f"discord:channel:{channel_id}"),
+                (LLM_REQUEST_LIMIT, LLM_BUDGET_KEY)
+            )
+            span.set_attribute("rate_limit.allowed", decision.allowed)
+        is_mention = decision.allowed
+        if not decision.allowed:
+            metrics.MENTIONS_TOTAL.labels("discord", "rate_limited").inc()
+            await message.channel.send(RATE_LIMIT_RESPONSE)
+
+    if is_mention:
         clean_content = message.content.replace(f'<@{bot.user.id}>', '').strip()
         clean_content = clean_content[4:] if clean_content.lower().startswith('bot,') else clean_content
 
-        thinking_message = await message.channel.send("Thinking...")
+        with tracing.span("platform_send"):
+            thinking_message = await message.channel.send("Thinking...")
 
         async with message.channel.typing():
-            response = await generate_response(channel_id, clean_content)
-
-            chunks = [response[i:i+2000] for i in range(0, len(response), 2000)]
-
-            await thinking_message.edit(content=chunks[0])
-
-            for chunk in chunks[1:]:
-                await message.channel.send(chunk)
-
-        try:
-            memory = Memory(
-                messages=[Message(role="assistant", content=response)],
-                metadata={"session_id": session_id}
-            )
-            zep_client.memory.add_memory(session_id, memory)
-            # print(f"Bot response saved: {response}")
-        except Exception as e:
-            print(f"Error saving bot response: {e}")
+            # Mentions in one channel are answered in order, several at a time when they pile up
+            try:
+                with metrics.MENTION_SECONDS.labels("discord").time(), tracing.span("mention"):
+                    await mention_scheduler.submit(session_id, (message.author.name, clean_content, thinking_message))
+                metrics.MENTIONS_TOTAL.labels("discord", "answered").inc()
+            except Exception as e:
+                metrics.MENTIONS_TOTAL.labels("discord", "failed").inc()
+                print(f"Error answering mention in session {session_id}: {e}")
+                await thinking_message.edit(content=FALLBACK_RESPONSE)
 
     # This line is crucial for processing commands
     await bot.process_commands(message)
 
 
-async def generate_response(channel_id, user_message):
-    session_id = f"discord_chat_{await get_channel_session_id(channel_id)}"
-
-    async with ZepClient(ZEP_API_URL, ZEP_API_KEY) as client:
-        try:
-            historical_messages = await zep_client.message.aget_session_messages(
-                session_id)
-            # print(len(historical_messages))
-        except Exception as e:
-            print(f"Error retrieving historical messages: {e}")
-            historical_messages = []
+async def build_response_prompt(session_id, user_message):
+    try:
+        with metrics.stage("discord", "history_fetch"), tracing.span("history_fetch"):
+            # Make sure messages still sitting in the write-behind queue are visible
+            await memory_writer.flush(session_id)
+            window = await context_assembler.build(session_id)
+        historical_messages = window.chat_messages()
+    except Exception as e:
+        metrics.ERRORS_TOTAL.labels("discord", "history_fetch").inc()
+        print(f"Error retrieving historical messages: {e}")
+        historical_messages = []
 
     system_message = {
         "role":
@@ -297,10 +458,37 @@ async def generate_response(channel_id, user_message):
     messages = [system_message]
     user_chat_logs = []
 
+    # Older history, at the most detail that fits the summary budget
+    try:
+        with metrics.stage("discord", "summary_select"), tracing.span("summary_select"):
+            summary_nodes = await summary_tree.select(session_id, SUMMARY_CONTEXT_TOKENS)
+    except Exception as e:
+        metrics.ERRORS_TOTAL.labels("discord", "summary_select").inc()
+        print(f"Error selecting summaries: {e}")
+        summary_nodes = []
+    if summary_nodes:
+        messages.append({
+            "role": "system",
+            "content": "Summary of earlier conversation:\n" + summary_tree.format(summary_nodes)
+        })
+
+    # Older messages relevant to the question
+    try:
+        recent = {memory["content"] for memory in historical_messages}
+        with metrics.stage("discord", "ranking"), tracing.span("ranking"):
+            results = await get_relevant_context(session_id, user_message, RELEVANT_CONTEXT_TOKENS)
+        relevant = [r.message["content"] for r in results if r.message["content"] not in recent]
+    except Exception as e:
+        metrics.ERRORS_TOTAL.labels("discord", "ranking").inc()
+        print(f"Error retrieving relevant context: {e}")
+        relevant = []
+    if relevant:
+        messages.append({"role": "system", "content": "Relevant earlier messages:\n" + "\n".join(relevant)})
+
     for memory in historical_messages:
-        messages.append({"role": memory.role, "content": memory.content})
-        if memory.role == "user":
-            content = extract_message_content(memory.content)
+        messages.append(memory)
+        if memory["role"] == "user":
+            content = extract_message_content(memory["content"])
             if is_valid_message(content):
                 user_chat_logs.append(content)
 
@@ -308,20 +496,36 @@ async def generate_response(channel_id, user_message):
     messages.append(current_user_message)
 
     full_prompt = " ".join(user_chat_logs)
+    return messages, full_prompt
+
+
+async def remember_prompt(user_message, full_prompt):
+    await shared_state.push_recent(RECENT_PROMPTS_KEY, {
+        "question": user_message,
+        "prompt_summary": full_prompt
+    }, RECENT_PROMPTS_LIMIT)
+
+
+async def remember_response(session_id, ai_response):
+    message = Message(role="assistant", content=ai_response)
+    await memory_writer.add(session_id, message, metadata={"session_id": session_id})
+    search_index.add(session_id, "assistant", ai_response, message.uuid)
+
+
+async def generate_response(session_id, user_message):
+    cached = await response_cache.lookup(session_id, user_message)
+    if cached.answer is not None:
+        await remember_response(session_id, cached.answer)
+        return cached.answer
+
+    messages, full_prompt = await build_response_prompt(session_id, user_message)
 
     try:
-        response = openai.ChatCompletion.create(model="gpt-4o-mini",
-                                                messages=messages)
-        ai_response = response.choices[0].message['content']
+        ai_response = await llm_gateway.chat_text(RESPONSE_GENERATION_MODEL, messages)
 
-        recent_prompts.append({
-            "question": user_message,
-            "prompt_summary": full_prompt
-        })
-        if len(recent_prompts) > 5:
-            recent_prompts.pop(0)
+        await remember_prompt(user_message, full_prompt)
 
-        if len(ai_response) > 2000:
+        if len(ai_response) > DISCORD_MESSAGE_LIMIT:
             summarize_messages = [{
                 "role":
                 "system",
@@ -331,177 +535,189 @@ async def generate_response(channel_id, user_message):
                 "role": "user",
                 "content": ai_response
             }]
-            summary_response = openai.ChatCompletion.create(
-                model="gpt-4o-mini", messages=summarize_messages)
-            ai_response = summary_response.choices[0].message['content']
+            ai_response = await llm_gateway.chat_text(SUMMARIZATION_MODEL, summarize_messages)
 
-        memory = Memory(
-            messages=[Message(role="assistant", content=ai_response)])
-        zep_client.memory.add_memory(session_id, memory)
+        response_cache.store(session_id, cached, ai_response)
+        await remember_response(session_id, ai_response)
 
         return ai_response
     except Exception as e:
         return f"An error occurred: {str(e)}"
 
 
+async def stream_response(session_id, user_message, thinking_message):
+    async def edit(discord_message, text):
+        with metrics.stage("discord", "platform_send"), tracing.span("platform_send"):
+            await discord_message.edit(content=text)
 
+    editor = StreamingMessageEditor(
+        thinking_message,
+        edit=edit,
+        send=thinking_message.channel.send,
+        max_length=DISCORD_MESSAGE_LIMIT,
+        min_interval=STREAM_EDIT_INTERVAL
+    )
 
-async def check_and_summarize(session_id):
-    messages = await zep_client.message.aget_session_messages(session_id)
-    
-    if not messages:
-        print(f"No messages found for session {session_id}")
+    cached = await response_cache.lookup(session_id, user_message)
+    if cached.answer is not None:
+        await editor.feed(cached.answer)
+        await editor.finish()
+        await remember_response(session_id, cached.answer)
         return
-    
-    last_summary = await get_last_summary(session_id)
 
-    if last_summary == "This is your first message in this channel":
-        # If there's no previous summary, treat all messages as new
-        messages_since_last_summary = messages
-        summary_age = timedelta(hours=SUMMARY_MAX_AGE_HOURS + 1)
-    else:
-        messages_since_last_summary = [m for m in messages if m.created_at > last_summary.created_at]
-        current_time = datetime.now()
-        summary_age = current_time - last_summary.created_at
+    messages, full_prompt = await build_response_prompt(session_id, user_message)
 
-    if not messages_since_last_summary:
-        print(f"No new messages since last summary for session {session_id}")
+    try:
+        ai_response = (await editor.consume(llm_gateway.stream_chat(RESPONSE_GENERATION_MODEL, messages))).strip()
+    except Exception as e:
+        metrics.ERRORS_TOTAL.labels("discord", "llm").inc()
+        print(f"Error streaming response for session {session_id}: {e}")
+        await editor.finish()
+        if not editor.text:
+            await thinking_message.edit(content=FALLBACK_RESPONSE)
         return
 
-    if (len(messages_since_last_summary) >= MAX_MESSAGES_BEFORE_SUMMARY or
-        sum(len(m.content) for m in messages_since_last_summary) >= MAX_CHARS_BEFORE_SUMMARY or
-        summary_age.total_seconds() / 3600 >= SUMMARY_MAX_AGE_HOURS):
-        await create_summary(session_id, messages_since_last_summary)
+    await remember_prompt(user_message, full_prompt)
+
+    response_cache.store(session_id, cached, ai_response)
+    await remember_response(session_id, ai_response)
+
+
+
+
+async def send_reply(thinking_message, response):
+    chunks = [response[i:i+DISCORD_MESSAGE_LIMIT] for i in range(0, len(response), DISCORD_MESSAGE_LIMIT)]
+
+    with metrics.stage("discord", "platform_send"), tracing.span("platform_send"):
+        await thinking_message.edit(content=chunks[0])
+
+        for chunk in chunks[1:]:
+            await thinking_message.channel.send(chunk)
+
 
+async def answer_mentions(session_id, mentions):
+    """Answer (author, question, thinking_message) mentions that arrived together in one channel.
 
+    Returns one result per mention: None, or the exception that kept it from being answered.
+    """
+    if len(mentions) == 1:
+        _, question, thinking_message = mentions[0]
+        if STREAM_RESPONSES:
+            return [await settle(stream_response(session_id, question, thinking_message))]
+        return [await settle(answer_mention(session_id, question, thinking_message))]
 
-async def get_last_summary(session_id):
+    results = [None] * len(mentions)
+    pending = []
+    for index, (author, question, thinking_message) in enumerate(mentions):
+        try:
+            cached = await response_cache.lookup(session_id, question)
+            if cached.answer is not None:
+                await remember_response(session_id, cached.answer)
+                await send_reply(thinking_message, cached.answer)
+            else:
+                pending.append((index, author, question, thinking_message, cached))
+        except Exception as e:
+            results[index] = e
+    if len(pending) < 2:
+        for index, author, question, thinking_message, _ in pending:
+            results[index], = await answer_mentions(session_id, [(author, question, thinking_message)])
+        return results
+
+    batched_question = format_batched_questions([f"{author}: {question}" for _, author, question, _, _ in pending])
     try:
-        searchPayload = MemorySearchPayload(
-            search_scope="summary",
-            text="latest summary"  # Add a non-empty search text
-        )
-        summaries = await zep_client.memory.search_memory(session_id, searchPayload, limit=1)
-        return summaries[0] if summaries else "hi"
+        messages, full_prompt = await build_response_prompt(session_id, batched_question)
+        answers = split_batched_answers(await llm_gateway.chat_text(RESPONSE_GENERATION_MODEL, messages), len(pending))
     except Exception as e:
-        # print(f"Error getting last summary for session {session_id}: {str(e)}")
-        return "This is your first message in this channel"
+        print(f"Error answering {len(pending)} mentions together in session {session_id}: {e}")
+        answers = None
 
+    if answers is None:
+        # The combined answer could not be split up; answer the questions one by one instead
+        for index, _, question, thinking_message, _ in pending:
+            results[index] = await settle(answer_mention(session_id, question, thinking_message))
+        return results
 
-async def create_summary(session_id, messages):
-    if not messages:
-        print(f"No messages to summarize for session {session_id}")
-        return
+    for (index, _, question, thinking_message, cached), answer in zip(pending, answers):
+        response_cache.store(session_id, cached, answer)
+        results[index] = await settle(deliver_answer(session_id, thinking_message, answer))
 
-    combined_text = "\n".join([f"{msg.role}: {msg.content}" for msg in messages])
+    try:
+        await remember_prompt(batched_question, full_prompt)
+    except Exception as e:
+        print(f"Error remembering batched prompt for session {session_id}: {e}")
+    return results
 
-    if not combined_text.strip():
-        print(f"Empty combined text for session {session_id}")
-        return
 
+async def answer_mention(session_id, question, thinking_message):
+    await send_reply(thinking_message, await generate_response(session_id, question))
+
+
+async def deliver_answer(session_id, thinking_message, answer):
+    await remember_response(session_id, answer)
+    await send_reply(thinking_message, answer)
+
+
+async def summarize_text(text, previous=None):
     summary_prompt = f"Summarize the following conversation in {SUMMARY_WORD_LIMIT} words or less. "
     summary_prompt += f"Style: {SUMMARY_STYLE}. Focus: {SUMMARY_FOCUS}. "
     if SUMMARY_SENTIMENT:
         summary_prompt += "Include overall sentiment. "
     if SUMMARY_ENTITIES:
         summary_prompt += "Highlight key entities or names. "
-    summary_prompt += "Conversation:\n" + combined_text
+    if previous:
+        summary_prompt += "Fold it into the existing summary, keeping what still matters.\n"
+        summary_prompt += "Existing summary:\n" + previous + "\n\n"
+    summary_prompt += "Conversation:\n" + text
+
+    return await llm_gateway.chat_text(
+        SUMMARIZATION_MODEL,
+        [
+            {"role": "system", "content": "You are a summarization assistant."},
+            {"role": "user", "content": summary_prompt}
+        ]
+    )
 
-    try:
-        response = openai.ChatCompletion.create(
-            model=SUMMARIZATION_MODEL,
-            messages=[
-                {"role": "system", "content": "You are a summarization assistant."},
-                {"role": "user", "content": summary_prompt}
-            ]
-        )
-        summary = response.choices[0].message['content']
 
-        summary_memory = Memory(
-            messages=[Message(role="system", content=f"Summary: {summary}")],
-            metadata={"type": "summary", "start_time": messages[0].created_at, "end_time": messages[-1].created_at}
-        )
-        # Use the synchronous version of add_memory
-        zep_client.memory.add_memory(session_id, summary_memory)
-        print(f"Summary created and added for session {session_id}")
+summary_tree = SummaryTree(
+    summarize_text,
+    store=None,  # Postgres node store, attached once the pool exists in on_ready
+    model=SUMMARIZATION_MODEL,
+    chunk_size=SUMMARY_CHUNK_SIZE,
+    fanout=SUMMARY_FANOUT
+)
+
+
+async def create_summary(session_id, messages):
+    if not messages:
+        print(f"No messages to summarize for session {session_id}")
+        return 0
+
+    try:
+        # Only the new messages and the newest branch of the tree are sent to the LLM
+        summarized = await summary_tree.extend(session_id, messages)
+        print(f"Summary tree updated for session {session_id} ({summarized} messages)")
+        return summarized
     except Exception as e:
         print(f"Error creating summary for session {session_id}: {str(e)}")
+        return 0
 
 
 
 async def get_relevant_context(session_id, query, max_tokens):
-    searchPayload = MemorySearchPayload(
-        text=query,
-        search_scope="summary"
-    )
-    results = await zep_client.memory.search_memory(session_id, searchPayload, limit=SEARCH_RESULT_LIMIT)
-
-    summaries = [r for r in results if r.metadata.get('type') == 'summary']
-    messages = [r for r in results if r.metadata.get('type') != 'summary']
-
-    query_embedding = await zep_client.memory.acreate_embedding(query)
-    summary_embeddings = [await zep_client.memory.acreate_embedding(s.content) for s in summaries]
-    message_embeddings = [await zep_client.memory.acreate_embedding(m.content) for m in messages]
+    results = await memory_backend.search(session_id, query, limit=SEARCH_RESULT_LIMIT, mmr_lambda=MMR_LAMBDA,
+                                          threshold=RELEVANCE_THRESHOLD)
 
     selected_results = []
     current_tokens = 0
-    summary_context_limit = int(max_tokens * SUMMARY_CONTEXT_PERCENTAGE)
-
-    ranked_summaries = rank_by_relevance(query_embedding, summary_embeddings, summaries)
-
-    for i, (summary, summary_relevance) in enumerate(ranked_summaries):
-        if summary_relevance < RELEVANCE_THRESHOLD:
+    for result in results:
+        tokens = len(result.message.get("content", "").split())
+        if current_tokens + tokens > max_tokens:
             break
-
-        summary_start = summary.metadata['start_time']
-        summary_end = summary.metadata['end_time']
-        relevant_messages = [m for m in messages if summary_start <= m.created_at <= summary_end]
-
-        ranked_messages = rank_by_relevance(query_embedding,
-                                            [message_embeddings[messages.index(m)] for m in relevant_messages],
-                                            relevant_messages)
-
-        percentage = max(MIN_SUMMARY_PERCENTAGE, INITIAL_SUMMARY_PERCENTAGE - (i * SUMMARY_PERCENTAGE_REDUCTION))
-        messages_to_include = int(len(ranked_messages) * percentage)
-
-        for message, message_relevance in ranked_messages[:messages_to_include]:
-            if message_relevance < RELEVANCE_THRESHOLD:
-                break
-            if current_tokens + len(message.content.split()) <= summary_context_limit:
-                selected_results.append(message)
-                current_tokens += len(message.content.split())
-            else:
-                break
-
-        if current_tokens >= summary_context_limit:
-            break
-
-    remaining_messages = [m for m in messages if m not in selected_results]
-    ranked_remaining = rank_by_relevance(query_embedding,
-                                         [message_embeddings[messages.index(m)] for m in remaining_messages],
-                                         remaining_messages)
-    for message, relevance_score in ranked_remaining:
-            if relevance_score < RELEVANCE_THRESHOLD:
-                break
-            if current_tokens + len(message.content.split()) <= max_tokens:
-                selected_results.append(message)
-                current_tokens += len(message.content.split())
-            else:
-                break
+        selected_results.append(result)
+        current_tokens += tokens
 
     return selected_results
 
-def rank_by_relevance(query_embedding, candidate_embeddings, candidates):
-    similarities = [cosine_similarity(query_embedding, emb) for emb in candidate_embeddings]
-    ranked = sorted(zip(candidates, similarities), key=lambda x: x[1], reverse=True)
-    return ranked
-
-def cosine_similarity(v1, v2):
-    if VECTOR_NORMALIZATION:
-        v1 = v1 / np.linalg.norm(v1)
-        v2 = v2 / np.linalg.norm(v2)
-    return np.dot(v1, v2)
-
 # Error handling decorator
 def handle_errors(func):
     async def wrapper(*args, **kwargs):
@@ -518,9 +734,24 @@ def handle_errors(func):
 
 # Apply error handling to key functions
 generate_response = handle_errors(generate_response)
-check_and_summarize = handle_errors(check_and_summarize)
 create_summary = handle_errors(create_summary)
 
+mention_scheduler = SessionScheduler(answer_mentions, max_batch=MENTION_BATCH_SIZE)
+summary_scheduler = SummaryScheduler(
+    zep_client,
+    memory_writer,
+    create_summary,
+    store=None,  # Postgres watermark store, attached once the pool exists in on_ready
+    workers=SUMMARY_WORKERS,
+    debounce=SUMMARY_DEBOUNCE,
+    max_delay=SUMMARY_MAX_DELAY,
+    max_messages=MAX_MESSAGES_BEFORE_SUMMARY,
+    max_chars=MAX_CHARS_BEFORE_SUMMARY,
+    max_age_hours=SUMMARY_MAX_AGE_HOURS
+)
+metrics.export_stats("discord", "mention_scheduler", mention_scheduler.stats)
+metrics.export_stats("discord", "summary_scheduler", summary_scheduler.stats)
+
 def extract_message_content(message):
     # Remove username from the start of the message
     return re.sub(r'^.*?: ', '', message).strip()
@@ -541,46 +772,37 @@ def is_valid_message(message):
     return True
 
 
-# Rate limiting
+# Rate limiting; goes below @bot.command so the registered callback is the limited one
 def rate_limit(func):
-    cooldowns = {}
+    @functools.wraps(func)
     async def wrapper(ctx, *args, **kwargs):
-        if ctx.author.id in cooldowns:
-            remaining = COOLDOWN_DURATION - (datetime.now() - cooldowns[ctx.author.id]).total_seconds()
-            if remaining > 0:
-                await ctx.send(RATE_LIMIT_RESPONSE)
-                return
-        cooldowns[ctx.author.id] = datetime.now()
+        decision = await rate_limiter.hit(
+            (COMMAND_COOLDOWN, f"discord:cooldown:{ctx.author.id}"),
+            (USER_COMMAND_LIMIT, f"discord:commands:{ctx.author.id}")
+        )
+        if not decision.allowed:
+            await ctx.send(RATE_LIMIT_RESPONSE)
+            return
         return await func(ctx, *args, **kwargs)
     return wrapper
 
-# Apply rate limiting to commands
-
-
-
 
 @bot.command(name='search')
-async def search(ctx, keyword: str):
+@rate_limit
+async def search(ctx, *, keyword: str):
     channel_id = str(ctx.channel.id)
     session_id = f"discord_chat_{await get_channel_session_id(channel_id)}"
 
-    async with ZepClient(ZEP_API_URL, ZEP_API_KEY) as client:
-        try:
-            historical_messages = await client.message.aget_session_messages(
-                session_id)
-        except Exception as e:
-            await ctx.send(f"Error retrieving historical messages: {e}")
-            return
+    try:
+        hits = await search_index.search(session_id, keyword, limit=10, highlight=highlight_keyword)
+    except Exception as e:
+        await ctx.send(f"Error retrieving historical messages: {e}")
+        return
 
-    search_results = []
-    for msg in historical_messages:
-        if keyword.lower() in msg.content.lower():
-            highlighted_content = highlight_keyword(msg.content, keyword)
-            search_results.append(f"**{msg.role}**: {highlighted_content}")
+    search_results = [f"**{hit.role}**: {hit.snippet}" for hit in hits]
 
     if search_results:
-        response = f"Search results for '{keyword}':\n\n" + "\n\n".join(
-            search_results[-10:])
+        response = f"Search results for '{keyword}':\n\n" + "\n\n".join(search_results)
         if len(response) > 2000:
             response = response[:1997] + "..."
         await ctx.send(response)
@@ -589,7 +811,9 @@ async def search(ctx, keyword: str):
 
 
 @bot.command(name='prompt')
+@rate_limit
 async def prompt(ctx):
+    recent_prompts = await shared_state.recent(RECENT_PROMPTS_KEY, RECENT_PROMPTS_LIMIT)
     if not recent_prompts:
         await ctx.send("No recent prompts available.")
         return
@@ -605,14 +829,21 @@ async def prompt(ctx):
 
 
 
-
-search = rate_limit(search)
-prompt = rate_limit(prompt)
-
-
 @bot.event
 async def on_shutdown():
+    if session_storage.pool is None:
+        return
+    await summary_scheduler.close()
+    await memory_writer.close()
+    await llm_gateway.close()
+    await memory_backend.close()
+    await stop_rate_limiter()
     await session_storage.close()
+    session_storage.pool = None
+    embedding_cache.close()
+    if METRICS_PORT:
+        await metrics_server.close()
+    await tracer.close()
 
 # Run the bot
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Two-tier embedding cache keyed by (model, sha256(text)).
+# The memory tier is an LRU bounded by a byte budget; the optional SQLite tier
+# keeps float32 vectors on disk so embeddings survive a restart. Entries in
+# both tiers expire after `ttl` seconds. SQLite reads and writes run in a
+# worker thread (asyncio.to_thread), batched per call, so a disk lookup never
+# blocks the event loop.
+
+SQLITE_MAX_PARAMS = 900  # Keys per SELECT, under SQLite's default host parameter limit
+
+
+class EmbeddingCache:
+    def __init__(self, ttl=3600, max_bytes=64 * 1024 * 1024, path=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.path = path
+
+        self._entries = OrderedDict()  # key -> (vector, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()  # memory tier and counters
+        self._db_lock = threading.Lock()  # the SQLite connection
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    vector BLOB NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            self._db.execute('DELETE FROM embeddings WHERE expires_at <= ?', (time.time(),))
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model, text):
+        return f"{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    async def get(self, model, text):
+        return (await self.get_many(model, [text]))[0]
+
+    async def put(self, model, text, vector):
+        await self.put_many(model, [text], [vector])
+
+    async def get_many(self, model, texts):
+        """Return cached vectors for `texts`, with None in place of misses."""
+        now = time.time()
+        keys = [self.make_key(model, text) for text in texts]
+        found = [None] * len(keys)
+        disk_lookups = []
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                entry = self._entries.get(key)
+                if entry is not None:
+                    vector, expires_at = entry
+                    if expires_at > now:
+                        self._entries.move_to_end(key)
+                        found[i] = vector
+                        self.hits += 1
+                        continue
+                    self._remove(key)
+                    self.expirations += 1
+                disk_lookups.append(i)
+
+        if self._db is not None and disk_lookups:
+            rows = await asyncio.to_thread(self._read_rows, [keys[i] for i in disk_lookups], now)
+            with self._lock:
+                for i in disk_lookups:
+                    row = rows.get(keys[i])
+                    if row is not None:
+                        vector = np.frombuffer(row[0], dtype=np.float32)
+                        self._insert(keys[i], vector, row[1])
+                        found[i] = vector
+                        self.hits += 1
+                        self.disk_hits += 1
+
+        with self._lock:
+            self.misses += sum(1 for vector in found if vector is None)
+
+        return found
+
+    async def put_many(self, model, texts, vectors):
+        expires_at = time.time() + self.ttl
+        rows = []
+
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = self.make_key(model, text)
+                vector = np.asarray(vector, dtype=np.float32)
+                self._insert(key, vector, expires_at)
+                rows.append((key, vector.tobytes(), expires_at))
+
+        if self._db is not None and rows:
+            await asyncio.to_thread(self._write_rows, rows)
+
+    async def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]
+            for key in expired:
+                self._remove(key)
+            self.expirations += len(expired)
+        if self._db is not None:
+            await asyncio.to_thread(self._delete_expired, now)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # SQLite tier; these run in a worker thread, never on the event loop
+    def _read_rows(self, keys, now):
+        rows = {}
+        with self._db_lock:
+            if self._db is None:
+                return rows
+            for start in range(0, len(keys), SQLITE_MAX_PARAMS):
+                chunk = keys[start:start + SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                for key, vector, expires_at in self._db.execute(
+                    f'SELECT key, vector, expires_at FROM embeddings WHERE key IN ({placeholders}) AND expires_at > ?',
+                    (*chunk, now)
+                ):
+                    rows[key] = (vector, expires_at)
+        return rows
+
+    def _write_rows(self, rows):
+        with self._db_lock:
+            if self._db is None:
+                return
+            self._db.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, vector, expires_at) VALUES (?, ?, ?)',
+                rows
+            )
+            self._db.commit()
+
+    def _delete_expired(self, now):
+        with self._db_lock:
+            if self._db is None:
+                return
+            self._db.execute('DELETE FROM embeddings WHERE expires_at <= ?', (now,))
+            self._db.commit()
+
+    # Callers must hold self._lock
+    def _insert(self, key, vector, expires_at):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (vector, expires_at)
+        self._bytes += vector.nbytes
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        vector, _ = self._entries.pop(key)
+        self._bytes -= vector.nbytes
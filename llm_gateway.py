@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import aiohttp
+import openai
+
+import metrics
+import tracing
+from token_budget import MESSAGE_TOKEN_OVERHEAD, count_tokens
+
+
+logger = logging.getLogger(__name__)
+
+
+# Shared async gateway for chat completions.
+# All bots in a process go through one pooled aiohttp session with a global
+# concurrency limit, a per-model limit, and token buckets that pace requests
+# and tokens under the provider's RPM/TPM limits. Identical prompts already in
+# flight are answered by the same request instead of being sent twice.
+# Every request, streamed or not, has to finish within `timeout` seconds, and
+# a stream that goes `stream_idle_timeout` seconds without a chunk is given up
+# on, so a stalled connection cannot hold a concurrency slot.
+
+DEFAULT_COMPLETION_TOKENS = 500  # Completion tokens assumed for pacing when max_tokens is not given
+
+LLM_SECONDS = metrics.histogram("llm_request_seconds", "Chat completion latency up to the full response or last delta",
+                                ("model", "mode"))
+LLM_WAIT_SECONDS = metrics.histogram("llm_queue_seconds", "Time a completion waited for rate and concurrency budget",
+                                     ("model",))
+LLM_ERRORS = metrics.counter("llm_errors_total", "Chat completions that failed or timed out", ("model", "mode"))
+LLM_TOKENS = metrics.counter("llm_tokens_total", "Tokens reported by non-streamed completions", ("model", "kind"))
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        # Waiters queue on the lock, so capacity is handed out in arrival order
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, amount):
+        """Return (positive) or charge (negative) tokens after the real cost is known."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class LLMGateway:
+    def __init__(self, max_concurrency=16, model_concurrency=None, default_model_concurrency=8,
+                 requests_per_minute=3500, tokens_per_minute=200000, timeout=60, stream_idle_timeout=15):
+        self.max_concurrency = max_concurrency
+        self.model_concurrency = model_concurrency or {}
+        self.default_model_concurrency = default_model_concurrency
+        self.timeout = timeout
+        self.stream_idle_timeout = stream_idle_timeout
+
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._global_limit = asyncio.Semaphore(max_concurrency)
+        self._model_limits = {}
+        self._inflight = {}
+        self._session = None
+        self._users = 0
+
+        self.request_count = 0
+        self.coalesced_count = 0
+        self.tokens_used = 0
+
+    async def chat(self, model, messages, **kwargs):
+        """Return the ChatCompletion for `messages`, sharing identical in-flight requests."""
+        key = self._request_key(model, messages, kwargs)
+        with tracing.span("llm.chat", tracing.KIND_CLIENT, {"llm.model": model}, require_parent=True) as span:
+            task = self._inflight.get(key)
+            if task is None:
+                # The request task starts inside this span, so its own span lands under it
+                task = asyncio.ensure_future(self._complete(model, messages, kwargs))
+                self._inflight[key] = task
+                task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            else:
+                self.coalesced_count += 1
+                span.set_attribute("llm.coalesced", True)
+            return await asyncio.shield(task)
+
+    async def chat_text(self, model, messages, **kwargs):
+        response = await self.chat(model, messages, **kwargs)
+        return response.choices[0].message['content']
+
+    async def stream_chat(self, model, messages, **kwargs):
+        """Yield content deltas of a streamed completion; streams are never coalesced."""
+        # Not made current: the consumer runs its own spans between deltas
+        span = tracing.start_span("llm.stream", tracing.KIND_CLIENT, {"llm.model": model}, require_parent=True)
+        deltas = 0
+        try:
+            async with self._slot(model, messages, kwargs.get("max_tokens")):
+                span.add_event("llm.slot_acquired")
+                session_token = openai.aiosession.set(await self._get_session())
+                started = time.perf_counter()
+                deadline = time.monotonic() + self.timeout
+                response = None
+                try:
+                    response = await asyncio.wait_for(
+                        openai.ChatCompletion.acreate(model=model, messages=messages, stream=True, **kwargs),
+                        self.timeout
+                    )
+                    while True:
+                        # Bounded per chunk and overall, so a stalled stream gives its slot back
+                        wait = min(self.stream_idle_timeout, deadline - time.monotonic())
+                        try:
+                            chunk = await asyncio.wait_for(response.__anext__(), max(0.0, wait))
+                        except StopAsyncIteration:
+                            break
+                        delta = chunk["choices"][0].get("delta", {}).get("content")
+                        if delta:
+                            if not deltas:
+                                span.add_event("llm.first_delta")
+                            deltas += 1
+                            yield delta
+                except Exception:
+                    LLM_ERRORS.labels(model, "stream").inc()
+                    raise
+                finally:
+                    # Releases the HTTP connection on timeouts, errors and consumers that stop early
+                    if response is not None:
+                        await response.aclose()
+                    try:
+                        openai.aiosession.reset(session_token)
+                    except ValueError:
+                        pass  # Finalized by the loop in another context, which never saw the set
+                LLM_SECONDS.labels(model, "stream").observe(time.perf_counter() - started)
+        except (Exception, asyncio.CancelledError) as e:
+            span.record_exception(e)
+            raise
+        finally:
+            span.set_attribute("llm.deltas", deltas)
+            span.end()
+
+    async def start(self):
+        # Reference counted like MemoryWriteQueue: the session is closed by the last bot to stop
+        self._users += 1
+
+    async def close(self):
+        self._users = max(0, self._users - 1)
+        if self._users > 0:
+            return
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self):
+        return {
+            "requests": self.request_count,
+            "coalesced": self.coalesced_count,
+            "tokens_used": self.tokens_used,
+            "in_flight": len(self._inflight),
+        }
+
+    async def _complete(self, model, messages, kwargs):
+        with tracing.span("llm.request", tracing.KIND_CLIENT, {"llm.model": model}) as span:
+            async with self._slot(model, messages, kwargs.get("max_tokens")) as estimate:
+                span.add_event("llm.slot_acquired")
+                session_token = openai.aiosession.set(await self._get_session())
+                try:
+                    with LLM_SECONDS.labels(model, "chat").time():
+                        response = await asyncio.wait_for(
+                            openai.ChatCompletion.acreate(model=model, messages=messages, **kwargs),
+                            self.timeout
+                        )
+                except Exception:
+                    LLM_ERRORS.labels(model, "chat").inc()
+                    raise
+                finally:
+                    openai.aiosession.reset(session_token)
+            usage = response.get("usage") or {}
+            for kind in ("prompt", "completion"):
+                LLM_TOKENS.labels(model, kind).inc(usage.get(f"{kind}_tokens") or 0)
+                span.set_attribute(f"llm.usage.{kind}_tokens", usage.get(f"{kind}_tokens"))
+        if usage.get("total_tokens"):
+            self.tokens_used += usage["total_tokens"]
+            self.tokens.adjust(estimate - usage["total_tokens"])
+        return response
+
+    @asynccontextmanager
+    async def _slot(self, model, messages, max_tokens):
+        estimate = self._estimate_tokens(model, messages, max_tokens)
+        started = time.perf_counter()
+        await self.requests.acquire(1)
+        await self.tokens.acquire(estimate)
+        async with self._global_limit, self._model_limit(model):
+            LLM_WAIT_SECONDS.labels(model).observe(time.perf_counter() - started)
+            self.request_count += 1
+            yield estimate
+
+    def _model_limit(self, model):
+        if model not in self._model_limits:
+            limit = self.model_concurrency.get(model, self.default_model_concurrency)
+            self._model_limits[model] = asyncio.Semaphore(limit)
+        return self._model_limits[model]
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            )
+        return self._session
+
+    @staticmethod
+    def _estimate_tokens(model, messages, max_tokens):
+        prompt = sum(count_tokens(m.get("content") or "", model) + MESSAGE_TOKEN_OVERHEAD for m in messages)
+        return prompt + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+    @staticmethod
+    def _request_key(model, messages, kwargs):
+        payload = json.dumps([model, messages, kwargs], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
@@ -1,25 +1,247 @@
+import argparse
 import asyncio
-from zep_integration import ZepIntegration
-from discord_bot import DiscordBot
-from telegram_bot import TelegramBot
-from config import *
-
-async def main():
-    # Initialize Zep integration
-    zep_integration = ZepIntegration(ZEP_API_URL, ZEP_API_KEY, PG_CONFIG)
-    await zep_integration.initialize()
-
-    # Initialize Discord bot
-    discord_bot = DiscordBot(zep_integration, OPENAI_API_KEY, DISCORD_BOT_TOKEN)
-    
-    # Initialize Telegram bot
-    telegram_bot = TelegramBot(zep_integration, OPENAI_API_KEY, TELEGRAM_BOT_TOKEN)
-
-    # Start both bots concurrently
-    await asyncio.gather(
-        discord_bot.start(),
-        telegram_bot.start()
+import importlib
+import logging
+import multiprocessing
+import os
+import signal
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PLATFORMS = ["discord", "telegram", "slack", "whatsapp"]
+
+
+# Runs the platform bots as adapters inside one asyncio event loop.
+# Every adapter imports its platform module lazily (so a process only needs
+# the credentials of the platforms it hosts) and can be started and stopped
+# on its own. Because they share a process, the modules resolve the same Zep
+# client, write-behind queue, embedding cache, Postgres pool and LLM gateway
+# through shared_resources, so OpenAI concurrency and RPM/TPM budgets are
+# enforced once for every bot in the process.
+
+
+class PlatformAdapter:
+    name = None
+    module_name = None
+
+    def __init__(self):
+        self.module = None
+        self.task = None
+
+    async def start(self):
+        self.module = importlib.import_module(self.module_name)
+        await self.setup()
+        self.task = asyncio.create_task(self.run(), name=f"{self.name}-adapter")
+
+    async def stop(self):
+        await self.teardown()
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+
+    async def setup(self):
+        pass
+
+    async def run(self):
+        # Adapters whose platform runs in background tasks just park here until stopped
+        await asyncio.Event().wait()
+
+    async def teardown(self):
+        pass
+
+
+class DiscordAdapter(PlatformAdapter):
+    name = "discord"
+    module_name = "discord_func"
+
+    async def run(self):
+        await self.module.bot.start(os.getenv("DISCORD_BOT_TOKEN"))
+
+    async def teardown(self):
+        await self.module.bot.close()
+        await self.module.on_shutdown()
+
+
+class TelegramAdapter(PlatformAdapter):
+    name = "telegram"
+    module_name = "telegram_func"
+
+    async def setup(self):
+        # run_polling() owns its own loop, so drive the application lifecycle by hand
+        self.application = self.module.build_application()
+        await self.application.initialize()
+        await self.module.post_init(self.application)
+        await self.application.start()
+        await self.application.updater.start_polling()
+
+    async def teardown(self):
+        await self.application.updater.stop()
+        await self.application.stop()
+        await self.application.shutdown()
+        await self.module.post_shutdown(self.application)
+
+
+class SlackAdapter(PlatformAdapter):
+    name = "slack"
+    module_name = "slack_func"
+
+    async def setup(self):
+        from aiohttp import web
+
+        self.runner = web.AppRunner(self.module.create_web_app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, port=self.module.SLACK_PORT).start()
+
+    async def teardown(self):
+        await self.runner.cleanup()
+
+
+class WhatsAppAdapter(PlatformAdapter):
+    name = "whatsapp"
+    module_name = "whatsapp_funct"
+
+    async def setup(self):
+        self.service = self.module.WhatsAppIngestionService()
+        await self.service.start()
+
+    async def run(self):
+        await self.service.run()
+
+    async def teardown(self):
+        self.service.running = False
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        await self.service.stop()
+
+
+ADAPTERS = {
+    "discord": DiscordAdapter,
+    "telegram": TelegramAdapter,
+    "slack": SlackAdapter,
+    "whatsapp": WhatsAppAdapter,
+}
+
+
+class Runtime:
+    def __init__(self, platforms):
+        self.platforms = platforms
+        self.adapters = {}
+        self.stopping = asyncio.Event()
+
+    async def start_adapter(self, name):
+        if name in self.adapters:
+            return
+        adapter = ADAPTERS[name]()
+        try:
+            await adapter.start()
+        except (Exception, SystemExit) as e:  # whatsapp_funct exits when its env vars are missing
+            logger.error(f"Failed to start {name} adapter: {e}")
+            return
+        self.adapters[name] = adapter
+        adapter.task.add_done_callback(lambda task: self._on_adapter_exit(name, task))
+        logger.info(f"Started {name} adapter")
+
+    async def stop_adapter(self, name):
+        adapter = self.adapters.pop(name, None)
+        if adapter is None:
+            return
+        try:
+            await adapter.stop()
+        except Exception as e:
+            logger.error(f"Error stopping {name} adapter: {e}")
+        logger.info(f"Stopped {name} adapter")
+        if not self.adapters:
+            self.stopping.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Not supported on this platform; KeyboardInterrupt still stops the loop
+
+        for name in self.platforms:
+            await self.start_adapter(name)
+
+        try:
+            if self.adapters:
+                await self.stopping.wait()
+        finally:
+            # Stop in reverse start order so shared resources outlive their last user
+            for name in reversed(list(self.adapters)):
+                await self.stop_adapter(name)
+
+    def _on_adapter_exit(self, name, task):
+        if task.cancelled() or self.stopping.is_set():
+            return
+        if task.exception() is not None:
+            logger.error(f"{name} adapter crashed: {task.exception()}")
+        else:
+            logger.info(f"{name} adapter exited")
+        # The other adapters keep running; only this one is torn down
+        asyncio.create_task(self.stop_adapter(name))
+
+
+def run_runtime(platforms, index=0):
+    # Read by shared_resources, so every process serves /metrics on its own port
+    os.environ["RUNTIME_PROCESS_INDEX"] = str(index)
+    asyncio.run(Runtime(platforms).run())
+
+
+def shard_platforms(platforms, processes):
+    # Round-robin the platforms over the worker processes
+    return [platforms[i::processes] for i in range(processes) if platforms[i::processes]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the chat platform bots in one runtime.")
+    parser.add_argument(
+        "--platforms",
+        default=os.getenv("PLATFORMS", ",".join(PLATFORMS)),
+        help="Comma-separated platforms to run (default: all, or $PLATFORMS)"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=int(os.getenv("RUNTIME_PROCESSES", "1")),
+        help="Spread the platforms over this many processes, one event loop each"
     )
+    args = parser.parse_args()
+
+    platforms = [p.strip() for p in args.platforms.split(",") if p.strip()]
+    unknown = [p for p in platforms if p not in ADAPTERS]
+    if unknown:
+        parser.error(f"Unknown platforms: {', '.join(unknown)}")
+
+    if args.processes <= 1:
+        try:
+            run_runtime(platforms)
+        except KeyboardInterrupt:
+            logger.info("Shutting down...")
+        return
+
+    workers = [
+        multiprocessing.Process(target=run_runtime, args=(shard, index), name=f"runtime-{'-'.join(shard)}")
+        for index, shard in enumerate(shard_platforms(platforms, args.processes))
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Workers received the same SIGINT and shut down on their own
+        for worker in workers:
+            worker.join()
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main()
@@ -0,0 +1,243 @@
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from zep_python import MemorySearchPayload
+from zep_python.exceptions import NotFoundError
+from zep_python.memory import MemorySearchResult
+
+from context_ranking import ContextRanker
+
+
+logger = logging.getLogger(__name__)
+
+
+# Pluggable backends for semantic retrieval over a session's messages.
+# Every backend answers search() with Zep's MemorySearchResult objects, best
+# first with `dist` holding the cosine similarity to the query, so callers do
+# not care where the results come from:
+#   ZepMemoryBackend     - the remote Zep server (asearch_memory), its
+#                          candidates ranked locally by context_ranking
+#   LocalMemoryBackend   - the in-process LocalVectorStore, fed by the ingest path
+#   CachingMemoryBackend - local results for sessions mirrored from Zep, falling
+#                          back to Zep for anything that cannot be served locally
+# Writes to Zep keep going through MemoryWriteQueue; backends that keep their
+# own copy register with it as mirrors and receive each batch once Zep has it.
+
+
+class MemoryBackend(ABC):
+    async def add_messages(self, session_id, messages):
+        pass
+
+    @abstractmethod
+    async def search(self, session_id, text, limit=10, mmr_lambda=None, threshold=None):
+        """Return up to `limit` MemorySearchResults for `text`, best first, none scoring below `threshold`."""
+
+    async def close(self):
+        pass
+
+
+class ZepMemoryBackend(MemoryBackend):
+    def __init__(self, zep_client, embed=None):
+        """With `embed` (as for LocalMemoryBackend), Zep's candidates are re-scored against the query locally.
+
+        Similarity results are re-ranked by that score; MMR results keep Zep's order.
+        """
+        self.zep_client = zep_client
+        self.embed = embed
+
+    async def search(self, session_id, text, limit=10, mmr_lambda=None, threshold=None):
+        payload = MemorySearchPayload(
+            text=text,
+            search_scope="messages",
+            search_type="mmr" if mmr_lambda is not None else "similarity",
+            mmr_lambda=mmr_lambda
+        )
+        try:
+            results = await self.zep_client.memory.asearch_memory(session_id, payload, limit=limit)
+        except NotFoundError:
+            return []
+        if self.embed is None or not results:
+            if threshold is not None:
+                results = [r for r in results if r.dist is None or r.dist >= threshold]
+            return results
+
+        # One batched embedding for the query and every candidate, then the same top-k as the local store
+        vectors = await self.embed([text] + [(r.message or {}).get("content") or "" for r in results])
+        ranker = ContextRanker(vectors[0], vectors[1:])
+        if mmr_lambda is None:
+            rows = ranker.rank(k=limit, threshold=threshold)
+        else:
+            # Zep's MMR order already trades relevance for diversity; only the threshold applies
+            rows = [row for row in range(len(results)) if threshold is None or ranker.scores[row] >= threshold]
+        return [MemorySearchResult(message=results[row].message, metadata=results[row].metadata,
+                                   dist=float(ranker.scores[row]))
+                for row in rows]
+
+
+class LocalMemoryBackend(MemoryBackend):
+    def __init__(self, store, embed):
+        """`embed(texts)` must return L2-normalized embeddings, one row per text."""
+        self.store = store
+        self.embed = embed
+        self._locks = {}
+
+    async def add_messages(self, session_id, messages):
+        if not messages:
+            return
+        # Empty messages are still stored so the record count matches Zep's message count
+        vectors = await self.embed([message.content or message.role for message in messages])
+        records = [self._record(message) for message in messages]
+        async with self.lock(session_id):
+            # Loading a session, writing its files and k-means all stay off the event loop
+            await asyncio.to_thread(self._add, session_id, vectors, records)
+
+    async def search(self, session_id, text, limit=10, mmr_lambda=None, threshold=None):
+        query = (await self.embed([text]))[0]
+        async with self.lock(session_id):
+            # MMR picks from a wider pool of close matches
+            fetch_k = limit * 4 if mmr_lambda is not None else None
+            hits = await asyncio.to_thread(self.store.search, session_id, query, k=limit, fetch_k=fetch_k,
+                                           mmr_lambda=mmr_lambda, threshold=threshold)
+        return [MemorySearchResult(message=record, metadata=record.get("metadata"), dist=score)
+                for record, score in hits]
+
+    async def count(self, session_id):
+        return await asyncio.to_thread(self.store.count, session_id)
+
+    async def uuids(self, session_id):
+        """The uuids of the session's stored messages."""
+        return await asyncio.to_thread(self.store.uuids, session_id)
+
+    def lock(self, session_id):
+        if session_id not in self._locks:
+            self._locks[session_id] = asyncio.Lock()
+        return self._locks[session_id]
+
+    async def close(self):
+        self.store.close()
+
+    def _add(self, session_id, vectors, records):
+        self.store.add(session_id, vectors, records)
+        if self.store.count(session_id) >= self.store.ivf_min_size:
+            self.store.train(session_id)
+
+    @staticmethod
+    def _record(message):
+        created_at = message.created_at or datetime.utcnow().isoformat()
+        return {
+            "uuid": message.uuid,
+            "role": message.role,
+            "content": message.content,
+            "created_at": str(created_at),
+            "metadata": message.metadata or {},
+        }
+
+
+class CachingMemoryBackend(MemoryBackend):
+    """Serves searches from a local mirror of each Zep session, falling back to Zep.
+
+    The first search for a session in this process catches the local copy up
+    with Zep (only the pages past what is already stored on disk); after that,
+    batches mirrored from the write queue keep it current and searches never
+    leave the process. Batches mirrored while a catch-up runs are held back and
+    merged by uuid once it finishes. This relies on one process owning a
+    session's writes, which holds as long as each platform runs in a single
+    runtime process.
+    """
+
+    def __init__(self, local, remote, zep_client, page_size=100):
+        self.local = local
+        self.remote = remote
+        self.zep_client = zep_client
+        self.page_size = page_size
+        self._synced = set()
+        self._syncing = {}  # session_id -> in-flight catch-up task
+        self._pending = {}  # session_id -> messages mirrored while its catch-up runs
+        self._uuids = {}  # session_id -> uuids of the messages stored locally, for synced sessions
+
+        self.local_searches = 0
+        self.remote_searches = 0
+
+    async def add_messages(self, session_id, messages):
+        if session_id in self._pending:
+            # The catch-up may or may not see this batch in Zep; it merges it either way
+            self._pending[session_id].extend(messages)
+            return
+        # Sessions never synced pick these messages up from Zep when they are
+        if session_id not in self._synced:
+            return
+        known = self._uuids[session_id]
+        messages = [m for m in messages if m.uuid is None or m.uuid not in known]
+        known.update(m.uuid for m in messages if m.uuid is not None)
+        await self.local.add_messages(session_id, messages)
+
+    async def search(self, session_id, text, limit=10, mmr_lambda=None, threshold=None):
+        try:
+            await self._sync(session_id)
+            results = await self.local.search(session_id, text, limit=limit, mmr_lambda=mmr_lambda,
+                                              threshold=threshold)
+            self.local_searches += 1
+            return results
+        except Exception as e:
+            logger.error(f"Local search failed for session {session_id}, using Zep: {e}")
+            self.remote_searches += 1
+            return await self.remote.search(session_id, text, limit=limit, mmr_lambda=mmr_lambda,
+                                            threshold=threshold)
+
+    async def close(self):
+        await self.local.close()
+
+    async def _sync(self, session_id):
+        if session_id in self._synced:
+            return
+        task = self._syncing.get(session_id)
+        if task is None:
+            self._pending[session_id] = []
+            task = self._syncing[session_id] = asyncio.ensure_future(self._catch_up(session_id))
+            task.add_done_callback(lambda _: self._syncing.pop(session_id, None))
+        await asyncio.shield(task)
+
+    async def _fetch_page(self, session_id, page):
+        try:
+            return await self.zep_client.message.aget_session_messages(session_id, limit=self.page_size, cursor=page)
+        except NotFoundError:
+            return []
+
+    async def _catch_up(self, session_id):
+        try:
+            known = await self.local.uuids(session_id)
+            # Start one page before where the stored count points; if that page does not begin with a
+            # stored message, the count has drifted, so walk back until one does
+            page = max(1, await self.local.count(session_id) // self.page_size)
+            messages = await self._fetch_page(session_id, page)
+            while page > 1 and not (messages and messages[0].uuid in known):
+                page -= 1
+                messages = await self._fetch_page(session_id, page)
+
+            missing = []
+            while True:
+                for message in messages:
+                    if message.uuid is None or message.uuid not in known:
+                        missing.append(message)
+                        if message.uuid is not None:
+                            known.add(message.uuid)
+                if len(messages) < self.page_size:
+                    break
+                page += 1
+                messages = await self._fetch_page(session_id, page)
+            for start in range(0, len(missing), self.page_size):
+                await self.local.add_messages(session_id, missing[start:start + self.page_size])
+
+            # Merge what was mirrored meanwhile; nothing is awaited between the last check and going live
+            while self._pending[session_id]:
+                buffered, self._pending[session_id] = self._pending[session_id], []
+                buffered = [m for m in buffered if m.uuid is None or m.uuid not in known]
+                known.update(m.uuid for m in buffered if m.uuid is not None)
+                await self.local.add_messages(session_id, buffered)
+            self._uuids[session_id] = known
+            self._synced.add(session_id)
+        finally:
+            # On failure the buffered batches are already in Zep, so the next catch-up fetches them
+            self._pending.pop(session_id, None)
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+import uuid
+
+from zep_python.memory import Memory
+
+import tracing
+
+
+logger = logging.getLogger(__name__)
+
+
+# Write-behind queue for Zep add_memory calls.
+# Handlers enqueue messages and return immediately; a single consumer task
+# coalesces them per session into one Memory with many Messages and flushes
+# when a session reaches `batch_size` messages or its oldest pending message
+# is `flush_interval` seconds old. The queue is bounded, so producers wait
+# (backpressure) instead of piling up unbounded work when Zep is slow.
+# Mirrors (see memory_backend) receive every batch Zep accepted, in the
+# background, so keeping a local copy never slows the Zep writes down.
+# Messages get their uuid here rather than from Zep, so local copies can be
+# matched with the same messages read back from Zep. Each message carries the
+# span it was queued under; a batch is written in a span parented to the first
+# of them and linked to the rest, so traces show the real Zep write.
+
+_STOP = object()
+_FLUSH = object()
+
+
+class MemoryWriteQueue:
+    def __init__(self, zep_client, batch_size=10, flush_interval=1.0, max_pending=1000):
+        self.zep_client = zep_client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._queue = None
+        self._task = None
+        self._loop = None
+        self._users = 0  # start() calls not yet matched by close(); the queue drains when the last one leaves
+        self._mirrors = []
+        self._mirror_tasks = set()
+
+        self.messages_written = 0
+        self.batches_written = 0
+        self.failed_batches = 0
+        self.messages_dropped = 0  # messages in failed batches, which are not retried
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def add_mirror(self, mirror):
+        """Register an object whose `add_messages(session_id, messages)` receives every written batch."""
+        if mirror not in self._mirrors:
+            self._mirrors.append(mirror)
+
+    async def start(self):
+        self._users += 1
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._task = asyncio.create_task(self._run())
+
+    async def add(self, session_id, message, metadata=None):
+        """Queue one Message for `session_id`, waiting while the queue is full."""
+        if message.uuid is None:
+            message.uuid = str(uuid.uuid4())
+        if not self.running:
+            # Not started (or already closed): fall back to a direct write
+            await self._write(session_id, metadata, [message], [tracing.current_span()])
+            return
+        await self._queue.put((session_id, message, metadata, tracing.current_span()))
+
+    async def flush(self, session_id=None):
+        """Write out everything queued so far for `session_id` (or every session)."""
+        if not self.running:
+            return
+        done = self._loop.create_future()
+        await self._queue.put((session_id, _FLUSH, done, None))
+        await done
+
+    async def close(self):
+        """Stop accepting work and drain everything already queued."""
+        self._users = max(0, self._users - 1)
+        if not self.running or self._users:
+            return
+        await self._queue.put((None, _STOP, None, None))
+        await self._task
+        self._task = None
+        await asyncio.gather(*self._mirror_tasks, return_exceptions=True)
+
+    async def _run(self):
+        pending = {}  # session_id -> (metadata, [Message, ...], [queuing span, ...])
+        deadlines = {}  # session_id -> monotonic time the batch must be written by
+
+        while True:
+            timeout = None
+            if deadlines:
+                timeout = max(0.0, min(deadlines.values()) - time.monotonic())
+
+            try:
+                session_id, message, extra, span = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                session_id, message, extra, span = None, None, None, None
+
+            if message is _STOP:
+                await self._flush_sessions(list(pending), pending, deadlines)
+                return
+
+            if message is _FLUSH:
+                targets = list(pending) if session_id is None else [session_id]
+                await self._flush_sessions(targets, pending, deadlines)
+                # The caller may have stopped waiting (cancelled or timed out)
+                if not extra.done():
+                    extra.set_result(None)
+                continue
+
+            if message is not None:
+                if session_id not in pending:
+                    pending[session_id] = (extra, [], [])
+                    deadlines[session_id] = time.monotonic() + self.flush_interval
+                pending[session_id][1].append(message)
+                if span is not None:
+                    pending[session_id][2].append(span)
+                if len(pending[session_id][1]) >= self.batch_size:
+                    await self._flush_sessions([session_id], pending, deadlines)
+
+            now = time.monotonic()
+            due = [s for s, deadline in deadlines.items() if deadline <= now]
+            if due:
+                await self._flush_sessions(due, pending, deadlines)
+
+    async def _flush_sessions(self, session_ids, pending, deadlines):
+        batches = []
+        for session_id in session_ids:
+            if session_id in pending:
+                batches.append((session_id, *pending.pop(session_id)))
+                deadlines.pop(session_id, None)
+        if batches:
+            await asyncio.gather(*(self._write(*batch) for batch in batches))
+
+    async def _write(self, session_id, metadata, messages, spans=()):
+        memory = Memory(messages=messages, metadata=metadata or {"session_id": session_id})
+        spans = [span for span in spans if span is not None]
+        try:
+            # Untraced messages do not start a trace of their own
+            with tracing.span("memory.write", attributes={"session.id": session_id, "batch.size": len(messages)},
+                              parent=spans[0] if spans else None, links=spans[1:], require_parent=True):
+                await self.zep_client.memory.aadd_memory(session_id, memory)
+            self.messages_written += len(messages)
+            self.batches_written += 1
+        except Exception as e:
+            self.failed_batches += 1
+            self.messages_dropped += len(messages)
+            logger.error(f"Error writing {len(messages)} messages for session {session_id}, dropping them: {e}")
+            return
+        for mirror in self._mirrors:
+            task = asyncio.ensure_future(self._mirror(mirror, session_id, messages))
+            self._mirror_tasks.add(task)
+            task.add_done_callback(self._mirror_tasks.discard)
+
+    async def _mirror(self, mirror, session_id, messages):
+        try:
+            await mirror.add_messages(session_id, messages)
+        except Exception as e:
+            logger.error(f"Error mirroring {len(messages)} messages for session {session_id}: {e}")
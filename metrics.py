@@ -0,0 +1,285 @@
+import asyncio
+import bisect
+import logging
+import math
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+
+logger = logging.getLogger(__name__)
+
+
+# Process-wide metrics in the Prometheus text format.
+# Counters, gauges and histograms live in one registry and are created on
+# first use, so a module can declare the metrics it updates at import time
+# and every bot in the process adds to the same series. Gauges (and counters
+# that some component already keeps) can read their value from a function at
+# scrape time instead of being updated on the hot path. The registry is
+# served on /metrics by MetricsServer (on localhost unless told otherwise), or
+# mounted on an existing aiohttp app.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, child in list(self._children.items()):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+    def _default(self):
+        # Metrics without labels are used directly, e.g. counter.inc()
+        return self.labels()
+
+    def _render_child(self, key, child):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.get())}"]
+
+
+class _Value:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def inc(self, amount=1.0):
+        self.value += amount
+
+    def dec(self, amount=1.0):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from `function()` at scrape time."""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return float(self.function())
+            except Exception:
+                return math.nan
+        return self.value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self._default().inc(amount)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self._default().inc(amount)
+
+    def dec(self, amount=1.0):
+        self._default().dec(amount)
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _render_child(self, key, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key, [("le", "+Inf")])
+        lines.append(f"{self.name}_bucket{labels} {child.count}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _get(self, cls, name, documentation, labelnames, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+        elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+            raise ValueError(f"Metric {name} is already registered with a different type or labels")
+        return metric
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+# Series shared by the platform modules
+STAGE_SECONDS = histogram("chatbot_stage_seconds", "Time spent in each stage of handling a message",
+                          ("platform", "stage"))
+MENTION_SECONDS = histogram("chatbot_mention_seconds", "Time from receiving a mention to the reply being sent",
+                            ("platform",))
+MESSAGES_TOTAL = counter("chatbot_messages_total", "Messages received", ("platform",))
+MENTIONS_TOTAL = counter("chatbot_mentions_total", "Mentions answered, by outcome", ("platform", "outcome"))
+ERRORS_TOTAL = counter("chatbot_errors_total", "Errors while handling messages", ("platform", "stage"))
+COMPONENT_STATS = gauge("chatbot_component_stat", "Values reported by a component's stats(), read at scrape time",
+                        ("platform", "component", "stat"))
+
+
+def stage(platform, name):
+    """Time a block of work as `name` in chatbot_stage_seconds."""
+    return STAGE_SECONDS.labels(platform, name).time()
+
+
+def export_stats(platform, component, stats):
+    """Expose every numeric value returned by `stats()` (queue depths, hit counts, ...) as a gauge."""
+    for stat, value in stats().items():
+        if isinstance(value, (int, float)):
+            COMPONENT_STATS.labels(platform, component, stat).set_function(lambda stat=stat: stats()[stat])
+
+
+async def handle_metrics(request):
+    return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+
+class MetricsServer:
+    def __init__(self, port=9100, host="127.0.0.1"):
+        self.port = port
+        self.host = host
+        self._runner = None
+        self._users = 0
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        # Reference counted like the LLM gateway: the first bot to start opens the port
+        async with self._lock:
+            self._users += 1
+            if self._runner is not None:
+                return
+            app = web.Application()
+            app.router.add_get("/metrics", handle_metrics)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            try:
+                await web.TCPSite(runner, self.host, self.port).start()
+            except OSError as e:
+                # A taken port costs the endpoint, not the bots
+                logger.error(f"Metrics endpoint could not listen on {self.host}:{self.port}: {e}")
+                await runner.cleanup()
+                return
+            self._runner = runner
+
+    async def close(self):
+        async with self._lock:
+            self._users = max(0, self._users - 1)
+            if self._users > 0 or self._runner is None:
+                return
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,157 @@
+import logging
+import time
+from dataclasses import dataclass
+
+
+logger = logging.getLogger(__name__)
+
+
+# GCRA (generic cell rate algorithm) rate limiting, the token bucket written as
+# a single timestamp per key. A limit of `rate` requests per `period` seconds
+# spaces requests `period / rate` seconds apart; every allowed request pushes
+# the key's theoretical arrival time (TAT) forward by that interval, and a
+# request is refused when it would put the TAT more than `burst` intervals
+# ahead of now. A key whose TAT has passed is back to a full burst and holds no
+# information, so idle keys are simply dropped.
+# The memory backend limits one process; the Postgres backend keeps the TATs
+# in a table so every process sharing the database shares the limits.
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    rate: int  # requests allowed per period on average
+    period: float  # seconds
+    burst: int = 1  # requests that may arrive back to back
+
+    @property
+    def interval(self):
+        return self.period / self.rate
+
+    @property
+    def tolerance(self):
+        return self.interval * self.burst
+
+
+@dataclass
+class RateLimitDecision:
+    allowed: bool
+    retry_after: float = 0.0  # seconds until the refused request would be allowed
+    key: str = None  # the key that refused it
+
+
+class MemoryRateLimitBackend:
+    def __init__(self, sweep_interval=60.0):
+        self.sweep_interval = sweep_interval
+        self._tats = {}  # key -> theoretical arrival time (monotonic)
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    async def take(self, key, limit, cost=1):
+        """Charge `cost` requests to `key`; returns seconds to wait, or 0 if the requests were allowed."""
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        tat = max(self._tats.get(key, now), now)
+        new_tat = tat + limit.interval * cost
+        if new_tat - now > limit.tolerance:
+            return new_tat - now - limit.tolerance
+        self._tats[key] = new_tat
+        return 0.0
+
+    async def refund(self, key, limit, cost=1):
+        if key in self._tats:
+            self._tats[key] -= limit.interval * cost
+
+    async def close(self):
+        self._tats.clear()
+
+    def __len__(self):
+        return len(self._tats)
+
+    def _sweep(self, now):
+        self._tats = {key: tat for key, tat in self._tats.items() if tat > now}
+        self._next_sweep = now + self.sweep_interval
+
+
+class PostgresRateLimitBackend:
+    def __init__(self, pool, sweep_interval=60.0):
+        self.pool = pool
+        self.sweep_interval = sweep_interval
+        self._next_sweep = 0.0
+
+    async def initialize(self):
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    key TEXT PRIMARY KEY,
+                    tat DOUBLE PRECISION NOT NULL
+                )
+            ''')
+            await conn.execute('CREATE INDEX IF NOT EXISTS rate_limits_tat ON rate_limits (tat)')
+
+    async def take(self, key, limit, cost=1):
+        # Processes share the limits, so TATs are wall-clock epoch seconds
+        now = time.time()
+        increment = limit.interval * cost
+        async with self.pool.acquire() as conn:
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.sweep_interval
+                await conn.execute('DELETE FROM rate_limits WHERE tat <= $1', now)
+            # The conditional upsert is the whole check-and-set, so concurrent callers cannot overshoot
+            row = await conn.fetchrow('''
+                INSERT INTO rate_limits (key, tat) VALUES ($1, $2::float8 + $3::float8)
+                ON CONFLICT (key) DO UPDATE SET tat = GREATEST(rate_limits.tat, $2::float8) + $3::float8
+                WHERE GREATEST(rate_limits.tat, $2::float8) + $3::float8 - $2::float8 <= $4::float8
+                RETURNING tat
+            ''', key, now, increment, limit.tolerance)
+            if row is not None:
+                return 0.0
+            tat = await conn.fetchval('SELECT tat FROM rate_limits WHERE key = $1', key)
+        return max(tat or now, now) + increment - now - limit.tolerance
+
+    async def refund(self, key, limit, cost=1):
+        async with self.pool.acquire() as conn:
+            await conn.execute('UPDATE rate_limits SET tat = tat - $2::float8 WHERE key = $1', key,
+                               limit.interval * cost)
+
+    async def close(self):
+        pass
+
+
+class RateLimiter:
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryRateLimitBackend()
+
+        self.allowed = 0
+        self.refused = 0
+        self.errors = 0
+
+    async def hit(self, *checks, cost=1):
+        """Charge every `(limit, key)` in `checks`, all or nothing.
+
+        The checks run in order and stop at the first refusal, handing back
+        whatever the earlier checks took, so put the narrowest (per-user)
+        limits first and shared ones such as a global budget last. If the
+        backend fails the request is allowed: losing rate limiting for a
+        moment is better than taking the bot down with the database.
+        """
+        taken = []
+        try:
+            for limit, key in checks:
+                retry_after = await self.backend.take(key, limit, cost)
+                if retry_after > 0:
+                    for taken_limit, taken_key in reversed(taken):
+                        await self.backend.refund(taken_key, taken_limit, cost)
+                    self.refused += 1
+                    return RateLimitDecision(False, retry_after, key)
+                taken.append((limit, key))
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Rate limit backend failed, allowing the request: {e}")
+        self.allowed += 1
+        return RateLimitDecision(True)
+
+    async def close(self):
+        await self.backend.close()
+
+    def stats(self):
+        return {"allowed": self.allowed, "refused": self.refused, "errors": self.errors}
@@ -0,0 +1,155 @@
+import itertools
+import logging
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+# Per-session semantic cache of bot answers.
+# Questions are normalized and embedded; a new question whose embedding is
+# within `threshold` cosine similarity of a cached one in the same session gets
+# the cached answer without a completion. Any new conversation in the session
+# bumps its generation and drops its answers, so a cached reply never ignores
+# messages that arrived after it was generated.
+
+_MENTION = re.compile(r"<[@#!&]*\d+>")
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+# Generations are unique across sessions, so a session evicted and recreated
+# mid-lookup can never match a generation handed out before the eviction
+_generations = itertools.count()
+
+
+def normalize_question(text: str) -> str:
+    text = _MENTION.sub(" ", text.lower())
+    text = _PUNCTUATION.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+@dataclass
+class CacheLookup:
+    question: str
+    generation: int
+    answer: Optional[str] = None
+    vector: Optional[np.ndarray] = None
+
+
+class _SessionEntries:
+    def __init__(self):
+        self.generation = next(_generations)
+        self.questions = []
+        self.answers = []
+        self.created = []
+        self.matrix = None  # normalized question embeddings, one row per entry
+
+    def clear(self):
+        self.generation = next(_generations)
+        self.questions, self.answers, self.created = [], [], []
+        self.matrix = None
+
+
+class SemanticResponseCache:
+    def __init__(self, embed, threshold=0.95, ttl=3600, max_entries=32, max_sessions=1000):
+        """`embed(texts)` must return a matrix of L2-normalized embeddings, one row per text."""
+        self.embed = embed
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    async def lookup(self, session_id, question) -> CacheLookup:
+        entries = self._entries(session_id)
+        lookup = CacheLookup(normalize_question(question), entries.generation)
+        if not lookup.question:
+            return lookup
+
+        self._expire(entries)
+
+        # Exact repeats are answered without embedding anything
+        if lookup.question in entries.questions:
+            lookup.answer = entries.answers[entries.questions.index(lookup.question)]
+            self.hits += 1
+            return lookup
+
+        try:
+            lookup.vector = (await self.embed([lookup.question]))[0]
+        except Exception as e:
+            logger.error(f"Error embedding question for response cache: {e}")
+            return lookup
+
+        # Entries may have changed while the embedding was in flight
+        if entries.generation == lookup.generation and entries.matrix is not None:
+            scores = entries.matrix @ lookup.vector
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                lookup.answer = entries.answers[best]
+                self.hits += 1
+                return lookup
+
+        self.misses += 1
+        return lookup
+
+    def store(self, session_id, lookup: CacheLookup, answer):
+        entries = self._entries(session_id)
+        # Skip answers generated against a conversation that has since moved on
+        if lookup.vector is None or not answer or entries.generation != lookup.generation:
+            return
+
+        entries.questions.append(lookup.question)
+        entries.answers.append(answer)
+        entries.created.append(time.monotonic())
+        vector = lookup.vector[np.newaxis, :]
+        entries.matrix = vector if entries.matrix is None else np.vstack([entries.matrix, vector])
+
+        if len(entries.questions) > self.max_entries:
+            self._drop(entries, len(entries.questions) - self.max_entries)
+
+    def invalidate(self, session_id):
+        entries = self._sessions.get(session_id)
+        if entries is not None:
+            entries.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "sessions": len(self._sessions),
+            "entries": sum(len(entries.questions) for entries in self._sessions.values()),
+        }
+
+    def _entries(self, session_id):
+        entries = self._sessions.get(session_id)
+        if entries is None:
+            entries = self._sessions[session_id] = _SessionEntries()
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session_id)
+        return entries
+
+    def _expire(self, entries):
+        cutoff = time.monotonic() - self.ttl
+        expired = 0
+        while expired < len(entries.created) and entries.created[expired] < cutoff:
+            expired += 1
+        if expired:
+            self._drop(entries, expired)
+
+    @staticmethod
+    def _drop(entries, count):
+        # Entries are kept oldest first, so dropping from the front evicts the oldest
+        del entries.questions[:count]
+        del entries.answers[:count]
+        del entries.created[:count]
+        entries.matrix = entries.matrix[count:] if entries.questions else None
@@ -0,0 +1,63 @@
+import time
+
+
+# Streams chat completions into a platform message that is edited in place.
+# Edits are throttled to `min_interval` seconds per message to stay inside the
+# platform's edit rate limits, and text past `max_length` rolls over into a
+# new message, the same way the non-streaming path splits replies into chunks.
+# The deltas come from LLMGateway.stream_chat.
+
+
+class StreamingMessageEditor:
+    def __init__(self, message, edit, send, max_length=2000, min_interval=1.0):
+        """`edit(message, text)` updates a sent message; `send(text)` posts a new one and returns it."""
+        self.message = message
+        self.edit = edit
+        self.send = send
+        self.max_length = max_length
+        self.min_interval = min_interval
+
+        self.text = ""  # everything received so far
+        self._current = ""  # text belonging to the message being edited
+        self._shown = None  # what that message currently displays
+        self._last_edit = 0.0
+
+    async def feed(self, delta):
+        self.text += delta
+        self._current += delta
+
+        while len(self._current) > self.max_length:
+            head, self._current = self._split(self._current)
+            await self._edit(head)
+            # The rest goes into a new message, posted on the next edit
+            self.message = None
+            self._shown = None
+
+        if time.monotonic() - self._last_edit >= self.min_interval:
+            await self._edit(self._current)
+
+    async def finish(self):
+        await self._edit(self._current)
+        return self.text
+
+    async def consume(self, deltas):
+        async for delta in deltas:
+            await self.feed(delta)
+        return await self.finish()
+
+    def _split(self, text):
+        # Prefer breaking on a newline or space so words are not cut in half
+        cut = max(text.rfind("\n", 0, self.max_length), text.rfind(" ", 0, self.max_length))
+        if cut <= 0:
+            cut = self.max_length
+        return text[:cut], text[cut:].lstrip()
+
+    async def _edit(self, text):
+        if not text or text == self._shown:
+            return
+        if self.message is None:
+            self.message = await self.send(text)
+        else:
+            await self.edit(self.message, text)
+        self._shown = text
+        self._last_edit = time.monotonic()
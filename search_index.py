@@ -0,0 +1,321 @@
+import asyncio
+import heapq
+import logging
+import math
+import re
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from zep_python.exceptions import NotFoundError
+
+
+logger = logging.getLogger(__name__)
+
+
+# Local full-text index for the /search commands.
+# Every session gets an in-memory inverted index (term -> doc ids and token
+# positions) that is appended to from the ingest path, so a search is a few
+# postings lookups plus BM25 scoring instead of a download of the whole
+# session. Queries support plain terms (all must match), "quoted phrases" and
+# prefix* terms. A session is backfilled from Zep once, on its first search
+# after a restart; after that searches never leave the process.
+
+_TOKEN = re.compile(r"\w+")
+_QUERY = re.compile(r'"([^"]*)"|(\w+)(\*?)')
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+MAX_PREFIX_EXPANSION = 50  # Vocabulary terms a single prefix* query may expand to
+
+
+def tokenize(text):
+    return [match.group(0).lower() for match in _TOKEN.finditer(text)]
+
+
+def parse_query(query):
+    """Split a query into ("term", t), ("prefix", p) and ("phrase", [t, ...]) clauses."""
+    clauses = []
+    for phrase, word, star in _QUERY.findall(query):
+        if phrase:
+            terms = tokenize(phrase)
+            if len(terms) > 1:
+                clauses.append(("phrase", terms))
+            elif terms:
+                clauses.append(("term", terms[0]))
+        elif star:
+            clauses.append(("prefix", word.lower()))
+        else:
+            clauses.append(("term", word.lower()))
+    return clauses
+
+
+@dataclass
+class SearchHit:
+    doc_id: int
+    score: float
+    role: str
+    text: str
+    snippet: str
+
+
+class _Postings:
+    __slots__ = ("docs", "positions")
+
+    def __init__(self):
+        self.docs = []  # ascending doc ids
+        self.positions = []  # token positions of the term in the matching doc
+
+
+class SessionIndex:
+    def __init__(self):
+        self.texts = []
+        self.roles = []
+        self.lengths = []
+        self.total_length = 0
+        self.postings = {}
+        self.vocabulary = []  # sorted, for prefix lookups
+
+    def add(self, role, text):
+        doc_id = len(self.texts)
+        terms = tokenize(text)
+        self.texts.append(text)
+        self.roles.append(role)
+        self.lengths.append(len(terms))
+        self.total_length += len(terms)
+
+        positions = {}
+        for position, term in enumerate(terms):
+            positions.setdefault(term, []).append(position)
+        for term, term_positions in positions.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = _Postings()
+                insort(self.vocabulary, term)
+            postings.docs.append(doc_id)
+            postings.positions.append(term_positions)
+        return doc_id
+
+    def __len__(self):
+        return len(self.texts)
+
+    def search(self, query, limit=10, highlight=None, snippet_length=160):
+        clauses = parse_query(query)
+        if not clauses or not self.texts:
+            return []
+
+        # Evaluate the rarest clause first so later ones only probe its candidates
+        evaluated = sorted((self._expand(clause) for clause in clauses), key=lambda item: item[0])
+        scores = None
+        matched_terms = set()
+        for _, kind, terms in evaluated:
+            clause_scores = self._score_clause(kind, terms, scores)
+            scores = clause_scores if scores is None else {
+                doc_id: score + clause_scores[doc_id] for doc_id, score in scores.items() if doc_id in clause_scores
+            }
+            matched_terms.update(terms)
+            if not scores:
+                return []
+
+        # Newest message wins ties
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+        return [
+            SearchHit(doc_id, score, self.roles[doc_id], self.texts[doc_id],
+                      self.snippet(doc_id, matched_terms, highlight, snippet_length))
+            for doc_id, score in best
+        ]
+
+    def snippet(self, doc_id, terms, highlight=None, length=160):
+        text = self.texts[doc_id]
+        spans = [match.span() for match in _TOKEN.finditer(text) if match.group(0).lower() in terms]
+        start = max(0, spans[0][0] - length // 3) if spans else 0
+        end = min(len(text), start + length)
+
+        parts = ["…"] if start > 0 else []
+        cursor = start
+        for span_start, span_end in spans:
+            if span_start < cursor or span_end > end:
+                continue
+            parts.append(text[cursor:span_start])
+            word = text[span_start:span_end]
+            parts.append(highlight(word) if highlight else word)
+            cursor = span_end
+        parts.append(text[cursor:end])
+        if end < len(text):
+            parts.append("…")
+        return "".join(parts)
+
+    def _expand(self, clause):
+        kind, value = clause
+        if kind == "prefix":
+            first = bisect_left(self.vocabulary, value)
+            terms = []
+            for term in self.vocabulary[first:first + MAX_PREFIX_EXPANSION]:
+                if not term.startswith(value):
+                    break
+                terms.append(term)
+        elif kind == "phrase":
+            terms = value
+        else:
+            terms = [value]
+        postings = [self.postings[term] for term in terms if term in self.postings]
+        if kind == "prefix":
+            cost = sum(len(p.docs) for p in postings)
+        else:
+            # Every term (of a phrase) must be present, so an unknown term means no match
+            cost = min(len(p.docs) for p in postings) if len(postings) == len(terms) else 0
+        return cost, kind, terms
+
+    def _score_clause(self, kind, terms, candidates):
+        if kind == "prefix":
+            scores = {}
+            for term in terms:
+                for doc_id, (score, _) in self._term_matches(term, candidates).items():
+                    scores[doc_id] = scores.get(doc_id, 0.0) + score
+            return scores
+
+        if kind == "term":
+            return {doc_id: score for doc_id, (score, _) in self._term_matches(terms[0], candidates).items()}
+
+        matches = self._term_matches(terms[0], candidates)
+        for term in terms[1:]:
+            if not matches:
+                break
+            matches_next = self._term_matches(term, matches)
+            matches = {doc_id: matches[doc_id] for doc_id in matches_next}
+            for doc_id in matches:
+                matches[doc_id] = (matches[doc_id][0] + matches_next[doc_id][0], matches[doc_id][1])
+
+        scores = {}
+        for doc_id, (score, _) in matches.items():
+            if self._has_phrase(doc_id, terms):
+                scores[doc_id] = score
+        return scores
+
+    def _term_matches(self, term, candidates):
+        """Map doc id -> (BM25 score, positions) for `term`, limited to `candidates` when given."""
+        postings = self.postings.get(term)
+        if postings is None:
+            return {}
+
+        count = len(self.texts)
+        idf = math.log(1 + (count - len(postings.docs) + 0.5) / (len(postings.docs) + 0.5))
+        average_length = self.total_length / count or 1.0
+
+        if candidates is not None and len(candidates) < len(postings.docs):
+            # Probe the postings for each candidate instead of walking the whole list
+            rows = []
+            for doc_id in candidates:
+                row = bisect_left(postings.docs, doc_id)
+                if row < len(postings.docs) and postings.docs[row] == doc_id:
+                    rows.append(row)
+        else:
+            rows = range(len(postings.docs))
+            if candidates is not None:
+                rows = [row for row in rows if postings.docs[row] in candidates]
+
+        matches = {}
+        for row in rows:
+            doc_id = postings.docs[row]
+            frequency = len(postings.positions[row])
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc_id] / average_length)
+            matches[doc_id] = (idf * frequency * (BM25_K1 + 1) / (frequency + norm), postings.positions[row])
+        return matches
+
+    def _has_phrase(self, doc_id, terms):
+        position_sets = []
+        for term in terms:
+            postings = self.postings[term]
+            row = bisect_left(postings.docs, doc_id)
+            position_sets.append(set(postings.positions[row]))
+        return any(
+            all(start + offset in positions for offset, positions in enumerate(position_sets[1:], 1))
+            for start in position_sets[0]
+        )
+
+
+class SearchIndex:
+    def __init__(self, zep_client, memory_writer=None, max_sessions=200, page_size=100):
+        self.zep_client = zep_client
+        self.memory_writer = memory_writer
+        self.max_sessions = max_sessions
+        self.page_size = page_size
+        self._sessions = OrderedDict()  # session_id -> SessionIndex
+        self._complete = set()  # sessions whose index holds the full history
+        self._backfills = {}  # session_id -> in-flight backfill task
+        self._pending = {}  # session_id -> messages ingested while a backfill runs
+
+    def add(self, session_id, role, content, uuid=None):
+        """Index one message; `uuid` (the Zep message's) keeps a concurrent backfill from indexing it twice."""
+        if session_id in self._backfills:
+            self._pending[session_id].append((role, content, uuid))
+        else:
+            self._session(session_id).add(role, content)
+
+    async def search(self, session_id, query, limit=10, highlight=None):
+        await self._ensure_complete(session_id)
+        return self._session(session_id).search(query, limit=limit, highlight=highlight)
+
+    def stats(self):
+        return {
+            "sessions": len(self._sessions),
+            "complete": len(self._complete),
+            "documents": sum(len(index) for index in self._sessions.values()),
+        }
+
+    def _session(self, session_id):
+        index = self._sessions.get(session_id)
+        if index is None:
+            index = self._sessions[session_id] = SessionIndex()
+            while len(self._sessions) > self.max_sessions:
+                evicted, _ = self._sessions.popitem(last=False)
+                self._complete.discard(evicted)
+        else:
+            self._sessions.move_to_end(session_id)
+        return index
+
+    async def _ensure_complete(self, session_id):
+        if session_id in self._complete:
+            return
+        task = self._backfills.get(session_id)
+        if task is None:
+            self._pending[session_id] = []
+            task = self._backfills[session_id] = asyncio.ensure_future(self._backfill(session_id))
+        await asyncio.shield(task)
+
+    async def _backfill(self, session_id):
+        index = SessionIndex()
+        fetched = set()  # uuids of the messages read from Zep
+        try:
+            if self.memory_writer is not None:
+                await self.memory_writer.flush(session_id)
+            page = 1
+            while True:
+                messages = await self.zep_client.message.aget_session_messages(session_id, limit=self.page_size,
+                                                                                cursor=page)
+                for message in messages:
+                    index.add(message.role, message.content)
+                    fetched.add(message.uuid)
+                if len(messages) < self.page_size:
+                    break
+                page += 1
+        except NotFoundError:
+            pass  # Zep has nothing stored for this session yet
+        except Exception:
+            # Keep what was ingested meanwhile; the next search retries the backfill
+            for role, content, _ in self._pending.pop(session_id, []):
+                self._session(session_id).add(role, content)
+            raise
+        finally:
+            self._backfills.pop(session_id, None)
+
+        # Messages ingested during the backfill may already be in the fetched pages
+        for role, content, uuid in self._pending.pop(session_id, []):
+            if uuid is None or uuid not in fetched:
+                index.add(role, content)
+        self._sessions[session_id] = index
+        self._sessions.move_to_end(session_id)
+        self._complete.add(session_id)
+        while len(self._sessions) > self.max_sessions:
+            evicted, _ = self._sessions.popitem(last=False)
+            self._complete.discard(evicted)
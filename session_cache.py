@@ -0,0 +1,51 @@
+import asyncio
+from collections import OrderedDict
+
+
+# Bounded read-through cache for channel/chat -> session id lookups.
+# Misses call `loader`; concurrent misses for the same key share one in-flight
+# load (single-flight) instead of each hitting the database.
+
+
+class SessionIdCache:
+    def __init__(self, loader, max_size=10000):
+        self.loader = loader
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(key))
+            self._inflight[key] = task
+        # Shield so one cancelled waiter does not cancel the load for the others
+        return await asyncio.shield(task)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    async def _load(self, key):
+        try:
+            value = await self.loader(key)
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return value
+        finally:
+            self._inflight.pop(key, None)
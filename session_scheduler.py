@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import re
+
+import tracing
+
+
+logger = logging.getLogger(__name__)
+
+
+# Per-session request scheduling for bot mentions.
+# Requests for one session are handled one batch at a time, in arrival order,
+# by a worker that exists only while the session has work; different sessions
+# run in parallel. The first request of an idle session is dispatched at once;
+# a batch is whatever queued up (up to `max_batch`) while the previous batch
+# was running, so a burst of mentions in a busy channel becomes one
+# completion instead of several racing ones, without delaying a lone mention. A batch is
+# traced under the first request's span, linked to the spans of the others.
+# The helpers below build and split the prompt for answering several
+# questions in one completion, and keep one request's failure from failing
+# the rest of its batch.
+
+_ANSWER_MARKER = re.compile(r"^\s*#{2,}\s*(\d+)\s*$", re.MULTILINE)
+
+
+def format_batched_questions(questions):
+    """Fold several questions, asked around the same time, into one prompt."""
+    lines = [
+        "Several people asked questions at about the same time. Answer each one separately and in order.",
+        "Start each answer with a line holding only '### ' and the question's number.",
+        ""
+    ]
+    lines.extend(f"{number}. {question}" for number, question in enumerate(questions, 1))
+    return "\n".join(lines)
+
+
+def split_batched_answers(text, count):
+    """Split a reply to format_batched_questions(); returns None unless it holds exactly `count` answers."""
+    markers = list(_ANSWER_MARKER.finditer(text))
+    if [int(marker.group(1)) for marker in markers] != list(range(1, count + 1)):
+        return None
+    answers = []
+    for marker, following in zip(markers, markers[1:] + [None]):
+        answer = text[marker.end():following.start() if following else len(text)].strip()
+        if not answer:
+            return None
+        answers.append(answer)
+    return answers
+
+
+async def settle(awaitable):
+    """Await one request's work; returns the exception it raised (or None) instead of raising it."""
+    try:
+        await awaitable
+    except Exception as e:
+        return e
+    return None
+
+
+class _SessionQueue:
+    def __init__(self):
+        self.items = []  # (item, future, submitter's span)
+        self.worker = None
+
+
+class SessionScheduler:
+    def __init__(self, run_batch, max_batch=5):
+        """`run_batch(session_id, items)` handles a batch and returns one result per item (or None).
+
+        A result that is an exception fails only that item's request.
+        """
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self._sessions = {}
+
+        self.requests = 0
+        self.batches = 0
+
+    async def submit(self, session_id, item):
+        """Queue `item` for its session and wait for the result of the batch it ends up in."""
+        queue = self._sessions.get(session_id)
+        if queue is None:
+            queue = self._sessions[session_id] = _SessionQueue()
+        future = asyncio.get_running_loop().create_future()
+        queue.items.append((item, future, tracing.current_span()))
+        self.requests += 1
+        if queue.worker is None:
+            queue.worker = asyncio.create_task(self._work(session_id, queue))
+        return await future
+
+    def stats(self):
+        return {
+            "sessions": len(self._sessions),
+            "waiting": sum(len(queue.items) for queue in self._sessions.values()),
+            "requests": self.requests,
+            "batches": self.batches,
+        }
+
+    async def _work(self, session_id, queue):
+        while queue.items:
+            batch, queue.items = queue.items[:self.max_batch], queue.items[self.max_batch:]
+            # Requests whose callers gave up are dropped before anything is spent on them
+            batch = [(item, future, span) for item, future, span in batch if not future.done()]
+            if not batch:
+                continue
+            self.batches += 1
+            spans = [span for _, _, span in batch if span is not None]
+            try:
+                with tracing.span("session.batch", attributes={"batch.size": len(batch)},
+                                  parent=spans[0] if spans else None, links=spans[1:]):
+                    results = await self.run_batch(session_id, [item for item, _, _ in batch])
+            except Exception as e:
+                logger.error(f"Batch of {len(batch)} requests failed for session {session_id}: {e}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results or [None] * len(batch)):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        # Nothing is awaited between the emptiness check and this, so no request can slip in unseen
+        del self._sessions[session_id]
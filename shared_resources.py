@@ -0,0 +1,202 @@
+import asyncio
+import os
+
+import asyncpg
+
+import metrics
+import tracing
+from embedding_cache import EmbeddingCache
+from llm_gateway import LLMGateway
+from memory_backend import CachingMemoryBackend, LocalMemoryBackend, ZepMemoryBackend
+from memory_writer import MemoryWriteQueue
+from rate_limiter import MemoryRateLimitBackend, PostgresRateLimitBackend, RateLimiter
+from search_index import SearchIndex
+from vector_store import LocalVectorStore
+from zep_async import AsyncZepClient
+
+
+# Process-wide clients, pools and caches shared by the platform modules.
+# Each bot asks for what it needs; when several bots run in one process
+# (see main.py) the same settings resolve to the same instance, so they share
+# one Zep client, one write-behind queue, one embedding cache, one LLM
+# gateway, one rate limiter, one search index, one memory backend, one
+# metrics endpoint, one trace exporter and one Postgres pool per database.
+# Counts the shared components already keep are exported as metrics read at
+# scrape time.
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # "memory" (per process) or "postgres" (shared by every process)
+
+_zep_clients = {}
+_memory_writers = {}
+_embedding_caches = {}
+_llm_gateway = None
+_rate_limiter = None
+_rate_limiter_users = 0
+_rate_limiter_lock = asyncio.Lock()
+_metrics_server = None
+_tracer_configured = False
+_search_indexes = {}
+_memory_backends = {}
+_pg_pools = {}  # connection settings -> [pool, users]
+_pg_lock = asyncio.Lock()
+
+
+def get_zep_client(base_url, api_key=None, timeout=5.0, max_workers=4):
+    # The first caller's timeout wins; every Zep call in the process goes through this facade
+    key = (base_url, api_key)
+    if key not in _zep_clients:
+        _zep_clients[key] = AsyncZepClient(base_url, api_key=api_key, timeout=timeout, max_workers=max_workers)
+    return _zep_clients[key]
+
+
+def get_memory_writer(zep_client, batch_size=10, flush_interval=1.0, max_pending=1000):
+    # The first caller's settings win; later callers share the running queue
+    key = id(zep_client)
+    if key not in _memory_writers:
+        writer = _memory_writers[key] = MemoryWriteQueue(zep_client, batch_size=batch_size,
+                                                         flush_interval=flush_interval, max_pending=max_pending)
+        metrics.gauge("memory_write_queue_depth", "Messages waiting for the Zep write-behind queue").set_function(
+            writer.qsize)
+        metrics.counter("memory_messages_written_total", "Messages written to Zep").set_function(
+            lambda: writer.messages_written)
+        metrics.counter("memory_failed_batches_total", "Zep write batches that failed").set_function(
+            lambda: writer.failed_batches)
+        metrics.counter("memory_messages_dropped_total", "Messages lost in failed Zep write batches").set_function(
+            lambda: writer.messages_dropped)
+    return _memory_writers[key]
+
+
+def get_embedding_cache(ttl=3600, max_bytes=64 * 1024 * 1024, path=None):
+    if path not in _embedding_caches:
+        cache = _embedding_caches[path] = EmbeddingCache(ttl=ttl, max_bytes=max_bytes, path=path)
+        lookups = metrics.counter("embedding_cache_lookups_total", "Embedding cache lookups by result", ("result",))
+        lookups.labels("memory_hit").set_function(lambda: cache.hits)
+        lookups.labels("disk_hit").set_function(lambda: cache.disk_hits)
+        lookups.labels("miss").set_function(lambda: cache.misses)
+    return _embedding_caches[path]
+
+
+def get_search_index(zep_client, memory_writer=None, max_sessions=200):
+    key = id(zep_client)
+    if key not in _search_indexes:
+        index = _search_indexes[key] = SearchIndex(zep_client, memory_writer=memory_writer, max_sessions=max_sessions)
+        metrics.gauge("search_index_sessions", "Sessions held by the full-text search index").set_function(
+            lambda: index.stats()["sessions"])
+    return _search_indexes[key]
+
+
+def get_memory_backend(kind, zep_client, memory_writer, embed=None, path=None, **store_kwargs):
+    """`kind` is "zep" (remote only), "local" (in-process vector store) or "cached" (local mirror in front of Zep)."""
+    key = (kind, id(zep_client), path)
+    if key not in _memory_backends:
+        remote = ZepMemoryBackend(zep_client, embed)
+        if kind == "zep":
+            backend = remote
+        elif kind in ("local", "cached"):
+            local = LocalMemoryBackend(LocalVectorStore(path, **store_kwargs), embed)
+            backend = local if kind == "local" else CachingMemoryBackend(local, remote, zep_client)
+            memory_writer.add_mirror(backend)
+        else:
+            raise ValueError(f"Unknown memory backend: {kind}")
+        _memory_backends[key] = backend
+    return _memory_backends[key]
+
+
+def get_llm_gateway(**kwargs):
+    # One gateway per process, so the concurrency and RPM/TPM budgets cover every bot
+    global _llm_gateway
+    if _llm_gateway is None:
+        gateway = _llm_gateway = LLMGateway(**kwargs)
+        metrics.counter("llm_requests_total", "Chat completions sent").set_function(lambda: gateway.request_count)
+        coalesced = metrics.counter("llm_coalesced_total", "Chat completions answered by an identical in-flight request")
+        coalesced.set_function(lambda: gateway.coalesced_count)
+        metrics.gauge("llm_in_flight", "Non-streamed chat completions in flight").set_function(
+            lambda: gateway.stats()["in_flight"])
+    return _llm_gateway
+
+
+def get_rate_limiter():
+    # One limiter per process, so a global budget covers every bot
+    global _rate_limiter
+    if _rate_limiter is None:
+        limiter = _rate_limiter = RateLimiter()
+        decisions = metrics.counter("rate_limit_decisions_total", "Rate limit checks by outcome", ("result",))
+        decisions.labels("allowed").set_function(lambda: limiter.allowed)
+        decisions.labels("refused").set_function(lambda: limiter.refused)
+        decisions.labels("backend_error").set_function(lambda: limiter.errors)
+    return _rate_limiter
+
+
+async def start_rate_limiter(**connect_kwargs):
+    """Put RATE_LIMIT_BACKEND behind the shared limiter; `connect_kwargs` reach Postgres if that is the backend.
+
+    Every bot calls this on startup and stop_rate_limiter() on shutdown; the
+    first one sets the backend up and the last one tears it down.
+    """
+    global _rate_limiter_users
+    limiter = get_rate_limiter()
+    async with _rate_limiter_lock:
+        if _rate_limiter_users == 0:
+            if RATE_LIMIT_BACKEND == "postgres":
+                backend = PostgresRateLimitBackend(await acquire_pg_pool(**connect_kwargs))
+                await backend.initialize()
+                limiter.backend = backend
+            elif RATE_LIMIT_BACKEND != "memory":
+                raise ValueError(f"Unknown rate limit backend: {RATE_LIMIT_BACKEND}")
+        _rate_limiter_users += 1
+    return limiter
+
+
+async def stop_rate_limiter():
+    global _rate_limiter_users
+    async with _rate_limiter_lock:
+        _rate_limiter_users -= 1
+        if _rate_limiter_users > 0:
+            return
+        backend, _rate_limiter.backend = _rate_limiter.backend, MemoryRateLimitBackend()
+        await backend.close()
+        if isinstance(backend, PostgresRateLimitBackend):
+            await release_pg_pool(backend.pool)
+
+
+def get_metrics_server(port=9100):
+    # One endpoint per process; the first caller's port wins, offset by the runtime process index (see main.py)
+    global _metrics_server
+    if _metrics_server is None:
+        _metrics_server = metrics.MetricsServer(port + int(os.getenv("RUNTIME_PROCESS_INDEX", "0")))
+    return _metrics_server
+
+
+def get_tracer(exporter=None, path=None, endpoint=None, service_name="chatbot", sample_rate=1.0):
+    # Spans from every module go to tracing.TRACER; the first bot to ask sets where they are exported
+    global _tracer_configured
+    if not _tracer_configured:
+        _tracer_configured = True
+        tracer = tracing.TRACER
+        tracer.exporter = tracing.create_exporter(exporter, path=path, endpoint=endpoint)
+        tracer.service_name = service_name
+        tracer.sample_rate = sample_rate
+        spans = metrics.counter("trace_spans_total", "Finished spans by what became of them", ("result",))
+        spans.labels("exported").set_function(lambda: tracer.spans_exported)
+        spans.labels("dropped").set_function(lambda: tracer.spans_dropped)
+    return tracing.TRACER
+
+
+async def acquire_pg_pool(**connect_kwargs):
+    key = tuple(sorted(connect_kwargs.items()))
+    async with _pg_lock:
+        if key not in _pg_pools:
+            _pg_pools[key] = [await asyncpg.create_pool(**connect_kwargs), 0]
+        _pg_pools[key][1] += 1
+        return _pg_pools[key][0]
+
+
+async def release_pg_pool(pool):
+    async with _pg_lock:
+        for key, entry in list(_pg_pools.items()):
+            if entry[0] is pool:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del _pg_pools[key]
+                    await pool.close()
+                return
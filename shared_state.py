@@ -0,0 +1,65 @@
+import json
+from collections import deque
+
+
+# State that has to be the same for every shard of a bot, wherever it runs.
+# MemorySharedState is enough while all shards live in one process (an
+# AutoShardedBot runs them on one event loop); PostgresSharedState lets
+# processes that each run a range of shards see the same recent prompts (rate
+# limits are shared the same way through shared_resources.RATE_LIMIT_BACKEND).
+# Per-session state such as summary activity does not need this: a channel
+# belongs to one guild, and a guild is always served by the same shard.
+
+
+class MemorySharedState:
+    def __init__(self):
+        self._recent = {}
+
+    async def initialize(self):
+        pass
+
+    async def push_recent(self, key, value, limit):
+        """Append a JSON-serializable `value` to the `key` list, keeping only the newest `limit` values."""
+        values = self._recent.get(key)
+        if values is None or values.maxlen != limit:
+            values = self._recent[key] = deque(values or (), maxlen=limit)
+        values.append(value)
+
+    async def recent(self, key, limit):
+        """Return up to `limit` of the newest values pushed to `key`, oldest first."""
+        return list(self._recent.get(key, ()))[-limit:]
+
+
+class PostgresSharedState:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def initialize(self):
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS shared_recent (
+                    id BIGSERIAL PRIMARY KEY,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL
+                )
+            ''')
+            await conn.execute('CREATE INDEX IF NOT EXISTS shared_recent_key ON shared_recent (key, id)')
+
+    async def push_recent(self, key, value, limit):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('INSERT INTO shared_recent (key, value) VALUES ($1, $2)', key, json.dumps(value))
+                await conn.execute('''
+                    DELETE FROM shared_recent
+                    WHERE key = $1 AND id <= (
+                        SELECT id FROM shared_recent WHERE key = $1 ORDER BY id DESC OFFSET $2 LIMIT 1
+                    )
+                ''', key, limit)
+
+    async def recent(self, key, limit):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                'SELECT value FROM shared_recent WHERE key = $1 ORDER BY id DESC LIMIT $2',
+                key, limit
+            )
+        return [json.loads(row['value']) for row in reversed(rows)]
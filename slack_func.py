@@ -1,13 +1,19 @@
 import os
 from dotenv import load_dotenv
-from slack_bolt import App
-from slack_bolt.adapter.flask import SlackRequestHandler
-from flask import Flask, request
+from slack_bolt.async_app import AsyncApp
+from aiohttp import web
 import openai
-from zep_python import ZepClient, MemorySearchPayload
-from zep_python.memory import Memory, Message
+from zep_python.memory import Message
+import metrics
+import tracing
+from rate_limiter import RateLimit
+from shared_resources import (get_llm_gateway, get_memory_writer, get_rate_limiter, get_search_index, get_tracer,
+                              get_zep_client, start_rate_limiter, stop_rate_limiter)
+from response_streaming import StreamingMessageEditor
 from datetime import datetime
+import asyncio
 import logging
+import re
 import traceback
 
 # Load environment variables
@@ -18,73 +24,255 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 logger = logging.getLogger(__name__)
 
 # Initialize Slack app
-app = App(token=os.environ["SLACK_BOT_TOKEN"])
+app = AsyncApp(token=os.environ["SLACK_BOT_TOKEN"])
 
 # Set OpenAI API key
 openai.api_key = os.environ["OPENAI_API_KEY"]
 
 # Initialize Zep client
-zep_client = ZepClient(base_url=os.environ["ZEP_API_URL"], api_key=os.environ["ZEP_API_KEY"])
-
-# Initialize Flask app
-flask_app = Flask(__name__)
-handler = SlackRequestHandler(app)
+zep_client = get_zep_client(os.environ["ZEP_API_URL"], os.environ["ZEP_API_KEY"])
 
 # Constants
 RESPONSE_GENERATION_MODEL = "gpt-4o-mini"
-
-def get_session_messages(session_id: str):
+BATCH_SIZE = 10  # Number of messages coalesced into one Zep write
+MEMORY_FLUSH_INTERVAL = 1.0  # Seconds a queued message may wait before it is written to Zep
+MEMORY_QUEUE_SIZE = 1000  # Maximum queued Zep writes before handlers wait for the writer to catch up
+STREAM_RESPONSES = True  # Stream replies into the "Thinking..." message as tokens arrive
+STREAM_EDIT_INTERVAL = 1.0  # Minimum seconds between chat_update calls on a streamed message
+SLACK_MESSAGE_LIMIT = 4000  # Characters per message before a streamed reply rolls over into a new one
+SLACK_WORKER_COUNT = 16  # Events processed concurrently per process
+SLACK_EVENT_QUEUE_SIZE = 500  # Events waiting for a worker before new ones are shed
+SLACK_PORT = int(os.getenv("SLACK_PORT", "5001"))
+SEARCH_INDEX_SESSIONS = 200  # Sessions whose full-text search index is kept in memory
+LLM_MAX_CONCURRENCY = 16  # Chat completions in flight at once across the process
+LLM_REQUESTS_PER_MINUTE = 3500  # OpenAI request budget the gateway paces to
+LLM_TOKENS_PER_MINUTE = 200000  # OpenAI token budget the gateway paces to
+LLM_TIMEOUT = 60  # Seconds before a chat completion request is abandoned
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER")  # "file", "otlp", or unset to record no traces
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")  # OTLP/JSON lines written by the file exporter
+TRACE_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")  # Collector for the otlp exporter
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))  # Share of inbound messages that get traced
+
+# Rate limiting; the PostgreSQL settings are only used when RATE_LIMIT_BACKEND is "postgres"
+RATE_LIMIT_MESSAGES = 30  # Maximum bot replies per user per minute
+BURST_ALLOWANCE = 5  # Number of rapid requests allowed before rate limiting kicks in
+RATE_LIMIT_CHANNEL_MESSAGES = 60  # Maximum bot replies per channel per minute
+RATE_LIMIT_LLM_REQUESTS = 600  # Maximum bot replies per minute across all users, channels and bots
+RATE_LIMIT_RESPONSE = "You're doing that too much. Please wait a moment and try again."
+PG_HOST = os.getenv("PG_HOST")
+PG_PORT = os.getenv("PG_PORT")
+PG_USER = os.getenv("PG_USER")
+PG_PASSWORD = os.getenv("PG_PASSWORD")
+PG_DATABASE = os.getenv("PG_DATABASE")
+
+USER_MESSAGE_LIMIT = RateLimit(RATE_LIMIT_MESSAGES, 60, BURST_ALLOWANCE)
+CHANNEL_MESSAGE_LIMIT = RateLimit(RATE_LIMIT_CHANNEL_MESSAGES, 60, BURST_ALLOWANCE)
+LLM_REQUEST_LIMIT = RateLimit(RATE_LIMIT_LLM_REQUESTS, 60, LLM_MAX_CONCURRENCY)
+LLM_BUDGET_KEY = "llm:global"  # Shared with the other bots, so the budget covers all of them
+
+memory_writer = get_memory_writer(zep_client, batch_size=BATCH_SIZE, flush_interval=MEMORY_FLUSH_INTERVAL,
+                                  max_pending=MEMORY_QUEUE_SIZE)
+search_index = get_search_index(zep_client, memory_writer, max_sessions=SEARCH_INDEX_SESSIONS)
+llm_gateway = get_llm_gateway(max_concurrency=LLM_MAX_CONCURRENCY, requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+                              tokens_per_minute=LLM_TOKENS_PER_MINUTE, timeout=LLM_TIMEOUT)
+rate_limiter = get_rate_limiter()
+tracer = get_tracer(TRACE_EXPORTER, path=TRACE_FILE, endpoint=TRACE_OTLP_ENDPOINT, sample_rate=TRACE_SAMPLE_RATE)
+
+
+class EventWorkerPool:
+    """Bounded queue of event jobs drained by a fixed number of worker tasks.
+
+    Listeners only enqueue, so Bolt can ack well inside Slack's 3 second window
+    however long the Zep/OpenAI work takes. When the queue is full new jobs are
+    shed instead of piling up.
+    """
+
+    def __init__(self, size=SLACK_WORKER_COUNT, max_pending=SLACK_EVENT_QUEUE_SIZE):
+        self.size = size
+        self.max_pending = max_pending
+        self.queue = None
+        self.workers = []
+        self.dropped = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.workers = [asyncio.create_task(self._work()) for _ in range(self.size)]
+
+    def submit(self, func, *args):
+        try:
+            self.queue.put_nowait((func, args))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"Event queue full, dropping {func.__name__}")
+            return False
+
+    async def close(self):
+        if self.queue is not None:
+            await self.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "workers": len(self.workers),
+            "dropped": self.dropped,
+        }
+
+    async def _work(self):
+        while True:
+            func, args = await self.queue.get()
+            try:
+                await func(*args)
+            except Exception as e:
+                logger.error(f"Error in {func.__name__}: {str(e)}")
+                logger.error(traceback.format_exc())
+            finally:
+                self.queue.task_done()
+
+
+event_workers = EventWorkerPool()
+metrics.export_stats("slack", "event_workers", event_workers.stats)
+
+
+class BotIdentity:
+    """The bot's own user id and workspace metadata, resolved once via auth.test.
+
+    Mention checks then reduce to a precompiled regex scan. The identity is
+    re-resolved lazily when the client's token changes (token rotation) or
+    after invalidate().
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.user_id = None
+        self.bot_id = None
+        self.team_id = None
+        self.team = None
+        self.url = None
+        self._token = None
+        self._mention_pattern = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def resolved(self):
+        return self.user_id is not None and self._token == self.client.token
+
+    async def resolve(self):
+        if self.resolved:
+            return self
+        async with self._lock:
+            if not self.resolved:
+                token = self.client.token
+                info = await self.client.auth_test()
+                self.user_id = info["user_id"]
+                self.bot_id = info.get("bot_id")
+                self.team_id = info.get("team_id")
+                self.team = info.get("team")
+                self.url = info.get("url")
+                self._mention_pattern = re.compile(rf"<@{re.escape(self.user_id)}(?:\|[^>]*)?>")
+                self._token = token
+                logger.info(f"Resolved bot identity {self.user_id} in team {self.team_id}")
+        return self
+
+    def invalidate(self):
+        self.user_id = None
+
+    async def is_mentioned(self, text):
+        await self.resolve()
+        return bool(self._mention_pattern.search(text))
+
+
+bot_identity = BotIdentity(app.client)
+
+
+async def get_session_messages(session_id: str):
     try:
-        messages = zep_client.message.get_session_messages(session_id)
+        await memory_writer.flush(session_id)
+        messages = await zep_client.message.aget_session_messages(session_id)
         return messages
     except Exception as e:
         logger.error(f"Error retrieving session messages: {str(e)}")
         return []
 
-def add_memory(session_id: str, memory: Memory):
+async def add_memory(session_id: str, message: Message):
     try:
-        zep_client.memory.add_memory(session_id, memory)
+        await memory_writer.add(session_id, message, metadata={"session_id": session_id})
+        search_index.add(session_id, message.role, message.content, message.uuid)
     except Exception as e:
         logger.error(f"Error adding memory: {str(e)}")
 
 @app.event("message")
-def handle_message(event, say):
+async def handle_message(event, say):
+    # Bolt acks the event before listeners run; the work itself goes to the worker pool
+    event_workers.submit(process_message_event, event, say)
+
+
+async def process_message_event(event, say):
+    # One trace per inbound message; every stage below it opens a child span
+    with tracing.span("slack.message", tracing.KIND_SERVER, {
+        "platform": "slack",
+        "messaging.message.id": event.get("ts"),
+        "messaging.channel.id": event.get("channel")
+    }):
+        await handle_message_event(event, say)
+
+
+async def handle_message_event(event, say):
     try:
         channel_id = event["channel"]
         user_id = event.get("user", "Unknown")
         text = event.get("text", "")
         timestamp = datetime.fromtimestamp(float(event["ts"])).strftime("%Y.%m.%d")
 
-        logger.info(f"Received message in channel {channel_id} from user {user_id}: {text}")
+        # Message text stays out of the logs
+        logger.debug(f"Received message in channel {channel_id} from user {user_id} ({len(text)} chars)")
+        metrics.MESSAGES_TOTAL.labels("slack").inc()
 
         # Generate a session_id based on channel_id
         session_id = f"slack_channel_{channel_id}"
+        tracing.set_attribute("session.id", session_id)
 
-        # Save message to Zep memory
-        user_memory = Memory(
-            messages=[Message(role="user", content=f"{user_id} ({timestamp}): {text}", timestamp=timestamp)],
-            metadata={"session_id": session_id}
-        )
-        add_memory(session_id, user_memory)
+        # Queue message for Zep memory
+        with tracing.span("memory_enqueue"):
+            await add_memory(session_id, Message(role="user", content=f"{user_id} ({timestamp}): {text}", timestamp=timestamp))
 
         # Check if the bot is mentioned
-        if app.client.auth_test()["user_id"] in text:
-            handle_bot_mention(event, say, session_id)
+        if await bot_identity.is_mentioned(text):
+            # Every mention is a paid completion: charge the user, the channel and the global budget
+            with tracing.span("rate_limit") as span:
+                decision = await rate_limiter.hit(
+                    (USER_MESSAGE_LIMIT, f"slack:user:{user_id}"),
+                    (CHANNEL_MESSAGE_LIMIT, f"slack:channel:{channel_id}"),
+                    (LLM_REQUEST_LIMIT, LLM_BUDGET_KEY)
+                )
+                span.set_attribute("rate_limit.allowed", decision.allowed)
+            if not decision.allowed:
+                metrics.MENTIONS_TOTAL.labels("slack", "rate_limited").inc()
+                await say(RATE_LIMIT_RESPONSE)
+                return
+            with metrics.MENTION_SECONDS.labels("slack").time(), tracing.span("mention"):
+                await handle_bot_mention(event, say, session_id)
 
     except Exception as e:
+        metrics.ERRORS_TOTAL.labels("slack", "handle_message").inc()
         logger.error(f"Error in handle_message: {str(e)}")
         logger.error(traceback.format_exc())
 
 
-def handle_bot_mention(event, say, session_id):
+async def handle_bot_mention(event, say, session_id):
     try:
         channel_id = event["channel"]
         text = event["text"]
 
-        thinking_message = say("Thinking...")
-
-        # Retrieve chat history
-        messages = get_session_messages(session_id)
+        # Post the placeholder and fetch chat history at the same time
+        with metrics.stage("slack", "history_fetch"), tracing.span("history_fetch"):
+            thinking_message, messages = await asyncio.gather(
+                say("Thinking..."),
+                get_session_messages(session_id)
+            )
         chat_history = "\n".join([f"{m.role}: {m.content}" for m in messages])
 
         gpt_messages = [
@@ -92,75 +280,111 @@ def handle_bot_mention(event, say, session_id):
             {"role": "user", "content": f"Chat history:\n{chat_history}\n\nUser: {text}"}
         ]
 
-        response = openai.ChatCompletion.create(
-            model=RESPONSE_GENERATION_MODEL,
-            messages=gpt_messages
-        )
-
-        reply_text = response.choices[0].message.content.strip()
+        if STREAM_RESPONSES:
+            reply_text = await stream_reply(channel_id, thinking_message['ts'], gpt_messages, say)
+        else:
+            reply_text = (await llm_gateway.chat_text(RESPONSE_GENERATION_MODEL, gpt_messages)).strip()
 
-        # Update the thinking message with the generated response
-        app.client.chat_update(
-            channel=channel_id,
-            ts=thinking_message['ts'],
-            text=reply_text
-        )
+            # Update the thinking message with the generated response
+            with metrics.stage("slack", "platform_send"), tracing.span("platform_send"):
+                await app.client.chat_update(
+                    channel=channel_id,
+                    ts=thinking_message['ts'],
+                    text=reply_text
+                )
 
         current_timestamp = datetime.utcnow().strftime("%Y.%m.%d")
-        # Save bot's response to Zep memory
-        bot_memory = Memory(
-            messages=[Message(role="assistant", content=f"({current_timestamp}): {reply_text}", timestamp=current_timestamp)],
-            metadata={"session_id": session_id}
-        )
-        add_memory(session_id, bot_memory)
+        # Queue bot's response for Zep memory
+        await add_memory(session_id, Message(role="assistant", content=f"({current_timestamp}): {reply_text}", timestamp=current_timestamp))
+        metrics.MENTIONS_TOTAL.labels("slack", "answered").inc()
 
     except Exception as e:
+        metrics.MENTIONS_TOTAL.labels("slack", "failed").inc()
         logger.error(f"Error in handle_bot_mention: {str(e)}")
         logger.error(traceback.format_exc())
-        say("An error occurred while processing your request. Please try again later.")
+        await say("An error occurred while processing your request. Please try again later.")
+
+async def stream_reply(channel_id, thinking_ts, gpt_messages, say):
+    async def edit(ts, text):
+        with metrics.stage("slack", "platform_send"), tracing.span("platform_send"):
+            await app.client.chat_update(channel=channel_id, ts=ts, text=text)
+
+    async def send(text):
+        return (await say(text))['ts']
+
+    editor = StreamingMessageEditor(
+        thinking_ts,
+        edit=edit,
+        send=send,
+        max_length=SLACK_MESSAGE_LIMIT,
+        min_interval=STREAM_EDIT_INTERVAL
+    )
+    reply_text = await editor.consume(llm_gateway.stream_chat(RESPONSE_GENERATION_MODEL, gpt_messages))
+    return reply_text.strip()
 
 @app.command("/search")
-def search_chat(ack, respond, command):
-    ack()
-    
+async def search_chat(ack, respond, command):
+    await ack()
+    event_workers.submit(run_search, respond, command)
+
+
+async def run_search(respond, command):
     keyword = command['text']
     channel_id = command['channel_id']
     session_id = f"slack_channel_{channel_id}"
 
     if not keyword:
-        respond("Please provide a search keyword. Usage: /search <keyword>")
+        await respond("Please provide a search keyword. Usage: /search <keyword>")
         return
 
-    search_payload = MemorySearchPayload(
-        text=keyword,
-        search_scope="messages",
-        search_type="mmr",
-        mmr_lambda=0.5
-    )
-
     try:
-        search_results = zep_client.memory.search_memory(session_id, search_payload, limit=5)
-        
+        search_results = await search_index.search(session_id, keyword, limit=5, highlight=lambda word: f"*{word}*")
+
         if search_results:
             response = "Search results:\n\n"
             for result in search_results:
-                if result.message:
-                    content = result.message.get('content', 'No content available')
-                    response += f"{content}\n\n"
+                response += f"{result.snippet}\n\n"
         else:
             response = "No results found for the given keyword."
 
-        respond(response)
+        await respond(response)
     except Exception as e:
         logger.error(f"Error in search_chat: {str(e)}")
-        respond("An error occurred while searching. Please try again later.")
-
-# Flask route for Slack events
-@flask_app.route("/slack/events", methods=["POST"])
-def slack_events():
-    return handler.handle(request)
+        await respond("An error occurred while searching. Please try again later.")
+
+
+async def on_startup(web_app):
+    await bot_identity.resolve()
+    await memory_writer.start()
+    await llm_gateway.start()
+    await tracer.start()
+    await start_rate_limiter(
+        host=PG_HOST,
+        port=PG_PORT,
+        user=PG_USER,
+        password=PG_PASSWORD,
+        database=PG_DATABASE
+    )
+    await event_workers.start()
+
+async def on_cleanup(web_app):
+    await event_workers.close()
+    await memory_writer.close()
+    await llm_gateway.close()
+    await tracer.close()
+    await stop_rate_limiter()
+
+def create_web_app():
+    # Entry point for multi-core serving, e.g.
+    #   gunicorn "slack_func:create_web_app()" --worker-class aiohttp.GunicornWebWorker --workers 4
+    web_app = app.web_app(path="/slack/events")
+    web_app.on_startup.append(on_startup)
+    web_app.on_cleanup.append(on_cleanup)
+    # Each gunicorn worker has its own registry, so scrape workers individually or run one
+    web_app.router.add_get("/metrics", metrics.handle_metrics)
+    return web_app
 
 # Main execution
 if __name__ == "__main__":
     print("Starting the Slack bot server...")
-    flask_app.run(port=5001)
\ No newline at end of file
+    web.run_app(create_web_app(), port=SLACK_PORT)
@@ -1,3 +1,4 @@
+import sys
 import time
 import subprocess
 from watchdog.observers import Observer
@@ -15,7 +16,7 @@ class MyHandler(FileSystemEventHandler):
             self.restart_bot()
 
     def start_bot(self):
-        self.process = subprocess.Popen(['/New Work/mutil-platform-chatbot/venv/Scripts/python.exe', 'slack_func.py'])
+        self.process = subprocess.Popen([sys.executable, 'main.py'])
 
     def restart_bot(self):
         if self.process:
@@ -0,0 +1,276 @@
+import asyncio
+import itertools
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+# Background summarization, off the message hot path.
+# Handlers only call record(), which updates in-memory counters. A session that
+# crosses a threshold is scheduled after it has been quiet for `debounce`
+# seconds (but never later than `max_delay` after it first qualified), and the
+# due sessions are drained by a small worker pool, busiest channel first.
+# Each session's watermark (how far it has been summarized) is persisted in
+# Postgres, so a job only fetches messages newer than the last summary. On
+# startup the counters are seeded from what each session gained past its
+# watermark, so a quiet channel still comes due after a restart, and a
+# session that was never summarized counts as overdue as soon as it has
+# messages.
+
+SUMMARY_PAGE_SIZE = 100  # Messages per Zep page when fetching past the watermark
+
+
+@dataclass
+class SummaryWatermark:
+    message_count: int = 0  # messages summarized so far
+    last_message_uuid: Optional[str] = None
+    last_message_at: Optional[str] = None  # Zep created_at of the newest summarized message
+    summarized_at: Optional[datetime] = None
+
+
+class PostgresWatermarkStore:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def initialize(self):
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS summary_watermarks (
+                    session_id TEXT PRIMARY KEY,
+                    message_count INTEGER NOT NULL,
+                    last_message_uuid TEXT,
+                    last_message_at TEXT,
+                    summarized_at TIMESTAMPTZ NOT NULL
+                )
+            ''')
+
+    async def load_all(self):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('SELECT * FROM summary_watermarks')
+        return {
+            row['session_id']: SummaryWatermark(row['message_count'], row['last_message_uuid'],
+                                                row['last_message_at'], row['summarized_at'])
+            for row in rows
+        }
+
+    async def save(self, session_id, watermark):
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO summary_watermarks (session_id, message_count, last_message_uuid, last_message_at, summarized_at)
+                VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT (session_id) DO UPDATE SET
+                    message_count = EXCLUDED.message_count,
+                    last_message_uuid = EXCLUDED.last_message_uuid,
+                    last_message_at = EXCLUDED.last_message_at,
+                    summarized_at = EXCLUDED.summarized_at
+            ''', session_id, watermark.message_count, watermark.last_message_uuid,
+                watermark.last_message_at, watermark.summarized_at)
+
+
+class _SessionActivity:
+    def __init__(self):
+        self.pending_messages = 0
+        self.pending_chars = 0
+        self.heat = 0.0  # exponentially decayed message rate
+        self.updated = time.monotonic()
+        self.first_due = None
+        self.timer = None
+
+
+class SummaryScheduler:
+    def __init__(self, zep_client, memory_writer, summarize, store, workers=2, debounce=30.0, max_delay=300.0,
+                 max_messages=75, max_chars=12000, max_age_hours=24, max_batch=500, heat_half_life=600.0):
+        """`summarize(session_id, messages)` returns how many of the messages, from the front, it summarized."""
+        self.zep_client = zep_client
+        self.memory_writer = memory_writer
+        self.summarize = summarize
+        self.store = store
+        self.workers = workers
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_messages = max_messages
+        self.max_chars = max_chars
+        self.max_age_hours = max_age_hours
+        self.max_batch = max_batch
+        self.heat_half_life = heat_half_life
+
+        self.watermarks = {}
+        self._activity = {}
+        self._queue = None
+        self._queued = set()
+        self._running = set()
+        self._tasks = []
+        self._order = itertools.count()
+
+        self.jobs_run = 0
+        self.jobs_failed = 0
+
+    async def start(self):
+        if self._tasks:
+            return
+        await self.store.initialize()
+        self.watermarks = await self.store.load_all()
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._seed()))
+
+    def record(self, session_id, text):
+        activity = self._activity.get(session_id)
+        if activity is None:
+            activity = self._activity[session_id] = _SessionActivity()
+
+        now = time.monotonic()
+        activity.heat = activity.heat * 0.5 ** ((now - activity.updated) / self.heat_half_life) + 1.0
+        activity.updated = now
+        activity.pending_messages += 1
+        activity.pending_chars += len(text)
+
+        if self._queue is not None and self._is_due(session_id, activity):
+            self._debounce(session_id, activity, now)
+
+    async def close(self):
+        for activity in self._activity.values():
+            if activity.timer is not None:
+                activity.timer.cancel()
+                activity.timer = None
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def stats(self):
+        return {
+            "queued": len(self._queued),
+            "running": len(self._running),
+            "jobs_run": self.jobs_run,
+            "jobs_failed": self.jobs_failed,
+        }
+
+    def _is_due(self, session_id, activity):
+        if activity.pending_messages == 0:
+            return False
+        if activity.pending_messages >= self.max_messages or activity.pending_chars >= self.max_chars:
+            return True
+        watermark = self.watermarks.get(session_id)
+        if watermark is None or watermark.summarized_at is None:
+            # Never summarized: overdue as soon as there is anything to summarize
+            return True
+        age = datetime.now(timezone.utc) - watermark.summarized_at
+        return age.total_seconds() / 3600 >= self.max_age_hours
+
+    async def _seed(self):
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def seed(session_id, watermark):
+            async with semaphore:
+                try:
+                    messages = await self._fetch_since(session_id, watermark)
+                except Exception as e:
+                    logger.warning(f"Could not count unsummarized messages for session {session_id}: {e}")
+                    return
+            # A job that ran meanwhile has already accounted for these messages
+            if not messages or session_id in self._running or self.watermarks.get(session_id) is not watermark:
+                return
+            activity = self._activity.get(session_id)
+            if activity is None:
+                activity = self._activity[session_id] = _SessionActivity()
+            # Messages recorded since startup are in Zep too, so they are not added on top
+            activity.pending_messages = max(activity.pending_messages, len(messages))
+            activity.pending_chars = max(activity.pending_chars, sum(len(m.content or "") for m in messages))
+            if self._queue is not None and self._is_due(session_id, activity):
+                self._debounce(session_id, activity, time.monotonic())
+
+        await asyncio.gather(*(seed(session_id, watermark) for session_id, watermark in list(self.watermarks.items())))
+
+    def _debounce(self, session_id, activity, now):
+        if session_id in self._queued or session_id in self._running:
+            return
+        if activity.first_due is None:
+            activity.first_due = now
+        if activity.timer is not None:
+            activity.timer.cancel()
+        delay = max(0.0, min(self.debounce, activity.first_due + self.max_delay - now))
+        activity.timer = asyncio.get_running_loop().call_later(delay, self._enqueue, session_id)
+
+    def _enqueue(self, session_id):
+        activity = self._activity[session_id]
+        activity.timer = None
+        if self._queue is None:
+            return
+        self._queued.add(session_id)
+        # Hottest first; PriorityQueue pops the smallest item
+        heat = activity.heat * 0.5 ** ((time.monotonic() - activity.updated) / self.heat_half_life)
+        self._queue.put_nowait((-heat, next(self._order), session_id))
+
+    async def _work(self):
+        while True:
+            _, _, session_id = await self._queue.get()
+            self._queued.discard(session_id)
+            self._running.add(session_id)
+            activity = self._activity[session_id]
+            pending = activity.pending_messages, activity.pending_chars
+            try:
+                remaining = await self._run_job(session_id)
+                self.jobs_run += 1
+                # Whatever arrived while the job ran still counts toward the next summary
+                activity.pending_messages = max(0, activity.pending_messages - pending[0]) + remaining
+                activity.pending_chars = max(0, activity.pending_chars - pending[1])
+                activity.first_due = None
+            except Exception as e:
+                self.jobs_failed += 1
+                logger.error(f"Summary job failed for session {session_id}: {e}")
+            finally:
+                self._running.discard(session_id)
+                self._queue.task_done()
+
+            if self._queue is not None and self._is_due(session_id, activity):
+                self._debounce(session_id, activity, time.monotonic())
+
+    async def _run_job(self, session_id):
+        """Summarize the messages past the watermark; returns how many were left for a later job."""
+        await self.memory_writer.flush(session_id)
+        watermark = self.watermarks.get(session_id) or SummaryWatermark()
+        messages = await self._fetch_since(session_id, watermark)
+        if not messages:
+            return 0
+
+        batch = messages[:self.max_batch]
+        summarized = await self.summarize(session_id, batch)
+        if not summarized:
+            raise RuntimeError("summarizer reported failure")
+
+        newest = batch[summarized - 1]
+        watermark = SummaryWatermark(
+            message_count=watermark.message_count + summarized,
+            last_message_uuid=newest.uuid,
+            last_message_at=newest.created_at,
+            summarized_at=datetime.now(timezone.utc)
+        )
+        await self.store.save(session_id, watermark)
+        self.watermarks[session_id] = watermark
+        return len(messages) - summarized
+
+    async def _fetch_since(self, session_id, watermark):
+        # Start on the page holding the last summarized message and skip everything up to it
+        page = max(watermark.message_count - 1, 0) // SUMMARY_PAGE_SIZE + 1
+        messages = []
+        while True:
+            batch = await self.zep_client.message.aget_session_messages(session_id, limit=SUMMARY_PAGE_SIZE,
+                                                                        cursor=page)
+            messages.extend(batch)
+            if len(batch) < SUMMARY_PAGE_SIZE or len(messages) > self.max_batch + SUMMARY_PAGE_SIZE:
+                break
+            page += 1
+
+        if watermark.last_message_uuid is not None:
+            uuids = [m.uuid for m in messages]
+            if watermark.last_message_uuid in uuids:
+                return messages[uuids.index(watermark.last_message_uuid) + 1:]
+            return [m for m in messages if m.created_at > watermark.last_message_at]
+        return messages
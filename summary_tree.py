@@ -0,0 +1,217 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+from token_budget import count_tokens
+
+
+logger = logging.getLogger(__name__)
+
+
+# Hierarchical, incremental conversation summaries per session.
+# Level 0 nodes summarize fixed-size chunks of `chunk_size` messages; a node at
+# level L+1 rolls up `fanout` closed nodes of level L. Only the newest (open)
+# node of each level ever changes: new messages are folded into the open chunk
+# summary, and a chunk that fills up is folded into its open parent, so the
+# LLM only ever reads new messages or one child summary, plus the summary
+# being updated.
+#
+# Every closed node is covered by its parent, so the coarsest complete view of
+# a session is all top-level nodes plus the open node of each lower level.
+# select() starts there and expands the newest nodes into their children
+# while the token budget allows, giving recent history the most detail.
+
+
+@dataclass
+class SummaryNode:
+    level: int
+    position: int
+    summary: str = ""
+    start_time: Optional[str] = None
+    end_time: Optional[str] = None
+    message_count: int = 0
+    child_count: int = 0
+    closed: bool = False
+    tokens: int = 0
+
+
+class PostgresSummaryNodeStore:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def initialize(self):
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS summary_nodes (
+                    session_id TEXT NOT NULL,
+                    level INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    summary TEXT NOT NULL,
+                    start_time TEXT,
+                    end_time TEXT,
+                    message_count INTEGER NOT NULL,
+                    child_count INTEGER NOT NULL,
+                    closed BOOLEAN NOT NULL,
+                    PRIMARY KEY (session_id, level, position)
+                )
+            ''')
+
+    async def load(self, session_id):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                'SELECT * FROM summary_nodes WHERE session_id = $1 ORDER BY level, position',
+                session_id
+            )
+        return [
+            SummaryNode(row['level'], row['position'], row['summary'], row['start_time'], row['end_time'],
+                        row['message_count'], row['child_count'], row['closed'])
+            for row in rows
+        ]
+
+    async def save(self, session_id, node):
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO summary_nodes (session_id, level, position, summary, start_time, end_time,
+                                           message_count, child_count, closed)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                ON CONFLICT (session_id, level, position) DO UPDATE SET
+                    summary = EXCLUDED.summary,
+                    start_time = EXCLUDED.start_time,
+                    end_time = EXCLUDED.end_time,
+                    message_count = EXCLUDED.message_count,
+                    child_count = EXCLUDED.child_count,
+                    closed = EXCLUDED.closed
+            ''', session_id, node.level, node.position, node.summary, node.start_time, node.end_time,
+                node.message_count, node.child_count, node.closed)
+
+
+class SummaryTree:
+    def __init__(self, summarize, store, model, chunk_size=25, fanout=4, max_sessions=1000):
+        """`summarize(text, previous)` returns a summary of `text` folded into the `previous` summary (or None)."""
+        self.summarize = summarize
+        self.store = store
+        self.model = model
+        self.chunk_size = chunk_size
+        self.fanout = fanout
+        self.max_sessions = max_sessions
+        self._levels = {}  # session_id -> [[nodes of level 0], [nodes of level 1], ...]
+        self._locks = {}
+
+    async def extend(self, session_id, messages):
+        """Fold new messages into the session's tree; returns how many of them were folded in.
+
+        If an update fails part way, the messages folded so far still count and
+        any chunk left without its roll-up is absorbed on the next call.
+        """
+        async with self._lock(session_id):
+            levels = await self._load(session_id)
+            folded = 0
+            try:
+                await self._absorb(session_id, levels)
+                while folded < len(messages):
+                    chunk = self._open_node(levels, 0)
+                    part = messages[folded:folded + self.chunk_size - chunk.message_count]
+                    text = "\n".join(f"{m.role}: {m.content}" for m in part)
+                    await self._update(chunk, text, part[0].created_at, part[-1].created_at)
+                    chunk.message_count += len(part)
+                    chunk.closed = chunk.message_count >= self.chunk_size
+                    await self.store.save(session_id, chunk)
+                    folded += len(part)
+                    if chunk.closed:
+                        await self._absorb(session_id, levels)
+            except Exception as e:
+                # The cached nodes may be ahead of what was persisted; reload them next time
+                self._levels.pop(session_id, None)
+                if not folded:
+                    raise
+                logger.error(f"Summary update for session {session_id} stopped after {folded} messages: {e}")
+            return folded
+
+    async def select(self, session_id, max_tokens):
+        """Return non-overlapping nodes covering the whole session, oldest first, within `max_tokens`."""
+        levels = await self._load(session_id)
+        if not levels or not levels[0]:
+            return []
+
+        # Coarsest complete cover: the top level plus the open node below it on every level
+        cover = list(levels[-1])
+        for nodes in levels[:-1]:
+            if nodes and not nodes[-1].closed:
+                cover.append(nodes[-1])
+        cover.sort(key=lambda node: node.start_time or "")
+
+        used = sum(node.tokens for node in cover)
+        while used > max_tokens and len(cover) > 1:
+            used -= cover.pop(0).tokens  # Even the coarse view is too big; keep the newest part
+
+        # Refine the newest node that still has children while the budget allows
+        index = len(cover) - 1
+        while index >= 0:
+            node = cover[index]
+            if node.level == 0:
+                index -= 1
+                continue
+            first = node.position * self.fanout
+            children = levels[node.level - 1][first:first + node.child_count]
+            extra = sum(child.tokens for child in children) - node.tokens
+            if not children or used + extra > max_tokens:
+                break
+            cover[index:index + 1] = children
+            used += extra
+            index += len(children) - 1
+        return cover
+
+    def format(self, nodes):
+        return "\n\n".join(f"[{node.start_time} - {node.end_time}] {node.summary}" for node in nodes)
+
+    def forget(self, session_id):
+        self._levels.pop(session_id, None)
+
+    async def _absorb(self, session_id, levels):
+        # Fold every closed node not yet in a parent into the open node one level up
+        level = 0
+        while level < len(levels):
+            closed = sum(1 for node in levels[level] if node.closed)
+            absorbed = sum(node.child_count for node in levels[level + 1]) if level + 1 < len(levels) else 0
+            for child in levels[level][absorbed:closed]:
+                parent = self._open_node(levels, level + 1)
+                await self._update(parent, child.summary, child.start_time, child.end_time)
+                parent.message_count += child.message_count
+                parent.child_count += 1
+                parent.closed = parent.child_count >= self.fanout
+                await self.store.save(session_id, parent)
+            level += 1
+
+    async def _update(self, node, text, start_time, end_time):
+        node.summary = await self.summarize(text, node.summary or None)
+        node.tokens = count_tokens(node.summary, self.model)
+        node.start_time = node.start_time or start_time
+        node.end_time = end_time
+
+    def _open_node(self, levels, level):
+        while len(levels) <= level:
+            levels.append([])
+        nodes = levels[level]
+        if not nodes or nodes[-1].closed:
+            nodes.append(SummaryNode(level, len(nodes)))
+        return nodes[-1]
+
+    async def _load(self, session_id):
+        levels = self._levels.get(session_id)
+        if levels is None:
+            levels = []
+            for node in await self.store.load(session_id):
+                node.tokens = count_tokens(node.summary, self.model)
+                while len(levels) <= node.level:
+                    levels.append([])
+                levels[node.level].append(node)
+            self._levels[session_id] = levels
+            while len(self._levels) > self.max_sessions:
+                self._levels.pop(next(iter(self._levels)))
+        return levels
+
+    def _lock(self, session_id):
+        if session_id not in self._locks:
+            self._locks[session_id] = asyncio.Lock()
+        return self._locks[session_id]
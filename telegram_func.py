@@ -5,21 +5,24 @@ import traceback
 from telegram import Update
 from telegram.constants import ChatAction
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 import openai
-from zep_python.memory import Memory, Message
-import uuid
-import asyncio
-from zep_python.exceptions import NotFoundError
+from zep_python.memory import Message
+import functools
 import concurrent.futures
-import re
-import tiktoken
 from datetime import datetime
 from typing import List
-import asyncpg
-from asyncpg.pool import Pool
 
-from zep_python import (ZepClient, MemorySearchPayload)
+import metrics
+import tracing
+from chat_activity import ChatActivityService
+from rate_limiter import RateLimit
+from session_scheduler import SessionScheduler, format_batched_questions, settle, split_batched_answers
+from shared_resources import (get_llm_gateway, get_memory_writer, get_metrics_server, get_rate_limiter, get_search_index,
+                              get_tracer, get_zep_client, start_rate_limiter, stop_rate_limiter)
+from response_streaming import StreamingMessageEditor
+from context_window import ContextAssembler
+from token_budget import count_tokens as count_model_tokens, truncate_to_budget
 # Load environment variables
 load_dotenv()
 
@@ -41,7 +44,6 @@ PG_DATABASE = os.getenv("PG_DATABASE")
 
 # Initialize clients
 openai.api_key = OPENAI_API_KEY
-zep_client = ZepClient(base_url=ZEP_API_URL, api_key=ZEP_API_KEY)
 
 
 
@@ -66,6 +68,15 @@ SUMMARIZATION_MODEL = "gpt-4o-mini"  # Model to use for generating summaries
 RESPONSE_GENERATION_MODEL = "gpt-4o-mini"  # Model to use for generating bot responses
 EMBEDDING_MODEL = "text-embedding-ada-002"  # Model to use for creating embeddings
 
+# Response Streaming
+STREAM_RESPONSES = True  # Stream replies into the "Thinking..." message as tokens arrive
+STREAM_EDIT_INTERVAL = 1.5  # Minimum seconds between edits of a streamed message (Telegram flood limits)
+TYPING_ACTION_INTERVAL = 4.5  # Seconds between typing actions while a reply is generated (Telegram shows one for 5s)
+THINKING_FRAME_INTERVAL = 1.5  # Seconds between frames of the "Thinking..." animation
+THINKING_MAX_INTERVAL = 60  # Longest pause between animation updates after flood waits
+MENTION_BATCH_SIZE = 5  # Most mentions answered by one completion
+TELEGRAM_MESSAGE_LIMIT = 4096  # Maximum characters Telegram accepts in a single message
+
 # Search and Ranking
 SEARCH_RESULT_LIMIT = 100  # Maximum number of results to retrieve from memory search
 MMR_LAMBDA = 0.5  # Lambda parameter for MMR reranking
@@ -98,6 +109,8 @@ RATE_LIMIT_COMMANDS = 20  # Maximum number of commands per user per hour
 COOLDOWN_DURATION = 5  # Seconds a user must wait between using specific commands
 BURST_ALLOWANCE = 5  # Number of rapid requests allowed before rate limiting kicks in
 RATE_LIMIT_RESPONSE = "You're doing that too much. Please wait a moment and try again."
+RATE_LIMIT_CHAT_MESSAGES = 60  # Maximum bot replies per chat per minute
+RATE_LIMIT_LLM_REQUESTS = 600  # Maximum bot replies per minute across all users, chats and bots
 
 # Context Retention
 CONTEXT_RETENTION_MESSAGES = 10  # Number of previous messages to retain for context
@@ -114,89 +127,102 @@ ERROR_LOGGING_LEVEL = "detailed"  # Options: "minimal", "detailed"
 # Performance Optimization
 CACHE_DURATION = 3600  # Seconds to cache embeddings or frequent queries
 BATCH_SIZE = 10  # Number of items to process in a single batch for efficiency
+MEMORY_FLUSH_INTERVAL = 1.0  # Seconds a queued message may wait before it is written to Zep
+MEMORY_QUEUE_SIZE = 1000  # Maximum queued Zep writes before handlers wait for the writer to catch up
+SEARCH_INDEX_SESSIONS = 200  # Sessions whose full-text search index is kept in memory
 ASYNC_PROCESSING = True  # Enable asynchronous processing of non-critical tasks
 
 # Integration with External Services
 ENABLE_WEATHER_API = False  # Toggle integration with weather service
 ENABLE_NEWS_API = False  # Toggle integration with news service
 API_TIMEOUT = 5  # Maximum wait time for external API responses in seconds
-
-class PostgresSessionStorage:
-    def __init__(self):
-        self.pool: Pool = None
-
-    async def initialize(self):
-        self.pool = await asyncpg.create_pool(
-            host=PG_HOST,
-            port=PG_PORT,
-            user=PG_USER,
-            password=PG_PASSWORD,
-            database=PG_DATABASE
+ZEP_EXECUTOR_WORKERS = 4  # Threads for Zep SDK calls that have no native async variant
+LLM_MAX_CONCURRENCY = 16  # Chat completions in flight at once across the process
+LLM_REQUESTS_PER_MINUTE = 3500  # OpenAI request budget the gateway paces to
+LLM_TOKENS_PER_MINUTE = 200000  # OpenAI token budget the gateway paces to
+LLM_TIMEOUT = 60  # Seconds before a chat completion request is abandoned
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # Local port serving /metrics; 0 turns it off
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER")  # "file", "otlp", or unset to record no traces
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")  # OTLP/JSON lines written by the file exporter
+TRACE_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")  # Collector for the otlp exporter
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))  # Share of inbound messages that get traced
+
+# Rate limits, all token buckets refilling at the configured rate and holding BURST_ALLOWANCE requests
+USER_MESSAGE_LIMIT = RateLimit(RATE_LIMIT_MESSAGES, 60, BURST_ALLOWANCE)
+CHAT_MESSAGE_LIMIT = RateLimit(RATE_LIMIT_CHAT_MESSAGES, 60, BURST_ALLOWANCE)
+LLM_REQUEST_LIMIT = RateLimit(RATE_LIMIT_LLM_REQUESTS, 60, LLM_MAX_CONCURRENCY)
+USER_COMMAND_LIMIT = RateLimit(RATE_LIMIT_COMMANDS, 3600, BURST_ALLOWANCE)
+COMMAND_COOLDOWN = RateLimit(1, COOLDOWN_DURATION)
+LLM_BUDGET_KEY = "llm:global"  # Shared with the other bots, so the budget covers all of them
+
+zep_client = get_zep_client(ZEP_API_URL, ZEP_API_KEY, timeout=API_TIMEOUT, max_workers=ZEP_EXECUTOR_WORKERS)
+memory_writer = get_memory_writer(zep_client, batch_size=BATCH_SIZE, flush_interval=MEMORY_FLUSH_INTERVAL,
+                                  max_pending=MEMORY_QUEUE_SIZE)
+context_assembler = ContextAssembler(zep_client, RESPONSE_GENERATION_MODEL, max_tokens=MAX_CONTEXT_TOKENS,
+                                     max_messages=CONTEXT_RETENTION_MESSAGES,
+                                     retention_minutes=CONTEXT_RETENTION_TIME)
+search_index = get_search_index(zep_client, memory_writer, max_sessions=SEARCH_INDEX_SESSIONS)
+rate_limiter = get_rate_limiter()
+llm_gateway = get_llm_gateway(max_concurrency=LLM_MAX_CONCURRENCY, requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+                              tokens_per_minute=LLM_TOKENS_PER_MINUTE, timeout=LLM_TIMEOUT)
+metrics_server = get_metrics_server(METRICS_PORT)
+tracer = get_tracer(TRACE_EXPORTER, path=TRACE_FILE, endpoint=TRACE_OTLP_ENDPOINT, sample_rate=TRACE_SAMPLE_RATE)
+
+
+
+
+
+
+def rate_limit(func):
+    @functools.wraps(func)
+    async def wrapper(update: Update, context):
+        user_id = update.effective_user.id
+        decision = await rate_limiter.hit(
+            (COMMAND_COOLDOWN, f"telegram:cooldown:{user_id}"),
+            (USER_COMMAND_LIMIT, f"telegram:commands:{user_id}")
         )
-        
-        # Create the sessions table if it doesn't exist
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS sessions (
-                    chat_id BIGINT PRIMARY KEY,
-                    session_id UUID NOT NULL
-                )
-            ''')
-
-    async def get_session_id(self, chat_id: int) -> str:
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                'SELECT session_id FROM sessions WHERE chat_id = $1',
-                chat_id
-            )
-            if row:
-                return str(row['session_id'])
-            
-            # If no session exists, create a new one
-            session_id = str(uuid.uuid4())
-            await conn.execute(
-                'INSERT INTO sessions (chat_id, session_id) VALUES ($1, $2)',
-                chat_id, session_id
-            )
-            return session_id
-
-    async def close(self):
-        await self.pool.close()
+        if not decision.allowed:
+            await update.message.reply_text(RATE_LIMIT_RESPONSE)
+            return
+        return await func(update, context)
+    return wrapper
 
-session_storage = PostgresSessionStorage()
 
+async def send_typing(chat):
+    await chat.send_action(ChatAction.TYPING)
 
+async def edit_placeholder(placeholder, text):
+    try:
+        await placeholder.edit_text(text)
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            raise
 
+def flood_wait(error):
+    if not isinstance(error, RetryAfter):
+        return None
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
 
+chat_activity = ChatActivityService(send_typing, edit_placeholder, flood_wait=flood_wait,
+                                    action_interval=TYPING_ACTION_INTERVAL, frame_interval=THINKING_FRAME_INTERVAL,
+                                    max_interval=THINKING_MAX_INTERVAL)
+metrics.export_stats("telegram", "chat_activity", chat_activity.stats)
 
 
 async def start(update: Update, context):
     await update.message.reply_text('Hello! I am your AI assistant. Mention me to ask questions. Use /search <keyword> to search chat logs.')
 
-async def send_typing_periodically(context, chat_id):
-    while True:
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        await asyncio.sleep(4)
-
-async def thinking_animation(message: Message):
-    text = "Thinking"
-    dots = 0
-    while True:
-        try:
-            dots = (dots % 3) + 1  # Cycle through 1, 2, 3 dots
-            await message.edit_text(f"{text}{'.' * dots}")
-            await asyncio.sleep(0.01)  # Wait for 0.1 seconds before the next update
-        except BadRequest as e:
-            if "Message is not modified" in str(e):
-                continue  # If the message didn't change, just continue
-            else:
-                break  # If there's another kind of error, stop the animation
-        except Exception:
-            break  # If any other exception occurs, stop the animation
-
-
-
 async def handle_message(update: Update, context):
+    # One trace per inbound message; every stage below it opens a child span
+    with tracing.span("telegram.message", tracing.KIND_SERVER, {
+        "platform": "telegram",
+        "messaging.message.id": update.message.message_id,
+        "messaging.chat.id": update.message.chat_id
+    }):
+        await process_message(update, context)
+
+async def process_message(update: Update, context):
     try:
         message = update.message
         chat_id = str(message.chat_id)
@@ -204,72 +230,157 @@ async def handle_message(update: Update, context):
         text = message.text
         timestamp = message.date
 
-        logger.info(f"Received message: {text}")
+        # Message text stays out of the logs
+        logger.debug(f"Received message {message.message_id} ({len(text)} chars) in chat {chat_id}")
+        metrics.MESSAGES_TOTAL.labels("telegram").inc()
 
         # Generate a session_id based on chat_id
         session_id = f"telegram_chat_{chat_id}"
-
-        # Save message to Zep memory
-        memory = Memory(
-            messages=[Message(role="user", content=f"{user_id} ({timestamp}): {text}", timestamp=timestamp)],
-            metadata={"session_id": session_id}
-        )
-        logger.debug(f"Adding memory: {memory}")
-        zep_client.memory.add_memory(session_id, memory)
+        tracing.set_attribute("session.id", session_id)
+
+        # Queue message for Zep memory
+        content = f"{user_id} ({timestamp}): {text}"
+        with tracing.span("memory_enqueue"):
+            user_message = Message(role="user", content=content, timestamp=timestamp)
+            await memory_writer.add(session_id, user_message, metadata={"session_id": session_id})
+            search_index.add(session_id, "user", content, user_message.uuid)
         # print(f"Message saved: {text}")
         # print(f"Message saved: {message}")
         # Check if bot is mentioned
         if context.bot.username in text:
             # logger.info("Bot mentioned, generating response...")
-            
-            thinking_message = await update.message.reply_text("Thinking...")
 
-            thinking_task = asyncio.create_task(thinking_animation(thinking_message))
+            # Every mention is a paid completion: charge the user, the chat and the global budget
+            with tracing.span("rate_limit") as span:
+                decision = await rate_limiter.hit(
+                    (USER_MESSAGE_LIMIT, f"telegram:user:{user_id}"),
+                    (CHAT_MESSAGE_LIMIT, f"telegram:chat:{chat_id}"),
+                    (LLM_REQUEST_LIMIT, LLM_BUDGET_KEY)
+                )
+                span.set_attribute("rate_limit.allowed", decision.allowed)
+            if not decision.allowed:
+                metrics.MENTIONS_TOTAL.labels("telegram", "rate_limited").inc()
+                await update.message.reply_text(RATE_LIMIT_RESPONSE)
+                return
 
-            # Retrieve chat history
-            try:
-                messages = await zep_client.message.aget_session_messages(session_id)
-                # logger.info(f"Number of messages in chat history: {len(messages)}")
-                chat_history = "\n".join([f"{m.role}: {m.content}" for m in messages])
-            except NotFoundError:
-                logger.info("Session not found, starting a new conversation")
-                chat_history = ""
-
-            gpt_messages = [
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": f"Chat history:\n{chat_history}\n\nUser: {text}"}
-            ]
+            with tracing.span("platform_send"):
+                thinking_message = await update.message.reply_text("Thinking...")
 
-        
-            response = await openai.ChatCompletion.acreate(
-                model="gpt-4o-mini",
-                messages=gpt_messages
-            )
-
-            reply_text = response.choices[0].message.content.strip()
-            # logger.info(f"Generated response: {reply_text}")
-
-            # Send the generated response
-            thinking_task.cancel()
-            await thinking_message.edit_text(reply_text)
-           
-            current_timestamp = datetime.utcnow()
-            # Save bot's response to Zep memory
-            bot_memory = Memory(
-                   messages=[Message(role="assistant", content=f"({current_timestamp}): {reply_text}", timestamp=current_timestamp)],
-                    metadata={"session_id": session_id}
-                   
-            )
-            zep_client.memory.add_memory(session_id, bot_memory)
+            # Typing action and animated placeholder until the reply lands
+            try:
+                async with chat_activity.activity(message.chat, thinking_message) as activity:
+                    # Mentions in one chat are answered in order, several at a time when they pile up
+                    with metrics.MENTION_SECONDS.labels("telegram").time(), tracing.span("mention"):
+                        await mention_scheduler.submit(session_id, (message, thinking_message, activity))
+                metrics.MENTIONS_TOTAL.labels("telegram", "answered").inc()
+            except Exception as e:
+                metrics.MENTIONS_TOTAL.labels("telegram", "failed").inc()
+                logger.error(f"Error answering mention in session {session_id}: {e}")
+                await thinking_message.edit_text(FALLBACK_RESPONSE)
         else:
-            logger.info("Bot not mentioned, no response generated.")
+            logger.debug("Bot not mentioned, no response generated.")
 
     except Exception as e:
+        metrics.ERRORS_TOTAL.labels("telegram", "handle_message").inc()
         logger.error(f"Error in handle_message: {str(e)}")
         logger.error(traceback.format_exc())
 
 
 
+async def remember_reply(session_id, reply_text):
+    current_timestamp = datetime.utcnow()
+    # Queue bot's response for Zep memory
+    content = f"({current_timestamp}): {reply_text}"
+    message = Message(role="assistant", content=content, timestamp=current_timestamp)
+    await memory_writer.add(session_id, message, metadata={"session_id": session_id})
+    search_index.add(session_id, "assistant", content, message.uuid)
+
+async def send_reply(message, thinking_message, reply_text):
+    chunks = [reply_text[i:i+TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(reply_text), TELEGRAM_MESSAGE_LIMIT)]
+
+    with metrics.stage("telegram", "platform_send"), tracing.span("platform_send"):
+        await thinking_message.edit_text(chunks[0])
+
+        for chunk in chunks[1:]:
+            await message.reply_text(chunk)
+
+async def answer_mention(session_id, chat_history, message, thinking_message, activity):
+    gpt_messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": f"Chat history:\n{chat_history}\n\nUser: {message.text}"}
+    ]
+
+    if STREAM_RESPONSES:
+        # Stream the response into the placeholder, rolling over into new replies
+        await activity.detach()
+
+        async def edit(telegram_message, text):
+            with metrics.stage("telegram", "platform_send"), tracing.span("platform_send"):
+                await telegram_message.edit_text(text)
+
+        editor = StreamingMessageEditor(
+            thinking_message,
+            edit=edit,
+            send=message.reply_text,
+            max_length=TELEGRAM_MESSAGE_LIMIT,
+            min_interval=STREAM_EDIT_INTERVAL
+        )
+        reply_text = (await editor.consume(llm_gateway.stream_chat(RESPONSE_GENERATION_MODEL, gpt_messages))).strip()
+    else:
+        reply_text = (await llm_gateway.chat_text(RESPONSE_GENERATION_MODEL, gpt_messages)).strip()
+        # logger.info(f"Generated response: {reply_text}")
+
+        # Send the generated response
+        await activity.detach()
+        await send_reply(message, thinking_message, reply_text)
+
+    await remember_reply(session_id, reply_text)
+
+async def deliver_answer(session_id, message, thinking_message, activity, answer):
+    await activity.detach()
+    await send_reply(message, thinking_message, answer)
+    await remember_reply(session_id, answer)
+
+async def answer_mentions(session_id, mentions):
+    """Answer (message, thinking_message, activity) mentions that arrived together in one chat.
+
+    Returns one result per mention: None, or the exception that kept it from being answered.
+    """
+    # Retrieve chat history
+    with metrics.stage("telegram", "history_fetch"), tracing.span("history_fetch"):
+        await memory_writer.flush(session_id)
+        window = await context_assembler.build(session_id)
+    chat_history = window.transcript()
+
+    if len(mentions) == 1:
+        return [await settle(answer_mention(session_id, chat_history, *mentions[0]))]
+
+    # Several people asked at once: answer them all with one completion
+    questions = format_batched_questions([f"{message.from_user.id}: {message.text}" for message, _, _ in mentions])
+    gpt_messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": f"Chat history:\n{chat_history}\n\nUser: {questions}"}
+    ]
+    try:
+        answers = split_batched_answers(await llm_gateway.chat_text(RESPONSE_GENERATION_MODEL, gpt_messages),
+                                        len(mentions))
+    except Exception as e:
+        logger.error(f"Error answering {len(mentions)} mentions together in session {session_id}: {e}")
+        answers = None
+
+    if answers is None:
+        # The combined answer could not be split up; answer the questions one by one instead
+        return [await settle(answer_mention(session_id, chat_history, *mention)) for mention in mentions]
+
+    return [await settle(deliver_answer(session_id, message, thinking_message, activity, answer))
+            for (message, thinking_message, activity), answer in zip(mentions, answers)]
+
+mention_scheduler = SessionScheduler(answer_mentions, max_batch=MENTION_BATCH_SIZE)
+metrics.export_stats("telegram", "mention_scheduler", mention_scheduler.stats)
+
+
+
+@rate_limit
 async def search_chat(update: Update, context):
     if not context.args:
         await update.message.reply_text("Please provide a search keyword. Usage: /search <keyword>")
@@ -279,30 +390,16 @@ async def search_chat(update: Update, context):
     chat_id = str(update.message.chat_id)
     session_id = f"telegram_chat_{chat_id}"
 
-    search_payload = MemorySearchPayload(
-        text=keyword,
-        search_scope="messages",
-        search_type="mmr", 
-        mmr_lambda=0.5
-    )
-
     try:
         search_message = await update.message.reply_text("Searching...")
-        search_results = await zep_client.memory.asearch_memory(session_id, search_payload, limit=5)
-        
+        # Highlight matches by making them uppercase and surrounding them with characters
+        search_results = await search_index.search(session_id, keyword, limit=5,
+                                                   highlight=lambda word: f"<<{word.upper()}>>")
+
         if search_results:
             response = "Search results:\n\n"
             for result in search_results:
-                if result.message:
-                    content = result.message.get('content', 'No content available')
-                    # Highlight the keyword by making it uppercase and surrounding it with characters
-                    highlighted_content = re.sub(
-                        f'({re.escape(keyword)})',
-                        lambda m: f"<<{m.group(1).upper()}>>",
-                        content,
-                        flags=re.IGNORECASE
-                    )
-                    response += f"{highlighted_content}\n\n"
+                response += f"{result.snippet}\n\n"
         else:
             response = "No results found for the given keyword."
 
@@ -314,8 +411,7 @@ async def search_chat(update: Update, context):
 
 
 def count_tokens(text: str) -> int:
-    encoding = tiktoken.encoding_for_model(SUMMARIZATION_MODEL)
-    return len(encoding.encode(text))
+    return count_model_tokens(text, SUMMARIZATION_MODEL)
 
 async def summarize_chat(update: Update, context):
     chat_id = str(update.message.chat_id)
@@ -325,26 +421,21 @@ async def summarize_chat(update: Update, context):
         # Retrieve recent messages
         messages = await zep_client.message.aget_session_messages(session_id)
         
-        # Prepare the chat history for summarization
-        chat_history = "\n".join([f"{m.role}: {m.content}" for m in messages])
-        
-        # Truncate the chat history if it's too long
-        while count_tokens(chat_history) > MAX_TOKENS_FOR_SUMMARY:
-            messages = messages[1:]  # Remove the oldest message
-            chat_history = "\n".join([f"{m.role}: {m.content}" for m in messages])
+        # Prepare the chat history for summarization, keeping the newest lines that fit the budget
+        lines = truncate_to_budget([f"{m.role}: {m.content}" for m in messages], MAX_TOKENS_FOR_SUMMARY,
+                                   SUMMARIZATION_MODEL)
+        chat_history = "\n".join(lines)
 
         # Generate summary
         summary_message = await update.message.reply_text("Generating summary...")
 
-        response = await openai.ChatCompletion.acreate(
-            model=SUMMARIZATION_MODEL,
-            messages=[
+        summary = (await llm_gateway.chat_text(
+            SUMMARIZATION_MODEL,
+            [
                 {"role": "system", "content": "You are a helpful assistant tasked with summarizing conversations. Provide a concise summary of the key points discussed."},
                 {"role": "user", "content": f"Please summarize the following conversation:\n\n{chat_history}"}
             ]
-        )
-
-        summary = response.choices[0].message.content.strip()
+        )).strip()
 
         # Send the summary
         await summary_message.edit_text(f"Summary of recent conversation:\n\n{summary}")
@@ -359,9 +450,39 @@ async def summarize_chat(update: Update, context):
 async def error_handler(update: Update, context):
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
 
-def main():
+async def post_init(application: Application):
+    await memory_writer.start()
+    await llm_gateway.start()
+    if METRICS_PORT:
+        await metrics_server.start()
+    await tracer.start()
+    await start_rate_limiter(
+        host=PG_HOST,
+        port=PG_PORT,
+        user=PG_USER,
+        password=PG_PASSWORD,
+        database=PG_DATABASE
+    )
+
+async def post_shutdown(application: Application):
+    await memory_writer.close()
+    await llm_gateway.close()
+    if METRICS_PORT:
+        await metrics_server.close()
+    await tracer.close()
+    await stop_rate_limiter()
+
+def build_application():
     # Create the Application and pass it your bot's token
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        # Handle updates concurrently; mention_scheduler keeps each chat's replies in order
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
 
     application.add_handler(CommandHandler("start", start))
@@ -371,9 +492,11 @@ def main():
 
     # Add error handler
     application.add_error_handler(error_handler)
+    return application
 
+def main():
     # Run the bot
-    application.run_polling()
+    build_application().run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,47 @@
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import accumulate
+
+import tiktoken
+
+
+# Token counting helpers shared by everything that builds a prompt under a
+# token budget. Encoders are expensive to construct, so one is cached per model.
+
+MESSAGE_TOKEN_OVERHEAD = 4  # Tokens the chat format adds around each message
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model):
+    return len(get_encoding(model).encode(text))
+
+
+def count_message_tokens(content, model):
+    return count_tokens(content, model) + MESSAGE_TOKEN_OVERHEAD
+
+
+def truncate_to_budget(texts, max_tokens, model, separator="\n"):
+    """Return the newest suffix of `texts` that fits in `max_tokens` once joined.
+
+    Each text is encoded exactly once; prefix sums of the per-text counts then
+    locate the cut point with a binary search instead of re-encoding the joined
+    history after every dropped message.
+    """
+    texts = list(texts)
+    if not texts:
+        return texts
+
+    separator_tokens = count_tokens(separator, model) if separator else 0
+    prefix = [0, *accumulate(count_tokens(text, model) + separator_tokens for text in texts)]
+    total = prefix[-1] - separator_tokens  # no separator after the last text
+
+    # texts[start:] costs total - prefix[start]; find the smallest start that fits
+    start = bisect_left(prefix, total - max_tokens)
+    return texts[start:]
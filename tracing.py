@@ -0,0 +1,289 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import aiohttp
+
+
+logger = logging.getLogger(__name__)
+
+
+# Request tracing in the OpenTelemetry data model.
+# A span is opened per inbound message and every stage below it (session
+# lookup, memory writes, prompt assembly, Zep and LLM calls, platform sends)
+# opens a child. The current span lives in a context variable, so it follows
+# the work into tasks created while it is active and, through zep_async, into
+# thread-pool offloads. Children copy the platform and session tags of their
+# parent. Finished spans are batched in memory and exported in the background
+# as OTLP/JSON, either appended to a file (one export request per line) or
+# posted to a collector's /v1/traces. Tracing is best effort: a failed export
+# is logged and dropped, and with no exporter configured spans are never
+# recorded.
+
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+INHERITED_ATTRIBUTES = ("platform", "session.id")  # Tags children copy from their parent span
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_CURRENT = object()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class Span:
+    __slots__ = ("tracer", "name", "kind", "trace_id", "span_id", "parent_id", "sampled", "attributes", "events",
+                 "links", "status", "status_message", "start_time", "end_time")
+
+    def __init__(self, tracer, name, kind, trace_id, parent_id, sampled, attributes, links):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes
+        self.events = []
+        self.links = links
+        self.status = STATUS_UNSET
+        self.status_message = ""
+        self.start_time = time.time_ns()
+        self.end_time = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def add_event(self, name, attributes=None):
+        self.events.append((time.time_ns(), name, attributes or {}))
+
+    def record_exception(self, error):
+        self.status = STATUS_ERROR
+        self.status_message = "cancelled" if isinstance(error, asyncio.CancelledError) else str(error)
+        self.add_event("exception", {"exception.type": type(error).__name__, "exception.message": str(error)})
+
+    def end(self):
+        if self.end_time is None:
+            self.end_time = time.time_ns()
+            self.tracer._finish(self)
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": self.status, "message": self.status_message},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.events:
+            span["events"] = [{"timeUnixNano": str(at), "name": name, "attributes": _otlp_attributes(attributes)}
+                              for at, name, attributes in self.events]
+        if self.links:
+            span["links"] = [{"traceId": link.trace_id, "spanId": link.span_id} for link in self.links]
+        return span
+
+
+class FileSpanExporter:
+    def __init__(self, path):
+        self.path = path
+
+    async def export(self, payload):
+        await asyncio.to_thread(self._append, json.dumps(payload, separators=(",", ":")))
+
+    async def close(self):
+        pass
+
+    def _append(self, line):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+class OTLPSpanExporter:
+    def __init__(self, endpoint, headers=None, timeout=10):
+        # Accepts the collector's base URL (http://host:4318) or the full traces URL
+        endpoint = endpoint.rstrip("/")
+        self.url = endpoint if endpoint.endswith("/v1/traces") else endpoint + "/v1/traces"
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+        self._session = None
+
+    async def export(self, payload):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        async with self._session.post(self.url, json=payload, headers=self.headers) as response:
+            response.raise_for_status()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+def create_exporter(kind, path=None, endpoint=None, headers=None):
+    """Build the exporter named by `kind`: "file", "otlp", or None/"" for no export."""
+    if not kind:
+        return None
+    if kind == "file":
+        return FileSpanExporter(path or "traces.jsonl")
+    if kind == "otlp":
+        return OTLPSpanExporter(endpoint or "http://localhost:4318", headers=headers)
+    raise ValueError(f"Unknown trace exporter: {kind}")
+
+
+class Tracer:
+    def __init__(self, exporter=None, service_name="chatbot", sample_rate=1.0, max_batch=512, flush_interval=5.0,
+                 max_pending=10000):
+        self.exporter = exporter
+        self.service_name = service_name
+        self.sample_rate = sample_rate
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._pending = deque(maxlen=max_pending)
+        self._wakeup = None
+        self._task = None
+        self._users = 0
+
+        self.spans_exported = 0
+        self.spans_dropped = 0
+        self.failed_exports = 0
+
+    def start_span(self, name, kind=KIND_INTERNAL, attributes=None, parent=_CURRENT, links=None,
+                   require_parent=False):
+        """Start a span without making it current; the caller must end() it.
+
+        The parent defaults to the current span. Without one a new trace starts,
+        sampled at `sample_rate`, unless `require_parent` is set: then the span
+        (and anything under it) is not recorded, which keeps client calls made
+        by background work from starting traces of their own.
+        """
+        if parent is _CURRENT:
+            parent = _current_span.get()
+        inherited = {}
+        if parent is not None:
+            trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+            inherited = {key: parent.attributes[key] for key in INHERITED_ATTRIBUTES if key in parent.attributes}
+        else:
+            trace_id, parent_id = os.urandom(16).hex(), None
+            sampled = (self.exporter is not None and not require_parent
+                       and (self.sample_rate >= 1.0 or random.random() < self.sample_rate))
+        inherited.update(attributes or {})
+        return Span(self, name, kind, trace_id, parent_id, sampled, inherited, list(links or ()))
+
+    @contextmanager
+    def span(self, name, kind=KIND_INTERNAL, attributes=None, parent=_CURRENT, links=None, require_parent=False):
+        """Run a block inside a new current span, recording any exception that escapes it."""
+        span = self.start_span(name, kind, attributes, parent, links, require_parent)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    async def start(self):
+        # Reference counted like the LLM gateway: the last bot to stop flushes and closes the exporter
+        self._users += 1
+        if self._task is None and self.exporter is not None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self._users = max(0, self._users - 1)
+        if self._users > 0 or self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self.flush()
+        await self.exporter.close()
+
+    async def flush(self):
+        while self._pending and self.exporter is not None:
+            batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+            try:
+                await self.exporter.export(self._payload(batch))
+                self.spans_exported += len(batch)
+            except Exception as e:
+                self.failed_exports += 1
+                self.spans_dropped += len(batch)
+                logger.warning(f"Dropped {len(batch)} spans after a failed export: {e}")
+                return
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "spans_exported": self.spans_exported,
+            "spans_dropped": self.spans_dropped,
+            "failed_exports": self.failed_exports,
+        }
+
+    def _finish(self, span):
+        if not span.sampled:
+            return
+        if len(self._pending) == self._pending.maxlen:
+            self.spans_dropped += 1
+        self._pending.append(span)
+        if len(self._pending) >= self.max_batch and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _payload(self, spans):
+        return {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": self.service_name})},
+            "scopeSpans": [{"scope": {"name": "chatbot"}, "spans": [span.to_otlp() for span in spans]}],
+        }]}
+
+
+TRACER = Tracer()
+span = TRACER.span
+start_span = TRACER.start_span
+
+
+def current_span():
+    """The active span, or None outside any trace."""
+    return _current_span.get()
+
+
+def set_attribute(key, value):
+    """Tag the active span, if there is one."""
+    active = _current_span.get()
+    if active is not None:
+        active.set_attribute(key, value)
@@ -0,0 +1,239 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from context_ranking import rank_indices
+
+
+logger = logging.getLogger(__name__)
+
+
+# In-process vector store for message embeddings, one partition per session.
+# Vectors live in a float32 memory-mapped file per session that grows by
+# doubling, with the message records alongside as JSON lines, so a session is
+# reopened from disk without re-embedding anything. Small sessions are searched
+# exactly; once a session has `ivf_min_size` vectors an IVF index (k-means
+# centroids plus one inverted list per centroid) is trained and only the
+# `nprobe` closest lists are scanned. Results can be diversified with MMR.
+# Everything here is blocking file and numpy work, meant to be called from a
+# worker thread; callers serialize access to each session themselves.
+
+VECTORS_FILE = "vectors.f32"
+RECORDS_FILE = "records.jsonl"
+META_FILE = "meta.json"
+CENTROIDS_FILE = "centroids.npy"
+
+
+def mmr_select(query, candidates, scores, k, mmr_lambda):
+    """Pick `k` rows of `candidates` (normalized vectors) trading relevance against redundancy."""
+    selected = []
+    remaining = list(range(len(candidates)))
+    redundancy = np.full(len(candidates), -np.inf, dtype=np.float32)
+    while remaining and len(selected) < k:
+        rows = np.asarray(remaining)
+        penalty = np.where(np.isfinite(redundancy[rows]), redundancy[rows], 0.0)
+        best = rows[np.argmax(mmr_lambda * scores[rows] - (1 - mmr_lambda) * penalty)]
+        selected.append(int(best))
+        remaining.remove(best)
+        redundancy = np.maximum(redundancy, candidates @ candidates[best])
+    return selected
+
+
+def _kmeans(vectors, clusters, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(clusters):
+            members = vectors[assignment == cluster]
+            if len(members):
+                centroid = members.mean(axis=0)
+                centroids[cluster] = centroid / (np.linalg.norm(centroid) or 1.0)
+    return centroids
+
+
+class SessionVectors:
+    def __init__(self, directory, dim=None, initial_capacity=1024):
+        self.directory = directory
+        self.dim = dim
+        self.records = []
+        self.centroids = None
+        self.lists = []  # per centroid: list of row ids
+        self.trained_size = 0
+        self._matrix = None
+        self._capacity = 0
+        self._initial_capacity = initial_capacity
+        self._load()
+
+    @property
+    def count(self):
+        return len(self.records)
+
+    @property
+    def vectors(self):
+        return self._matrix[:self.count] if self._matrix is not None else np.zeros((0, self.dim or 0), np.float32)
+
+    def add(self, vectors, records):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(os.path.join(self.directory, META_FILE), "w", encoding="utf-8") as f:
+                json.dump({"dim": self.dim}, f)
+        self._reserve(self.count + len(vectors))
+        start = self.count
+        self._matrix[start:start + len(vectors)] = vectors
+        self._matrix.flush()
+        with open(os.path.join(self.directory, RECORDS_FILE), "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        self.records.extend(records)
+        if self.centroids is not None:
+            self._assign(start, vectors)
+
+    def train(self, ivf_min_size, iterations=10):
+        """(Re)build the IVF index when the session is big enough and has doubled since the last build."""
+        if self.count < ivf_min_size or (self.centroids is not None and self.count < 2 * self.trained_size):
+            return False
+        vectors = np.array(self.vectors)
+        clusters = max(1, int(np.sqrt(len(vectors))))
+        sample = vectors if len(vectors) <= clusters * 256 else vectors[
+            np.random.default_rng(0).choice(len(vectors), clusters * 256, replace=False)]
+        self.centroids = _kmeans(sample, clusters, iterations)
+        self.lists = [[] for _ in range(clusters)]
+        self._assign(0, vectors)
+        self.trained_size = len(vectors)
+        np.save(os.path.join(self.directory, CENTROIDS_FILE), self.centroids)
+        return True
+
+    def search(self, query, k=10, nprobe=8, fetch_k=None, mmr_lambda=None, threshold=None):
+        """Return [(row, score)] best first; with `mmr_lambda`, the top `fetch_k` are reranked by MMR."""
+        if not self.count:
+            return []
+        fetch_k = max(k, fetch_k or k)
+
+        if self.centroids is None:
+            rows = np.arange(self.count)
+        else:
+            probes = np.argsort(-(self.centroids @ query))[:nprobe]
+            rows = np.fromiter((row for probe in probes for row in self.lists[probe]), dtype=np.intp)
+            # Vectors added since the last training are in the lists too; nothing else to scan
+        if not len(rows):
+            return []
+
+        candidates = self._matrix[rows]
+        scores = candidates @ query
+        best = rank_indices(scores, k=fetch_k, threshold=threshold)
+        rows, candidates, scores = rows[best], candidates[best], scores[best]
+
+        if mmr_lambda is not None:
+            picked = mmr_select(query, candidates, scores, k, mmr_lambda)
+        else:
+            picked = range(min(k, len(rows)))
+        return [(int(rows[i]), float(scores[i])) for i in picked]
+
+    def close(self):
+        if self._matrix is not None:
+            self._matrix.flush()
+            self._matrix = None
+
+    def _assign(self, start, vectors):
+        assignment = np.argmax(vectors @ self.centroids.T, axis=1)
+        for offset, cluster in enumerate(assignment):
+            self.lists[cluster].append(start + offset)
+
+    def _reserve(self, needed):
+        if needed <= self._capacity:
+            return
+        capacity = max(self._initial_capacity, self._capacity)
+        while capacity < needed:
+            capacity *= 2
+        path = os.path.join(self.directory, VECTORS_FILE)
+        if self._matrix is not None:
+            self._matrix.flush()
+            self._matrix = None
+        with open(path, "ab") as f:
+            f.truncate(capacity * self.dim * 4)
+        self._matrix = np.memmap(path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        self._capacity = capacity
+
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        meta_path = os.path.join(self.directory, META_FILE)
+        records_path = os.path.join(self.directory, RECORDS_FILE)
+        vectors_path = os.path.join(self.directory, VECTORS_FILE)
+        if not all(os.path.exists(path) for path in (meta_path, records_path, vectors_path)):
+            return
+        with open(meta_path, encoding="utf-8") as f:
+            self.dim = json.load(f)["dim"]
+        with open(records_path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        capacity = os.path.getsize(vectors_path) // (self.dim * 4)
+        if not capacity:
+            return
+        # Vectors are flushed before their records, so only a damaged file can hold fewer
+        self.records = records[:capacity]
+        self._matrix = np.memmap(vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        self._capacity = capacity
+
+        centroids_path = os.path.join(self.directory, CENTROIDS_FILE)
+        if os.path.exists(centroids_path):
+            self.centroids = np.load(centroids_path)
+            self.lists = [[] for _ in range(len(self.centroids))]
+            self._assign(0, np.asarray(self.vectors))
+            self.trained_size = self.count
+
+
+class LocalVectorStore:
+    def __init__(self, path, max_open_sessions=256, ivf_min_size=4096, nprobe=8):
+        self.path = path
+        self.max_open_sessions = max_open_sessions
+        self.ivf_min_size = ivf_min_size
+        self.nprobe = nprobe
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()  # guards _sessions across worker threads
+        os.makedirs(path, exist_ok=True)
+
+    def session(self, session_id):
+        with self._lock:
+            partition = self._sessions.get(session_id)
+            if partition is None:
+                partition = self._sessions[session_id] = SessionVectors(self._directory(session_id))
+                while len(self._sessions) > self.max_open_sessions:
+                    self._sessions.popitem(last=False)[1].close()
+            else:
+                self._sessions.move_to_end(session_id)
+            return partition
+
+    def add(self, session_id, vectors, records):
+        """Append normalized `vectors` and their JSON-serializable `records` to the session."""
+        self.session(session_id).add(vectors, records)
+
+    def train(self, session_id):
+        return self.session(session_id).train(self.ivf_min_size)
+
+    def search(self, session_id, query, k=10, fetch_k=None, mmr_lambda=None, threshold=None):
+        """Return [(record, score)] for the best matches of the normalized `query` vector."""
+        partition = self.session(session_id)
+        hits = partition.search(query, k=k, nprobe=self.nprobe, fetch_k=fetch_k, mmr_lambda=mmr_lambda,
+                                threshold=threshold)
+        return [(partition.records[row], score) for row, score in hits]
+
+    def count(self, session_id):
+        return self.session(session_id).count
+
+    def uuids(self, session_id):
+        return {record["uuid"] for record in self.session(session_id).records if record.get("uuid")}
+
+    def close(self):
+        with self._lock:
+            for partition in self._sessions.values():
+                partition.close()
+            self._sessions.clear()
+
+    def _directory(self, session_id):
+        return os.path.join(self.path, re.sub(r"[^\w.-]", "_", session_id))
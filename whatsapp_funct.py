@@ -1,14 +1,21 @@
 import os
 import sys
-import requests
+import asyncio
+import aiohttp
+import asyncpg
 import openai
-import zep_python as zep
 from dotenv import load_dotenv
 from datetime import datetime
-import psycopg2
-from psycopg2 import sql
 import logging
 from tenacity import retry, stop_after_attempt, wait_exponential
+from zep_python.memory import Message
+
+import metrics
+import tracing
+from context_window import ContextAssembler
+from rate_limiter import RateLimit
+from shared_resources import (acquire_pg_pool, get_llm_gateway, get_memory_writer, get_metrics_server, get_rate_limiter,
+                              get_tracer, get_zep_client, release_pg_pool, start_rate_limiter, stop_rate_limiter)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -22,6 +29,7 @@ WAHA_API_BASE_URL = os.getenv('WAHA_API_BASE_URL', 'https://waha.devlike.pro')
 WAHA_API_KEY = os.getenv('WAHA_API_KEY')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ZEP_API_BASE_URL = os.getenv('ZEP_API_BASE_URL')
+WHATSAPP_BOT_NAME = os.getenv('WHATSAPP_BOT_NAME', 'bot_name')  # Identifier that marks a message as a mention
 
 # PostgreSQL configuration
 DB_NAME = os.getenv('DB_NAME')
@@ -30,6 +38,42 @@ DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_HOST = os.getenv('DB_HOST')
 DB_PORT = os.getenv('DB_PORT')
 
+# Ingestion settings
+POLL_INTERVAL_MIN = 0.25  # Seconds between polls while messages keep arriving
+POLL_INTERVAL_MAX = 5.0  # Upper bound the poll interval backs off to when the API is idle
+MAX_CONCURRENT_GROUPS = 32  # Groups processed at the same time
+GROUP_QUEUE_SIZE = 100  # Messages buffered per group; past this the group's oldest waiting message is dropped
+GROUP_IDLE_TIMEOUT = 300  # Seconds an idle group worker lives before it is torn down
+API_TIMEOUT = 10  # Maximum wait time for WAHA API responses in seconds
+MESSAGE_SINK_BATCH_SIZE = 500  # Buffered message rows that trigger an immediate COPY into PostgreSQL
+MESSAGE_SINK_FLUSH_INTERVAL = 1.0  # Seconds between time-triggered flushes of the message buffer
+MESSAGE_SINK_MAX_BUFFER = 10000  # Rows kept for retry after a failed flush before the oldest are dropped
+LLM_MAX_CONCURRENCY = 16  # Chat completions in flight at once across the process
+LLM_REQUESTS_PER_MINUTE = 3500  # OpenAI request budget the gateway paces to
+LLM_TOKENS_PER_MINUTE = 200000  # OpenAI token budget the gateway paces to
+LLM_TIMEOUT = 60  # Seconds before a chat completion request is abandoned
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # Local port serving /metrics; 0 turns it off
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER")  # "file", "otlp", or unset to record no traces
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")  # OTLP/JSON lines written by the file exporter
+TRACE_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")  # Collector for the otlp exporter
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))  # Share of inbound messages that get traced
+
+# Rate limiting
+RATE_LIMIT_MESSAGES = 30  # Maximum bot replies per sender per minute
+BURST_ALLOWANCE = 5  # Number of rapid requests allowed before rate limiting kicks in
+RATE_LIMIT_GROUP_MESSAGES = 60  # Maximum bot replies per group per minute
+RATE_LIMIT_LLM_REQUESTS = 600  # Maximum bot replies per minute across all users, groups and bots
+RATE_LIMIT_RESPONSE = "You're doing that too much. Please wait a moment and try again."
+
+# Memory and context
+RESPONSE_GENERATION_MODEL = "gpt-4o-mini"
+MAX_CONTEXT_TOKENS = 3000  # Maximum number of tokens for the entire context
+CONTEXT_RETENTION_MESSAGES = 10  # Number of previous messages to retain for context
+CONTEXT_RETENTION_TIME = 30  # Minutes to retain context
+BATCH_SIZE = 10  # Number of messages coalesced into one Zep write
+MEMORY_FLUSH_INTERVAL = 1.0  # Seconds a queued message may wait before it is written to Zep
+MEMORY_QUEUE_SIZE = 1000  # Maximum queued Zep writes before handlers wait for the writer to catch up
+
 # Validate essential environment variables
 required_env_vars = ['WAHA_API_KEY', 'OPENAI_API_KEY', 'ZEP_API_BASE_URL', 'DB_NAME', 'DB_USER', 'DB_PASSWORD', 'DB_HOST', 'DB_PORT']
 missing_vars = [var for var in required_env_vars if not os.getenv(var)]
@@ -37,146 +81,162 @@ if missing_vars:
     logger.error(f"Missing required environment variables: {', '.join(missing_vars)}")
     sys.exit(1)
 
+USER_MESSAGE_LIMIT = RateLimit(RATE_LIMIT_MESSAGES, 60, BURST_ALLOWANCE)
+GROUP_MESSAGE_LIMIT = RateLimit(RATE_LIMIT_GROUP_MESSAGES, 60, BURST_ALLOWANCE)
+LLM_REQUEST_LIMIT = RateLimit(RATE_LIMIT_LLM_REQUESTS, 60, LLM_MAX_CONCURRENCY)
+LLM_BUDGET_KEY = "llm:global"  # Shared with the other bots, so the budget covers all of them
+
 # Set OpenAI API key
 openai.api_key = OPENAI_API_KEY
 
 # Initialize Zep client
 try:
-    zep_client = zep.ZepClient(base_url=ZEP_API_BASE_URL)
+    zep_client = get_zep_client(ZEP_API_BASE_URL)
 except Exception as e:
     logger.error(f"Failed to initialize Zep client: {e}")
     sys.exit(1)
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def get_db_connection():
-    try:
-        return psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-    except psycopg2.Error as e:
-        logger.error(f"Failed to connect to the database: {e}")
-        raise
+memory_writer = get_memory_writer(zep_client, batch_size=BATCH_SIZE, flush_interval=MEMORY_FLUSH_INTERVAL,
+                                  max_pending=MEMORY_QUEUE_SIZE)
+context_assembler = ContextAssembler(zep_client, RESPONSE_GENERATION_MODEL, max_tokens=MAX_CONTEXT_TOKENS,
+                                     max_messages=CONTEXT_RETENTION_MESSAGES,
+                                     retention_minutes=CONTEXT_RETENTION_TIME)
+llm_gateway = get_llm_gateway(max_concurrency=LLM_MAX_CONCURRENCY, requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+                              tokens_per_minute=LLM_TOKENS_PER_MINUTE, timeout=LLM_TIMEOUT)
+rate_limiter = get_rate_limiter()
+
+
+async def create_db_pool():
+    return await acquire_pg_pool(
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT
+    )
 
-def create_messages_table():
+async def create_messages_table(pool):
     try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS messages (
-                        id SERIAL PRIMARY KEY,
-                        group_id TEXT NOT NULL,
-                        sender TEXT NOT NULL,
-                        message TEXT NOT NULL,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-            conn.commit()
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id SERIAL PRIMARY KEY,
+                    group_id TEXT NOT NULL,
+                    sender TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS messages_group_id_timestamp_idx
+                ON messages (group_id, timestamp)
+            """)
         logger.info("Messages table created successfully or already exists.")
-    except psycopg2.Error as e:
+    except asyncpg.PostgresError as e:
         logger.error(f"Failed to create messages table: {e}")
         raise
 
 
+class PostgresMessageSink:
+    """Buffers message rows and writes them to PostgreSQL in bulk.
+
+    Rows are flushed with a single COPY when MESSAGE_SINK_BATCH_SIZE of them are
+    buffered or every MESSAGE_SINK_FLUSH_INTERVAL seconds, whichever comes first.
+    A failed flush keeps its rows (up to MESSAGE_SINK_MAX_BUFFER) for the next one.
+    """
+
+    columns = ('group_id', 'sender', 'message', 'timestamp')
+
+    def __init__(self, pool, batch_size=MESSAGE_SINK_BATCH_SIZE, flush_interval=MESSAGE_SINK_FLUSH_INTERVAL,
+                 max_buffer=MESSAGE_SINK_MAX_BUFFER):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.rows = []
+        self.lock = asyncio.Lock()
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._flush_periodically())
+
+    async def add(self, group_id, sender, message):
+        # Timestamp on receipt, since the row may reach the table a little later
+        self.rows.append((group_id, sender, message, datetime.now()))
+        if len(self.rows) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            rows, self.rows = self.rows, []
+            if not rows:
+                return
+            try:
+                async with self.pool.acquire() as conn:
+                    await conn.copy_records_to_table('messages', records=rows, columns=self.columns)
+                logger.info(f"Logged {len(rows)} messages to PostgreSQL")
+            except (asyncpg.PostgresError, OSError) as e:
+                logger.error(f"Failed to log {len(rows)} messages to PostgreSQL: {e}")
+                self.rows = (rows + self.rows)[-self.max_buffer:]
+
+    async def close(self):
+        if self._task is not None:
+            # Cancel under the lock so the periodic flusher is never stopped mid-COPY
+            async with self.lock:
+                self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+async def log_message_to_zep(message, sender, group_id):
+    await memory_writer.add(
+        group_id,
+        Message(role="user", content=f"{sender}: {message}", metadata={"sender": sender}),
+        metadata={"session_id": group_id, "group_name": group_id}
+    )
 
-
-
-
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def log_message_to_postgres(group_id, sender, message):
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    sql.SQL("INSERT INTO messages (group_id, sender, message) VALUES (%s, %s, %s)"),
-                    (group_id, sender, message)
-                )
-            conn.commit()
-        logger.info(f"Logged message to PostgreSQL: {message[:50]}... from {sender} in group {group_id}")
-    except psycopg2.Error as e:
-        logger.error(f"Failed to log message to PostgreSQL: {e}")
-        raise
-
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def log_message_to_zep(message, sender, group_id):
-    try:
-        session_id = group_id
-        try:
-            session = zep_client.get_session(session_id)
-        except zep.SessionNotFound:
-            session = zep.Session(session_id=session_id, metadata={"group_name": group_id})
-            zep_client.add_session(session)
-        
-        chat_message = zep.Message(
-            role="user",
-            content=message,
-            metadata={
-                "sender": sender,
-                "timestamp": datetime.now().isoformat()
-            }
-        )
-        
-        zep_client.add_message(session_id, chat_message)
-        logger.info(f"Logged message to Zep: {message[:50]}... from {sender} in group {group_id}")
-    except Exception as e:
-        logger.error(f"Failed to log message to Zep: {e}")
-        raise
-
-def retrieve_chat_history(session_id):
+async def build_contextual_prompt(current_message, group_id):
+    await memory_writer.flush(group_id)
     try:
-        messages = zep_client.get_messages(session_id)
-        return messages
-    except zep.SessionNotFound:
-        logger.warning(f"No chat history found for session {session_id}")
-        return []
+        window = await context_assembler.build(group_id)
+        history_content = window.transcript()
     except Exception as e:
         logger.error(f"Failed to retrieve chat history: {e}")
-        return []
+        history_content = ""
 
-def build_contextual_prompt(current_message, group_id):
-    history = retrieve_chat_history(group_id)
-    history_content = "\n".join(
-        [f"{msg.metadata['sender']}: {msg.content}" for msg in history if msg.content]
-    )
-    
     prompt = f"Conversation history:\n{history_content}\n\nUser's latest message:\n{current_message}\n\nReply to the user based on the conversation above."
     return prompt
 
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def send_whatsapp_message(group_id, message):
+async def send_whatsapp_message(http, group_id, message):
     url = f"{WAHA_API_BASE_URL}/sendMessage"
-    headers = {
-        'Authorization': f'Bearer {WAHA_API_KEY}',
-        'Content-Type': 'application/json'
-    }
     data = {
         "group_id": group_id,
         "message": message
     }
     try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        logger.info(f"Message sent successfully to group {group_id}")
-        return response.status_code, response.text
-    except requests.RequestException as e:
+        async with http.post(url, json=data) as response:
+            response.raise_for_status()
+            logger.info(f"Message sent successfully to group {group_id}")
+            return response.status, await response.text()
+    except aiohttp.ClientError as e:
         logger.error(f"Failed to send WhatsApp message: {e}")
         raise
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def handle_mention(message, group_id):
-    prompt = build_contextual_prompt(message, group_id)
-    
+async def handle_mention(message, group_id):
+    prompt = await build_contextual_prompt(message, group_id)
+
     try:
-        response = openai.Completion.create(
-            engine="gpt-4o-mini",
-            prompt=prompt,
+        reply = (await llm_gateway.chat_text(
+            RESPONSE_GENERATION_MODEL,
+            [{"role": "user", "content": prompt}],
             max_tokens=150
-        )
-        
-        reply = response['choices'][0]['text'].strip()
+        )).strip()
         logger.info(f"Generated response for group {group_id}")
         return reply
     except openai.error.OpenAIError as e:
@@ -186,56 +246,179 @@ def handle_mention(message, group_id):
         logger.error(f"Error generating response: {e}")
         return "An unexpected error occurred. Please try again later."
 
-def process_messages():
-    url = f"{WAHA_API_BASE_URL}/getMessages"
-    headers = {
-        'Authorization': f'Bearer {WAHA_API_KEY}',
-        'Content-Type': 'application/json'
-    }
-
-    while True:
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            messages = response.json()
-
-            for msg in messages:
-                group_id = msg['group_id']
-                sender = msg['sender']
-                message = msg['message']
-
-                try:
-                    log_message_to_postgres(group_id, sender, message)
-                    log_message_to_zep(message, sender, group_id)
-
-                    if 'bot_name' in message:  # Replace 'bot_name' with your bot's identifier
-                        reply = handle_mention(message, group_id)
-                        send_whatsapp_message(group_id, reply)
-                except Exception as e:
-                    logger.error(f"Error processing message: {e}")
-                    continue  # Continue with the next message even if there's an error
-
-        except requests.RequestException as e:
-            logger.error(f"Error fetching messages from WAHA API: {e}")
-        except Exception as e:
-            logger.error(f"Unexpected error in message processing loop: {e}")
-        
-        # Add a small delay to avoid hammering the API
-        time.sleep(1)
-
-
 
+class WhatsAppIngestionService:
+    """Polls WAHA and processes messages with one ordered worker per group.
+
+    Groups run concurrently (bounded by MAX_CONCURRENT_GROUPS) while messages
+    within a group are handled strictly in arrival order. A group that falls
+    GROUP_QUEUE_SIZE messages behind loses its oldest waiting ones rather than
+    stalling intake for every other group. The poll interval
+    drops to POLL_INTERVAL_MIN while traffic flows and doubles up to
+    POLL_INTERVAL_MAX while the API is idle.
+    """
+
+    def __init__(self):
+        self.http = None
+        self.pool = None
+        self.message_sink = None
+        self.running = False
+        self.poll_interval = POLL_INTERVAL_MIN
+        self.group_queues = {}
+        self.group_workers = {}
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_GROUPS)
+
+    async def start(self):
+        self.http = aiohttp.ClientSession(
+            headers={
+                'Authorization': f'Bearer {WAHA_API_KEY}',
+                'Content-Type': 'application/json'
+            },
+            timeout=aiohttp.ClientTimeout(total=API_TIMEOUT)
+        )
+        self.pool = await create_db_pool()
+        await create_messages_table(self.pool)
+        self.message_sink = PostgresMessageSink(self.pool)
+        await self.message_sink.start()
+        await memory_writer.start()
+        await llm_gateway.start()
+        await start_rate_limiter(
+            database=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            host=DB_HOST,
+            port=DB_PORT
+        )
+        if METRICS_PORT:
+            await get_metrics_server(METRICS_PORT).start()
+        await get_tracer(TRACE_EXPORTER, path=TRACE_FILE, endpoint=TRACE_OTLP_ENDPOINT,
+                         sample_rate=TRACE_SAMPLE_RATE).start()
+        self.running = True
+
+    async def run(self):
+        url = f"{WAHA_API_BASE_URL}/getMessages"
+
+        while self.running:
+            try:
+                async with self.http.get(url) as response:
+                    response.raise_for_status()
+                    messages = await response.json()
+
+                for msg in messages:
+                    self.dispatch(msg)
+
+                if messages:
+                    self.poll_interval = POLL_INTERVAL_MIN
+                else:
+                    self.poll_interval = min(self.poll_interval * 2, POLL_INTERVAL_MAX)
+
+            except aiohttp.ClientError as e:
+                logger.error(f"Error fetching messages from WAHA API: {e}")
+                self.poll_interval = POLL_INTERVAL_MAX
+            except Exception as e:
+                logger.error(f"Unexpected error in message processing loop: {e}")
+                self.poll_interval = POLL_INTERVAL_MAX
+
+            await asyncio.sleep(self.poll_interval)
+
+    def dispatch(self, msg):
+        group_id = msg['group_id']
+        queue = self.group_queues.get(group_id)
+        if queue is None:
+            queue = self.group_queues[group_id] = asyncio.Queue(maxsize=GROUP_QUEUE_SIZE)
+            self.group_workers[group_id] = asyncio.create_task(self._group_worker(group_id, queue))
+        if queue.full():
+            # The group is flooded; make room by dropping its oldest waiting message
+            queue.get_nowait()
+            queue.task_done()
+            metrics.ERRORS_TOTAL.labels("whatsapp", "group_queue_full").inc()
+            logger.warning(f"Group {group_id} is {GROUP_QUEUE_SIZE} messages behind, dropped its oldest message")
+        queue.put_nowait(msg)
+
+    async def _group_worker(self, group_id, queue):
+        while True:
+            try:
+                msg = await asyncio.wait_for(queue.get(), GROUP_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                # dispatch() may have queued a message after the timer fired but before this task resumed
+                if not queue.empty():
+                    continue
+                # dispatch() never awaits, so nothing can be queued between the check above and here
+                del self.group_queues[group_id]
+                del self.group_workers[group_id]
+                return
+
+            try:
+                async with self.semaphore:
+                    await self.process_message(group_id, msg['sender'], msg['message'])
+            except Exception as e:
+                metrics.ERRORS_TOTAL.labels("whatsapp", "process_message").inc()
+                logger.error(f"Error processing message: {e}")
+            finally:
+                queue.task_done()
+
+    async def process_message(self, group_id, sender, message):
+        metrics.MESSAGES_TOTAL.labels("whatsapp").inc()
+        # One trace per inbound message; every stage below it opens a child span
+        with tracing.span("whatsapp.message", tracing.KIND_SERVER, {"platform": "whatsapp", "session.id": group_id}):
+            with tracing.span("memory_enqueue"):
+                await self.message_sink.add(group_id, sender, message)
+                await log_message_to_zep(message, sender, group_id)
+
+            if WHATSAPP_BOT_NAME in message:
+                # Every mention is a paid completion: charge the sender, the group and the global budget
+                with tracing.span("rate_limit") as span:
+                    decision = await rate_limiter.hit(
+                        (USER_MESSAGE_LIMIT, f"whatsapp:user:{sender}"),
+                        (GROUP_MESSAGE_LIMIT, f"whatsapp:group:{group_id}"),
+                        (LLM_REQUEST_LIMIT, LLM_BUDGET_KEY)
+                    )
+                    span.set_attribute("rate_limit.allowed", decision.allowed)
+                if not decision.allowed:
+                    metrics.MENTIONS_TOTAL.labels("whatsapp", "rate_limited").inc()
+                    await send_whatsapp_message(self.http, group_id, RATE_LIMIT_RESPONSE)
+                    return
+                with metrics.MENTION_SECONDS.labels("whatsapp").time(), tracing.span("mention"):
+                    reply = await handle_mention(message, group_id)
+                    with metrics.stage("whatsapp", "platform_send"), tracing.span("platform_send"):
+                        await send_whatsapp_message(self.http, group_id, reply)
+                metrics.MENTIONS_TOTAL.labels("whatsapp", "answered").inc()
+
+    async def stop(self):
+        self.running = False
+        # Let every group finish what it already received before tearing down
+        await asyncio.gather(*(queue.join() for queue in list(self.group_queues.values())))
+        for worker in list(self.group_workers.values()):
+            worker.cancel()
+        if self.message_sink is not None:
+            await self.message_sink.close()
+        await memory_writer.close()
+        await llm_gateway.close()
+        await stop_rate_limiter()
+        if METRICS_PORT:
+            await get_metrics_server(METRICS_PORT).close()
+        await tracing.TRACER.close()
+        if self.http is not None:
+            await self.http.close()
+        if self.pool is not None:
+            await release_pg_pool(self.pool)
+
+
+async def main():
+    service = WhatsAppIngestionService()
+    await service.start()
+    logger.info("Starting message processing...")
+    try:
+        await service.run()
+    finally:
+        await service.stop()
 
 
 if __name__ == "__main__":
     try:
-        create_messages_table()
-        logger.info("Starting message processing...")
-        process_messages()
+        asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Shutting down gracefully...")
     except Exception as e:
         logger.critical(f"Critical error: {e}")
         sys.exit(1)
-
-
@@ -0,0 +1,119 @@
+import asyncio
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from zep_python import ZepClient
+
+import metrics
+import tracing
+
+
+logger = logging.getLogger(__name__)
+
+
+# Async facade over the Zep SDK client.
+# Every method of the wrapped sub-clients (memory, message, user, document) is
+# awaitable through the facade: calls go to the SDK's native async variant
+# (`aadd_memory` for `add_memory`) when it has one, and to a small bounded
+# thread pool otherwise, so a blocking SDK call can never stall the event loop.
+# Offloaded calls run in a copy of the caller's context, so tracing spans
+# follow them onto the pool. Each call is capped at `timeout` seconds, counted
+# per method and traced as a client span. Existing
+# call sites keep their `await client.memory.aadd_memory(...)` spelling.
+
+SUB_CLIENTS = ("memory", "message", "user", "document")
+
+ZEP_SECONDS = metrics.histogram("zep_call_seconds", "Zep SDK call latency", ("method",))
+ZEP_FAILURES = metrics.counter("zep_call_failures_total", "Zep SDK calls that raised or timed out", ("method", "kind"))
+
+
+class ZepCallStats:
+    __slots__ = ("calls", "errors", "timeouts", "seconds", "max_seconds", "offloaded")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.offloaded = 0  # calls that ran on the thread pool
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _SubClient:
+    def __init__(self, facade, name, target):
+        self._facade = facade
+        self._name = name
+        self._target = target
+
+    def __getattr__(self, attribute):
+        sync_name = attribute[1:] if attribute.startswith("a") and hasattr(self._target, attribute[1:]) else attribute
+        native = getattr(self._target, "a" + sync_name, None)
+        if asyncio.iscoroutinefunction(native):
+            function, offload = native, False
+        else:
+            function, offload = getattr(self._target, sync_name), True
+            if not callable(function):
+                return function
+        key = f"{self._name}.{sync_name}"
+
+        async def call(*args, **kwargs):
+            return await self._facade.call(key, function, offload, *args, **kwargs)
+
+        return call
+
+
+class AsyncZepClient:
+    def __init__(self, base_url, api_key=None, timeout=5.0, max_workers=4):
+        self.client = ZepClient(base_url=base_url, api_key=api_key)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="zep")
+        self._stats = {}
+        for name in SUB_CLIENTS:
+            if hasattr(self.client, name):
+                setattr(self, name, _SubClient(self, name, getattr(self.client, name)))
+
+    def __getattr__(self, attribute):
+        return getattr(self.client, attribute)
+
+    async def call(self, key, function, offload, *args, **kwargs):
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = ZepCallStats()
+        stats.calls += 1
+        started = time.monotonic()
+        try:
+            with tracing.span(f"zep.{key}", tracing.KIND_CLIENT, {"zep.offloaded": offload}, require_parent=True):
+                if offload:
+                    stats.offloaded += 1
+                    loop = asyncio.get_running_loop()
+                    context = contextvars.copy_context()
+                    # A timed-out call keeps its worker until the SDK returns; the pool bounds how many can pile up
+                    future = loop.run_in_executor(self._executor, lambda: context.run(function, *args, **kwargs))
+                else:
+                    future = function(*args, **kwargs)
+                return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            ZEP_FAILURES.labels(key, "timeout").inc()
+            logger.error(f"Zep {key} timed out after {self.timeout}s")
+            raise
+        except Exception as e:
+            stats.errors += 1
+            ZEP_FAILURES.labels(key, type(e).__name__).inc()
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            ZEP_SECONDS.labels(key).observe(elapsed)
+            stats.seconds += elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+
+    def stats(self):
+        return {key: stats.as_dict() for key, stats in self._stats.items()}
+
+    def close(self):
+        self._executor.shutdown(wait=False)